@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+'''
+bulkload.py: imports large datasets directly into the dbs, bypassing the
+per-command routing, checks and transactions. can be run as a script:
+
+    python -m clodss.bulkload DBPATH FILE [--db DB] [--format FORMAT]
+                              [--chunk-size N] [--profile PROFILE]
+'''
+
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+from .common import _setcount, _setexpire, _transaction
+from .hashmaps import _augkey, _hmget, _length
+from .keys import _keyexists
+from .lists import MIDDLE_INDEX, _itemkey, _meta, _setmeta
+from .storage import PROFILES
+
+LOG = logging.getLogger('clodss')
+
+# records partitioned, sorted and written at once
+CHUNK_SIZE = 1000000
+
+# options of SET taking an expiry, mapped to the units of their value per
+# second
+SET_EXPIRY_OPTIONS = {b'EX': 1, b'PX': 1000, b'EXAT': 1, b'PXAT': 1000}
+
+
+def readjsonl(f):
+    '''
+    reads records from JSON lines of the form
+    {"key": key, "value": value, "ttl": seconds}, where "ttl" is optional
+    '''
+    for line in f:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        yield item['key'], item['value'], item.get('ttl')
+
+
+def readcsv(f):
+    'reads string records from CSV rows key,value[,ttl]'
+    for row in csv.reader(f):
+        if not row:
+            continue
+        ttl = float(row[2]) if len(row) > 2 and row[2] else None
+        yield row[0], row[1], ttl
+
+
+def _readresp(f):
+    # commands in the redis protocol, i.e. arrays of bulk strings
+    while True:
+        line = f.readline()
+        if not line.strip():
+            if not line:
+                return
+            continue
+        if not line.startswith(b'*'):
+            raise ValueError(f'invalid command {line!r}')
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(f.readline()[1:])
+            args.append(f.read(size + 2)[:-2])
+        yield args
+
+
+def readresp(f):
+    '''
+    reads records from commands in the redis protocol, as fed to
+    `redis-cli --pipe`. supported commands are SET (with EX, PX, EXAT or
+    PXAT, its flags NX, XX, KEEPTTL and GET are ignored), HSET, HMSET, RPUSH,
+    EXPIRE and PEXPIRE
+    '''
+    for args in _readresp(f):
+        command = args[0].upper()
+        key = args[1].decode('utf-8')
+        if command == b'SET':
+            ttl = None
+            options = iter(args[3:])
+            for option in options:
+                option = option.upper()
+                if option in SET_EXPIRY_OPTIONS:
+                    value = next(options, None)
+                    if value is None:
+                        raise ValueError(f'no value for SET option {option!r}')
+                    ttl = float(value) / SET_EXPIRY_OPTIONS[option]
+                    if option.endswith(b'AT'):
+                        ttl -= time.time()
+                elif option not in (b'NX', b'XX', b'KEEPTTL', b'GET'):
+                    raise ValueError(f'unsupported SET option {option!r}')
+            yield key, args[2], ttl
+        elif command in (b'HSET', b'HMSET'):
+            yield key, {f.decode('utf-8'): v
+                        for f, v in zip(args[2::2], args[3::2])}, None
+        elif command == b'RPUSH':
+            yield key, args[2:], None
+        elif command == b'EXPIRE':
+            yield key, None, float(args[2])
+        elif command == b'PEXPIRE':
+            yield key, None, float(args[2]) / 1000
+        else:
+            raise ValueError(f'unsupported command {command!r}')
+
+
+READERS = {
+    'jsonl': (readjsonl, 'r'),
+    'csv': (readcsv, 'r'),
+    'resp': (readresp, 'rb'),
+}
+
+
+def _value(value):
+    return value if isinstance(value, (bytes, str)) else str(value)
+
+
+def _records(instance, db, fresh, items):
+    # converts items to the records of the db, in the order of the items
+    records = []
+    fields = {}
+    for key, value, _ in items:
+        if not fresh:
+            instance.checkexpired(key, enforce=True)
+            dtype = instance.keydtype(key)
+            vtype = b'h' if isinstance(value, dict) else \
+                b'l' if isinstance(value, list) else ''
+            if value is not None and dtype is not None and dtype != vtype:
+                raise ValueError(f'cannot load {key!r} over a {dtype} value')
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            hrecords = [(_augkey(key, f).encode('utf-8'), _value(v))
+                        for f, v in value.items()]
+            records.extend(hrecords)
+            fields.setdefault(key, set()).update(k for k, _ in hrecords)
+        elif isinstance(value, list):
+            meta = _meta(key, db)
+            length, head, tail = meta or (0, MIDDLE_INDEX + 1, MIDDLE_INDEX)
+            records.extend((_itemkey(key, tail + i), _value(v))
+                           for i, v in enumerate(value, 1))
+            _setmeta(key, db, length + len(value), head, tail + len(value))
+        else:
+            records.append((key.encode('utf-8'), _value(value)))
+    for key, hrecords in fields.items():
+        added = len(hrecords) - len(_hmget(db, sorted(hrecords)))
+        _setcount(db, key, 'h', _length(db, key) + added)
+    return records
+
+
+def _loadpartition(instance, db, fresh, items):
+    # checkpoints are postponed until the end of the load
+    autocheckpoint = db.autocheckpoint
+    db.autocheckpoint = 0
+    try:
+        with _transaction(db):
+            records = _records(instance, db, fresh, items)
+            records.sort(key=lambda record: record[0])
+            db.update(dict(records))
+            now = time.time()
+            for key, value, ttl in items:
+                if ttl is None:
+                    continue
+                # like expire, a ttl alone is ignored for missing keys
+                if value is None and not _keyexists(db, key):
+                    continue
+                _setexpire(db, key, now + float(ttl))
+    finally:
+        db.autocheckpoint = autocheckpoint
+
+
+def _loadchunk(instance, loaded, existing, chunk):
+    router = instance.router
+    groups = {}
+    for item in chunk:
+        groups.setdefault(router.shard(item[0]), []).append(item)
+    for name, items in sorted(groups.items()):
+        # dbs created by the load hold no data to check against
+        fresh = name not in existing
+        loaded.add(name)
+        with router.checkout(name) as conn, router.locked(name):
+            _loadpartition(instance, conn.db(), fresh, items)
+        for key, value, _ in items:
+            instance.uncachekey(key)
+            instance.keystoexpire.pop(key, None)
+            if isinstance(value, list):
+                instance.notifier.notify(key)
+    LOG.debug('loaded %d items', len(chunk))
+    return len(chunk)
+
+
+def bulkload(instance, items, chunksize=CHUNK_SIZE):
+    '''
+    imports `items`, an iterable of tuples (key, value, ttl) where value is a
+    string, a dict of hash fields or a list of list items, and ttl is None or
+    a number of seconds. strings replace existing ones like `set`, hash
+    fields are added and list items are appended like `rpush`. a value of
+    None only sets the ttl of an existing key. items are read by chunks of
+    `chunksize`, partitioned by db and sorted, and every db is written in one
+    transaction per chunk. the writes of the load do not checkpoint the dbs,
+    they are checkpointed once at the end. keys are type-checked against the
+    data which existed before the load, the items of a key must all have the
+    same type.
+    returns the number of items loaded
+    '''
+    router = instance.router
+    if router.layout.target is not None:
+        raise ValueError('cannot load while resharding')
+    existing = set(router.dbnames())
+    loaded = set()
+    count = 0
+    chunk = []
+    for item in items:
+        chunk.append(tuple(item) if len(item) == 3 else (*item, None))
+        if len(chunk) == chunksize:
+            count += _loadchunk(instance, loaded, existing, chunk)
+            chunk = []
+    count += _loadchunk(instance, loaded, existing, chunk)
+    for name in sorted(loaded):
+        with router.checkout(name) as conn, router.locked(name):
+            db = conn.db()
+            db.flush()
+            db.checkpoint(0)
+    return count
+
+
+def main(argv=None):
+    'command line entry point'
+    # pylint: disable=import-outside-toplevel,cyclic-import
+    from .clodss import StrictRedis
+    parser = argparse.ArgumentParser(
+        description='imports a dataset into a clodss database')
+    parser.add_argument('dbpath', help='base path of the database')
+    parser.add_argument('file', help='file to import, - for stdin')
+    parser.add_argument('--db', type=int, default=0, help='database index')
+    parser.add_argument('--format', choices=READERS,
+                        help='file format, guessed from the file extension '
+                        'by default')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='number of items written per transaction')
+    parser.add_argument('--profile', choices=PROFILES, default='bulk-load',
+                        help='storage profile used while loading')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    fmt = args.format or os.path.splitext(args.file)[1].lstrip('.')
+    if fmt not in READERS:
+        parser.error('unknown file format, use --format')
+    reader, mode = READERS[fmt]
+    instance = StrictRedis(args.dbpath, args.db, benchmark=False,
+                           storage_profile=args.profile)
+    t = time.time()
+    if args.file == '-':
+        f = sys.stdin.buffer if mode == 'rb' else io.TextIOWrapper(
+            sys.stdin.buffer, encoding='utf-8', newline='')
+        count = bulkload(instance, reader(f), args.chunk_size)
+    else:
+        encoding = None if mode == 'rb' else 'utf-8'
+        newline = None if mode == 'rb' else ''
+        with open(args.file, mode, encoding=encoding, newline=newline) as f:
+            count = bulkload(instance, reader(f), args.chunk_size)
+    instance.router.close()
+    LOG.info('loaded %d items in %.1fs', count, time.time() - t)
+
+
+if __name__ == '__main__':
+    main()
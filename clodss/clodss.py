@@ -8,81 +8,120 @@ and does not burden accesses with network latency.
 '''
 
 import logging
+import threading
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 from random import random
 import __main__
 from .router import Router
+from .pipeline import Pipeline
+from .notify import Notifier
+from .expiry import ActiveExpiry
+from .counters import CounterBuffer
+from .metrics import Metrics
+from .storage import storageoptions
 from . import hashmaps
+from . import zsets
+from . import sets
 from . import lists
 from . import keys
-from .common import SEP
+from . import bulkload
+from . import reshard
+from . import snapshot
+from .common import SEP, GLOBAL_METHODS, BLOCKING_METHODS, READ_METHODS
+from .common import methodtype, otherkeys, isbusy, _deletekey, _transaction
 
 LOG = logging.getLogger('clodss')
 
 
-def wrapmethod(method, stats=None):
+# retries of commands failing because their db is locked, with exponential
+# backoff between RETRY_BACKOFF and RETRY_BACKOFF_MAX seconds
+RETRY_ATTEMPTS = 10
+RETRY_BACKOFF = .001
+RETRY_BACKOFF_MAX = .1
+# seconds the metadata of a key is cached, i.e. how long the expiry set on
+# a key by other instances or processes may go unnoticed
+KEYCACHE_LIFETIME = .1
+
+
+def _runkeyed(instance, name, method, args, kwargs):
+    # returns the name of the db of the key and the result of the command
+    router = instance.router
+    key = args[1]
+    write = name not in READ_METHODS
+    # nested calls on the same db share the connection of the outer call.
+    # the dbs of the other keys of the command are locked along with the one
+    # of its key
+    with router.keyed(key, write, otherkeys(name, args[1:])) as conn:
+        instance.checkkey(name, key)
+        if not write:
+            return conn.name, method(*args, **kwargs)
+        with _transaction(conn.db()):
+            result = method(*args, **kwargs)
+        router.touch(key)
+        return conn.name, result
+
+
+def wrapmethod(method, name=None):
     '''
-    - guards all clodss methods with a key-scoped lock
+    - guards all clodss methods with a db-scoped reader/writer lock and runs
+      writers in a transaction
     - performs sanity checks on key
     - enures the key has not expired
+    - retries commands failing because their db is locked by another process
+    - records the metrics of the outermost command, if enabled
+    `name` is the command name, defaults to the name of `method`
     '''
-    def wrapper(*args, **kwargs):  # pylint: disable=too-many-branches
-        globalmethod = method.__name__ in ('keys', 'scan', 'flushdb')
+    name = name or method.__name__
+    keyed = name not in GLOBAL_METHODS + BLOCKING_METHODS
+    writes = name not in READ_METHODS + GLOBAL_METHODS + BLOCKING_METHODS
 
+    def wrapper(*args, **kwargs):
         instance = args[0]
-        if globalmethod:
-            key = '﹁'
-        else:
-            if len(args) < 2:
-                raise TypeError('too few parameters, `key` is required')
-            key = args[1]
-
-            if SEP in key:
-                raise ValueError(f'`key` contains invalid character(s): {SEP}')
-        dtype = instance.keydtype(key)
-        methodtype = method.__name__[0].encode('utf-8')
-        if method.__name__ in ('rpush', 'rpop'):
-            methodtype = b'l'
-        elif methodtype not in (b'l', b'h'):
-            methodtype = ''
-        LOG.debug(method.__name__, key, dtype, methodtype, globalmethod)
-        if method.__name__ != 'delete' and dtype is not None \
-            and not globalmethod and dtype != methodtype:
-            raise ValueError('incompatible operation `%s` on %s' %(
-                method.__name__, dtype))
-
-        if stats is not None:
+        if keyed and len(args) < 2:
+            raise TypeError('too few parameters, `key` is required')
+        # only the outermost command retries, as it holds the locks
+        nested = instance.router.holdslocks()
+        metrics = None if nested else instance.metrics
+        if metrics is not None:
             t1 = time.perf_counter()
-        if not globalmethod:
-            instance.checkexpired(key, enforce=True)
 
-        ntries = 0
-        while True:
-            try:
-                result = method(*args, **kwargs)
-                break
-            except Exception:  # pylint: disable=broad-except
-                ntries += 1
-                if ntries >= 30:
-                    raise
-                time.sleep(random()/10)
+        def run():
+            if keyed:
+                return _runkeyed(instance, name, method, args, kwargs)
+            return None, method(*args, **kwargs)
 
-        if stats is not None:
-            t = time.perf_counter() - t1
-            avg, n = stats.get(method.__name__, (0, 0))
-            avg = (avg * n + t) / (n + 1)
-            stats[method.__name__] = (avg, n + 1)
+        shard = result = None
+        error = True
+        try:
+            if nested:
+                shard, result = run()
+            else:
+                shard, result = instance.retrying(name, run)
+            error = False
+        finally:
+            if not nested:
+                instance.notifier.flush()
+            if metrics is not None:
+                metrics.record(
+                    name, shard, time.perf_counter() - t1, error,
+                    args=(args[2:], kwargs) if writes else (), result=result)
         return result
-    wrapper.__name__ = method.__name__
+    wrapper.__name__ = name
+    wrapper.__wrapped__ = method
     return wrapper
 
 
-class StrictRedis:
+class StrictRedis:  # pylint: disable=too-many-instance-attributes
     'main clodss class'
-    def __init__(
+    def __init__(  # pylint: disable=too-many-arguments
             self, dbpath: str = None, db: int = 0, spread_factor: int = 2,
-            decode_responses: bool = False, benchmark: bool = True) -> None:
+            decode_responses: bool = False, benchmark: bool = True, *,
+            scan_workers: int = 1, scan_processes: bool = False,
+            active_expire_interval: float = None,
+            keycache_size: int = 100000, max_open_dbs: int = 256,
+            storage_profile: str = None, storage_options: dict = None) -> None:
         if dbpath is None:
             try:
                 fname = __main__.__file__
@@ -97,12 +136,26 @@ class StrictRedis:
         dbpath = os.path.join(dbpath, '%02d' % db)
         os.makedirs(dbpath, exist_ok=True)
         self._dbpath = dbpath
-        self.router = Router(dbpath, spread_factor)
+        self.router = Router(
+            dbpath, spread_factor, workers=scan_workers,
+            processes=scan_processes, maxopen=max_open_dbs,
+            options=storageoptions(storage_profile, storage_options))
+        self.notifier = Notifier(os.path.join(dbpath, 'notify'))
         self.knownkeys = {}
+        self.keycachesize = keycache_size
         self.keystoexpire = {}
-        self._stats = {} if benchmark else None
+        self.metrics = Metrics() if benchmark else None
+        self._retries = {}
+        self._retrieslock = threading.Lock()
+        self._tasks = set()
+        self._taskslock = threading.Lock()
+        self._executor = None
+        self.activeexpiry = None
+        if active_expire_interval:
+            self.activeexpiry = ActiveExpiry(self, active_expire_interval)
+            self.activeexpiry.start()
 
-        modules = [keys, lists, hashmaps]
+        modules = [keys, lists, hashmaps, zsets, sets]
         for module in modules:
             for attr in dir(module):
                 if attr.startswith('_'):
@@ -113,11 +166,116 @@ class StrictRedis:
                 if attr == 'sēt':
                     # `set` is a reserved keyword
                     attr = 'set'
-                setattr(StrictRedis, attr, wrapmethod(method, self._stats))
+                setattr(StrictRedis, attr, wrapmethod(method, attr))
+
+    def pipeline(self, transaction: bool = True):
+        '''
+        creates a pipeline which queues commands and executes them in batches,
+        one per db, each batch running in a single transaction unless
+        `transaction` is False
+        '''
+        return Pipeline(self, transaction)
+
+    def counterbuffer(self, interval: float = 1.):
+        '''
+        creates a buffer which sums counter increments in memory and writes
+        them every `interval` seconds, for counters which may lag behind
+        '''
+        return CounterBuffer(self, interval)
+
+    def bulkload(self, items, chunksize: int = bulkload.CHUNK_SIZE):
+        '''
+        imports `items` directly into the dbs, by large sorted batches, see
+        `bulkload.bulkload`
+        '''
+        return bulkload.bulkload(self, items, chunksize)
+
+    def snapshot(self, path: str, base: str = None):
+        '''
+        writes a point-in-time snapshot of the database to the directory
+        `path`, incrementally from the snapshot at `base` if given, see
+        `snapshot.snapshot`
+        '''
+        return snapshot.snapshot(self, path, base)
+
+    def reshard(self, spread_factor: int, batchsize: int = 1000):
+        '''
+        moves the data to the layout of `spread_factor` while serving
+        requests, see `reshard.reshard`
+        '''
+        reshard.reshard(self.router, spread_factor, batchsize)
+
+    def schedule(self, task, *args):
+        '''
+        runs the maintenance `task(*args)` in a background thread, unless the
+        same task is already waiting to run
+        '''
+        with self._taskslock:
+            if (task, args) in self._tasks:
+                return None
+            self._tasks.add((task, args))
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    1, thread_name_prefix='clodss')
+        return self._executor.submit(self._runtask, task, args)
+
+    def _runtask(self, task, args):
+        with self._taskslock:
+            self._tasks.discard((task, args))
+        try:
+            return task(*args)
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception('background task %s failed', task.__name__)
+            return None
 
     def stats(self):
-        'gets benchmarking statistics'
-        return self._stats
+        '''
+        gets the mean duration in seconds and the number of calls per command,
+        None if benchmarking is disabled. see `metrics` for detailed measures
+        '''
+        if self.metrics is None:
+            return None
+        return self.metrics.stats()
+
+    def retrying(self, method, func, *args):
+        '''
+        runs `func(*args)` for the command `method`, retried with exponential
+        backoff while it fails because its db is locked
+        '''
+        ntries = 0
+        while True:
+            try:
+                return func(*args)
+            except Exception as e:  # pylint: disable=broad-except
+                if not isbusy(e):
+                    raise
+                ntries += 1
+                self.countretry(method, ntries)
+                if ntries > RETRY_ATTEMPTS:
+                    raise
+                time.sleep(random() * min(
+                    RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** ntries))
+
+    def countretry(self, method, ntries):
+        'records a retry of a command, `ntries` is the number of the retry'
+        with self._retrieslock:
+            retries, giveups = self._retries.get(method, (0, 0))
+            if ntries > RETRY_ATTEMPTS:
+                giveups += 1
+            else:
+                retries += 1
+            self._retries[method] = (retries, giveups)
+        if ntries <= RETRY_ATTEMPTS and self.metrics is not None:
+            self.metrics.retry(method)
+
+    def retrystats(self):
+        '''
+        gets the number of retries and of failures after all retries per
+        command, and the number and total seconds of lock waits per db
+        '''
+        with self._retrieslock:
+            commands = dict(self._retries)
+        return {'commands': commands, 'locks': self.router.lockstatus()}
 
     def makevalue(self, v):
         'makes value respecting decode_responses setting'
@@ -129,13 +287,65 @@ class StrictRedis:
         'gets base path for database files'
         return self._dbpath
 
+    def checkkey(self, method, key, expiry=True):
+        '''
+        performs sanity checks on key, ensures it is compatible with `method`
+        and, unless `expiry` is False, that it has not expired.
+        the type and expiry probes are skipped for keys cached less than
+        KEYCACHE_LIFETIME seconds ago
+        '''
+        if SEP in key:
+            raise ValueError(f'`key` contains invalid character(s): {SEP}')
+        mtype = methodtype(method)
+        cached = self.knownkeys.get(key)
+        if (cached is not None and mtype in (None, cached[0])
+                and time.monotonic() - cached[2] < KEYCACHE_LIFETIME):
+            dtype, hasttl, checked = cached
+            self.cachekey(key, dtype, hasttl, checked)
+        else:
+            dtype, hasttl = self.keydtype(key), True
+            LOG.debug('%s %s %s %s', method, key, dtype, mtype)
+            if mtype is not None and dtype is not None and dtype != mtype:
+                raise ValueError(
+                    f'incompatible operation `{method}` on {dtype}')
+        if not expiry or not hasttl:
+            return
+        status = self.checkexpired(key, enforce=True)
+        if dtype is not None and status is not True:
+            self.cachekey(key, dtype, status == 'scheduled')
+
+    def cachekey(self, key, dtype, hasttl, checked=None):
+        '''
+        records the data type of an existing key and whether it has a ttl in
+        the bounded metadata cache, as read at the monotonic time `checked`,
+        defaults to now. the cache is per instance, changes made by other
+        instances or processes are missed for up to KEYCACHE_LIFETIME seconds
+        '''
+        if not self.keycachesize:
+            return
+        if checked is None:
+            checked = time.monotonic()
+        cache = self.knownkeys
+        cache.pop(key, None)
+        cache[key] = (dtype, hasttl, checked)
+        if len(cache) > self.keycachesize:
+            try:
+                del cache[next(iter(cache))]
+            except (KeyError, RuntimeError, StopIteration):
+                # concurrently evicted
+                pass
+
+    def uncachekey(self, key):
+        'removes a key from the metadata cache'
+        self.knownkeys.pop(key, None)
+
     def keydtype(self, key):
         'get key data type'
-        db = self.router.connection(key).db()
         closestkey = b''
-        for k, _ in db[key:]:
-            closestkey = k
-            break
+        with self.router.pinned(key) as conn:
+            for k, _ in conn.db()[key:]:
+                closestkey = k
+                break
         if closestkey != key.encode('utf-8') and not closestkey.startswith(
                 f'{key}{SEP}'.encode('utf-8')):
             return None
@@ -145,8 +355,8 @@ class StrictRedis:
 
     def checkexpired(self, key, enforce=False):
         'checks if a key expired and removes it if so'
-        db = self.router.connection(key).db()
-        try:
+        with self.router.pinned(key) as conn:
+            db = conn.db()
             exp = self.keystoexpire.get(key)
             if not exp:
                 try:
@@ -160,26 +370,19 @@ class StrictRedis:
                     LOG.debug('expiring %r (%r)', key, type(key))
                     if not enforce:
                         return True
-                    del db[f'{SEP}expire{SEP}{key}'.encode('utf-8')]
-                    for k, _ in db[key:]:
-                        LOG.debug('checking %r, %r, %r', k, key, k == key)
-                        if k == key.encode('utf-8') or k.startswith(
-                                f'{key}{SEP}'.encode('utf-8')):
-                            LOG.debug('delete %r %r', k, f'{SEP}expire{SEP}{k}')
-                            del db[k]
-                        else:
-                            break
-                    if key in self.knownkeys:
-                        del self.knownkeys[key]
+                    _deletekey(db, key)
+                    self.keystoexpire.pop(key, None)
+                    self.uncachekey(key)
+                    self.router.touch(key)
 
                     return True
                 return 'scheduled'
             return False
-        finally:
-            pass
 
-    def reset(self):
-        'clears a database and all cached information'
-        self.router.reset()
+    def reset(self, asynchronous=False):
+        '''
+        clears a database and all cached information, see `Router.reset`
+        '''
+        self.router.reset(asynchronous)
         self.knownkeys = {}
         self.keystoexpire = {}
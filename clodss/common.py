@@ -5,11 +5,191 @@ common utilities
 '''
 
 
+import contextlib
+
+
 SEP = chr(0x2c3)
 
+# methods which operate on the whole database rather than a single key
+GLOBAL_METHODS = ('keys', 'scan', 'flushdb')
+
+# methods which block waiting on keys, the keys are checked by the commands
+# they delegate to
+BLOCKING_METHODS = ('blpop', 'brpop', 'blmove')
+
+
+# methods which do not modify data, they run under a shared lock of their db
+READ_METHODS = (
+    'get', 'llen', 'lindex', 'lrange', 'hget', 'hkeys', 'hvalues', 'hgetall',
+    'hmget', 'hlen', 'hexists', 'hstrlen', 'hscan', 'hscan_iter', 'zscore',
+    'zcard', 'zcount', 'zrange', 'zrevrange', 'zrangebyscore',
+    'zrevrangebyscore', 'zrank', 'zrevrank', 'scard', 'sismember',
+    'smismember', 'smembers', 'sinter', 'sunion', 'sdiff', 'srandmember',
+    'sscan', 'sscan_iter',
+)
+
+# methods which access other keys than their first one, mapped to the number
+# of following arguments which are keys they write, and whether all the
+# remaining arguments are keys they read. the dbs of all these keys are locked
+# before the method runs, see `otherkeys`
+MULTIKEY_METHODS = {
+    'lmove': (1, False), 'smove': (1, False), 'sinter': (0, True),
+    'sunion': (0, True), 'sdiff': (0, True), 'sinterstore': (0, True),
+    'sunionstore': (0, True), 'sdiffstore': (0, True),
+}
+
+# methods which operate on keys of any data type
+GENERIC_METHODS = ('delete', 'expire', 'persist')
+
+# methods of sets, which cannot be told from the ones of strings by their name
+SET_METHODS = (
+    'sadd', 'srem', 'scard', 'sismember', 'smismember', 'smembers', 'smove',
+    'sinter', 'sunion', 'sdiff', 'sinterstore', 'sunionstore', 'sdiffstore',
+    'srandmember', 'spop', 'sscan', 'sscan_iter',
+)
+
+
+def methodtype(name):
+    'gets the data type a method operates on, None if it operates on any'
+    if name in GENERIC_METHODS:
+        return None
+    mtype = name[0].encode('utf-8')
+    if name in ('rpush', 'rpop'):
+        return b'l'
+    if name in SET_METHODS:
+        return b's'
+    if mtype not in (b'l', b'h', b'z'):
+        return ''
+    return mtype
+
+
+def otherkeys(name, args):
+    '''
+    gets the keys other than the first one accessed by the method `name`
+    called with `args`, the first of which is its key, mapped to whether the
+    method writes them. None for methods accessing a single key
+    '''
+    spec = MULTIKEY_METHODS.get(name)
+    if spec is None:
+        return None
+    nwritten, readsrest = spec
+    keys = dict.fromkeys(args[1:1 + nwritten], True)
+    if readsrest:
+        for key in args[1 + nwritten:]:
+            keys.setdefault(key, False)
+    return keys
+
+
+class BusyError(Exception):
+    'raised when a db is locked by another connection, thread or process'
+
+
+def isbusy(exc):
+    'checks whether an exception is caused by a locked db, i.e. is transient'
+    if isinstance(exc, BusyError):
+        return True
+    # lsm raises plain exceptions for LSM_BUSY
+    plain = type(exc) is Exception  # pylint: disable=unidiomatic-typecheck
+    return plain and exc.args == ('Busy',)
+
+
+@contextlib.contextmanager
+def _transaction(db):
+    '''
+    runs the wrapped block in a (nested) transaction of `db`. unlike
+    `db.transaction()`, it leaves `db` usable if the transaction cannot begin
+    because the db is busy
+    '''
+    try:
+        db.begin()
+    except Exception:
+        # lsm-db counts the transaction even if it failed to begin
+        db.rollback(False)
+        raise
+    try:
+        yield
+    except BaseException:
+        db.rollback(False)
+        raise
+    try:
+        db.commit()
+    except Exception:
+        # the transaction is no longer counted at this point
+        db.rollback(True)
+        raise
+
+
+def _expirekey(key):
+    return f'{SEP}expire{SEP}{key}'
+
+
+def _ttlkey(key, expiretime):
+    # entry of the expiry index, ordered by expiry time
+    return f'{SEP}ttl{SEP}{float(expiretime):020.6f}{SEP}{key}'
+
+
+def _setexpire(db, key, expiretime):
+    with _transaction(db):
+        _dropexpire(db, key)
+        db[_expirekey(key)] = expiretime
+        db[_ttlkey(key, expiretime)] = b''
+
+
+def _dropexpire(db, key):
+    try:
+        expiretime = db[_expirekey(key)]
+    except KeyError:
+        return
+    with _transaction(db):
+        del db[_expirekey(key)]
+        del db[_ttlkey(key, expiretime)]
+
+
+def _recordkey(record):
+    'gets the key a record belongs to'
+    sep = SEP.encode('utf-8')
+    if record.startswith(sep):
+        # expiry and expiry index records, the key is the last field
+        return record.rsplit(sep, 1)[1].decode('utf-8')
+    return record.split(sep, 1)[0].decode('utf-8')
+
+
+def _deletekey(db, key):
+    'deletes all records of a key, including its expiry'
+    sep = SEP.encode('utf-8')
+    k = key.encode('utf-8')
+    with _transaction(db):
+        del db[k]
+        db.delete_range(k + sep, k + sep + b'\xff')
+        _dropexpire(db, key)
+
+
+def _getcount(db, key, mtype, default=0):
+    '''
+    gets the number of elements of a key of type `mtype` ('h', 'z' or 's')
+    from its count record, `default` if it has none
+    '''
+    try:
+        return int(db[f'{key}{SEP}{mtype}'])
+    except KeyError:
+        return default
+
+
+def _setcount(db, key, mtype, count):
+    # the record sorts right before the elements, so it does not interfere
+    # with them. it is dropped with the last element
+    if count <= 0:
+        try:
+            del db[f'{key}{SEP}{mtype}']
+        except KeyError:
+            pass
+        return
+    db[f'{key}{SEP}{mtype}'] = str(count)
+
+
 def _clearexpired(instance, db, key):
     if instance.checkexpired(key) in (True, 'scheduled'):
-        del db[f'{SEP}expire{SEP}{key}']
+        _dropexpire(db, key)
         if key in instance.keystoexpire:
             del instance.keystoexpire[key]
 
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+'''
+counters.py: provides the CounterBuffer class which sums increments in memory
+and writes them in batches
+'''
+
+import logging
+import threading
+
+from .common import isbusy
+
+LOG = logging.getLogger('clodss')
+
+
+class CounterBuffer:
+    '''
+    sums counter increments in memory and flushes them every `interval`
+    seconds through a pipeline, i.e. with one transaction per db. stored
+    counters lag behind by up to `interval` seconds, and increments not yet
+    flushed are lost if the process dies. use `close` or the context manager
+    protocol to flush the remaining increments
+    '''
+
+    def __init__(self, instance, interval=1.):
+        self._instance = instance
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        if interval:
+            self._thread = threading.Thread(
+                target=self._run, name='clodss-counters', daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def incr(self, key, amount=1):
+        'adds `amount` to the counter `key`'
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + amount
+
+    def incrby(self, key, amount):
+        'adds `amount` to the counter `key`'
+        self.incr(key, amount)
+
+    def incrbyfloat(self, key, amount):
+        'adds the float `amount` to the counter `key`'
+        self.incr(key, float(amount))
+
+    def decr(self, key, amount=1):
+        'subtracts `amount` from the counter `key`'
+        self.incr(key, -amount)
+
+    def decrby(self, key, amount):
+        'subtracts `amount` from the counter `key`'
+        self.incr(key, -amount)
+
+    def pending(self, key):
+        'gets the sum of the increments of `key` not flushed yet'
+        with self._lock:
+            return self._pending.get(key, 0)
+
+    def _execute(self, group):
+        # writes the increments of `group`, on keys of one db, in a pipeline
+        pipe = self._instance.pipeline()
+        for key, amount in group:
+            if isinstance(amount, float):
+                pipe.incrbyfloat(key, amount)
+            else:
+                pipe.incrby(key, amount)
+        return dict(zip((k for k, _ in group), pipe.execute()))
+
+    def flush(self):
+        '''
+        writes the pending increments, one transaction per db, and returns the
+        new values of the counters. increments failing because their db is
+        busy are kept for the next flush. when another increment fails, the
+        ones of its db are written again one by one, and the failures are
+        raised after all dbs have been written
+        '''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        router = self._instance.router
+        groups = {}
+        for key, amount in pending.items():
+            groups.setdefault(router.shard(key), []).append((key, amount))
+        queue = list(groups.values())
+        results = {}
+        error = None
+        while queue:
+            group = queue.pop()
+            try:
+                results.update(self._execute(group))
+            except Exception as e:  # pylint: disable=broad-except
+                if isbusy(e):
+                    with self._lock:
+                        for key, amount in group:
+                            self._pending[key] = (
+                                self._pending.get(key, 0) + amount)
+                elif len(group) > 1:
+                    # the transaction of the group was rolled back
+                    queue.extend([item] for item in group)
+                else:
+                    error = e
+        if error is not None:
+            raise error
+        return results
+
+    def close(self):
+        'stops the periodic flushes and writes the pending increments'
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception('counter flush failed')
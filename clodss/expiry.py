@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+'''
+expiry.py: provides the ActiveExpiry class which deletes expired keys in the
+background, so that keys which are never accessed again free their space
+'''
+
+import logging
+import threading
+import time
+import weakref
+
+from .common import SEP, _deletekey, _expirekey, _transaction, _ttlkey
+
+LOG = logging.getLogger('clodss')
+
+# expiry records added to the expiry index per db and cycle
+INDEX_BATCH_SIZE = 1000
+
+
+def indexdb(db, start, batchsize):
+    '''
+    adds up to `batchsize` expiry records of `db`, from the record `start`
+    on, to the expiry index. records written before the index was introduced
+    are not in it. returns the record to resume from, None once all are
+    indexed
+    '''
+    prefix = _expirekey('').encode('utf-8')
+    records = []
+    resume = None
+    for k, v in db[start or prefix:prefix + b'\xff']:
+        if len(records) == batchsize:
+            resume = k
+            break
+        records.append((k[len(prefix):].decode('utf-8'), v))
+    with _transaction(db):
+        for key, expiretime in records:
+            db[_ttlkey(key, expiretime)] = b''
+    return resume
+
+
+def expiredb(instance, db, batchsize):
+    '''
+    deletes up to `batchsize` expired keys from `db` following the expiry index.
+    returns the number of keys deleted
+    '''
+    sep = SEP.encode('utf-8')
+    prefix = f'{SEP}ttl{SEP}'.encode('utf-8')
+    now = f'{time.time():020.6f}'.encode('utf-8')
+    deleted = 0
+    with _transaction(db):
+        entries = []
+        for k, _ in db[prefix:prefix + now + b'\xff']:
+            if not k.startswith(prefix):
+                break
+            entries.append(k)
+            if len(entries) == batchsize:
+                break
+        for k in entries:
+            expiretime, key = k[len(prefix):].split(sep, 1)
+            key = key.decode('utf-8')
+            try:
+                current = f'{float(db[_expirekey(key)]):020.6f}'
+            except KeyError:
+                current = None
+            if current == expiretime.decode('utf-8'):
+                _deletekey(db, key)
+                instance.keystoexpire.pop(key, None)
+                instance.uncachekey(key)
+                instance.router.touch(key)
+                deleted += 1
+            else:
+                # stale entry, the expiry has been changed since
+                del db[k]
+    return deleted
+
+
+class ActiveExpiry:
+    '''
+    background thread which runs an expire cycle every `interval` seconds,
+    similar to the active expire cycle of redis. every cycle visits the dbs
+    in turn, deletes up to `batchsize` expired keys per db and stops when it
+    used a quarter of `interval`, the next cycle resumes where it stopped.
+    the first cycles visiting a db add its expiry records to the expiry
+    index, up to INDEX_BATCH_SIZE per cycle
+    '''
+
+    def __init__(self, instance, interval=.1, batchsize=20):
+        self._instance = weakref.ref(instance)
+        self.interval = interval
+        self.batchsize = batchsize
+        self._offset = 0
+        # record of every db the indexing resumes from, None once done
+        self._indexing = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='clodss-expiry', daemon=True)
+
+    def start(self):
+        'starts the background thread'
+        self._thread.start()
+
+    def stop(self):
+        'stops the background thread'
+        self._stopped.set()
+
+    def cycle(self):
+        'runs an expire cycle, returns the number of keys deleted'
+        instance = self._instance()
+        if instance is None:
+            self.stop()
+            return 0
+        deadline = time.perf_counter() + self.interval / 4
+        dbnames = instance.router.dbnames()
+        deleted = 0
+        for i in range(len(dbnames)):
+            name = dbnames[(self._offset + i) % len(dbnames)]
+            with instance.router.checkout(name) as conn, \
+                    instance.router.locked(name):
+                if self._indexing.get(name, b'') is not None:
+                    self._indexing[name] = indexdb(
+                        conn.db(), self._indexing.get(name), INDEX_BATCH_SIZE)
+                deleted += expiredb(instance, conn.db(), self.batchsize)
+            if time.perf_counter() > deadline:
+                self._offset = (self._offset + i + 1) % len(dbnames)
+                break
+        return deleted
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.cycle()
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception('active expire cycle failed')
@@ -4,20 +4,72 @@
 clodss: hashmap data-structure
 '''
 
-from .common import SEP
+import lsm
+
+from .common import SEP, _getcount, _setcount
+from .keys import _scanprefix
+
+# fields of hmget reached by stepping the cursor rather than seeking
+DENSE_STEPS = 8
+
+# fields read per batch by the streaming variants of the commands
+STREAM_BATCH = 1000
+
 
 def _augkey(hkey, key):
     return f'{hkey}{SEP}h{SEP}{key}'
 
 
+def _length(db, hkey):
+    '''
+    gets the number of fields of a hash from its metadata record, 0 if the
+    hash does not exist
+    '''
+    length = _getcount(db, hkey, 'h', None)
+    if length is not None:
+        return length
+    # hashes created before the metadata record was introduced
+    prefix = _augkey(hkey, '').encode('utf-8')
+    n = 0
+    for k, _ in db[prefix:]:
+        if not k.startswith(prefix):
+            break
+        n += 1
+    return n
+
+
 def _db(instance, hkey):
     return instance.router.connection(hkey).db()
 
 
-def hset(instance, hkey, key, val):
-    'https://redis.io/commands/hset'
+def hset(instance, hkey, key=None, val=None, mapping=None):
+    '''
+    https://redis.io/commands/hset
+    all fields are written at once, within the transaction of the command.
+    returns the number of fields added
+    '''
+    items = dict(mapping or {})
+    if key is not None:
+        items[key] = val
+    if not items:
+        raise ValueError('no fields to set')
+    db = _db(instance, hkey)
+    records = {_augkey(hkey, k).encode('utf-8'): v for k, v in items.items()}
+    added = len(records) - len(_hmget(db, sorted(records)))
+    if added:
+        _setcount(db, hkey, 'h', _length(db, hkey) + added)
+    db.update(records)
+    return added
+
+
+def hsetnx(instance, hkey, key, val):
+    'https://redis.io/commands/hsetnx'
     db = _db(instance, hkey)
-    db[_augkey(hkey, key)] = val
+    k = _augkey(hkey, key)
+    if k in db:
+        return 0
+    _setcount(db, hkey, 'h', _length(db, hkey) + 1)
+    db[k] = val
     return 1
 
 
@@ -30,18 +82,77 @@ def hget(instance, hkey, key):
         return None
 
 
-def hdel(instance, hkey, key):
+def hdel(instance, hkey, *keys):
     'https://redis.io/commands/hdel'
     db = _db(instance, hkey)
-    key = _augkey(hkey, key)
-    if not key in db:
+    records = {_augkey(hkey, k).encode('utf-8') for k in keys}
+    found = _hmget(db, sorted(records))
+    if not found:
         return 0
-    del db[key]
-    return 1
+    _setcount(db, hkey, 'h', _length(db, hkey) - len(found))
+    for k in found:
+        del db[k]
+    return len(found)
+
+
+def hlen(instance, hkey):
+    'https://redis.io/commands/hlen'
+    return _length(_db(instance, hkey), hkey)
+
+
+def hexists(instance, hkey, key):
+    'https://redis.io/commands/hexists'
+    return _augkey(hkey, key) in _db(instance, hkey)
+
+
+def hstrlen(instance, hkey, key):
+    'https://redis.io/commands/hstrlen'
+    try:
+        return len(_db(instance, hkey)[_augkey(hkey, key)])
+    except KeyError:
+        return 0
+
+
+def _hincrby(instance, hkey, key, amount, numtype):
+    db = _db(instance, hkey)
+    k = _augkey(hkey, key)
+    try:
+        val = db[k]
+    except KeyError:
+        val = 0
+        _setcount(db, hkey, 'h', _length(db, hkey) + 1)
+    try:
+        val = numtype(val)
+    except ValueError as e:
+        raise TypeError(f'invalid numeric {val}') from e
+    newval = val + amount
+    if numtype is float:
+        # shortest representation, without a trailing `.0` like redis
+        val = repr(newval)
+        db[k] = val[:-2] if val.endswith('.0') else val
+    else:
+        db[k] = newval
+    return newval
+
+
+def hincrby(instance, hkey, key, amount=1):
+    'https://redis.io/commands/hincrby'
+    return _hincrby(instance, hkey, key, int(amount), int)
+
 
+def hincrbyfloat(instance, hkey, key, amount=1.):
+    'https://redis.io/commands/hincrbyfloat'
+    return _hincrby(instance, hkey, key, float(amount), float)
 
-def hkeys(instance, hkey):
-    'https://redis.io/commands/hkeys'
+
+def hkeys(instance, hkey, stream=False):
+    '''
+    https://redis.io/commands/hkeys
+    returns a generator reading the hash by batches if `stream`, see
+    `hscan_iter`
+    '''
+    if stream:
+        return (k for k, _ in _stream(instance, hkey, None, STREAM_BATCH))
     db = _db(instance, hkey)
     keys = []
     prefix = _augkey(hkey, '').encode('utf-8')
@@ -51,8 +162,14 @@ def hkeys(instance, hkey):
         keys.append(instance.makevalue(k[len(prefix):]))
     return keys
 
-def hvalues(instance, hkey):
-    'https://redis.io/commands/hkeys'
+def hvalues(instance, hkey, stream=False):
+    '''
+    https://redis.io/commands/hvals
+    returns a generator reading the hash by batches if `stream`, see
+    `hscan_iter`
+    '''
+    if stream:
+        return (v for _, v in _stream(instance, hkey, None, STREAM_BATCH))
     db = _db(instance, hkey)
     vals = []
     prefix = _augkey(hkey, '').encode('utf-8')
@@ -62,8 +179,14 @@ def hvalues(instance, hkey):
         vals.append(instance.makevalue(v))
     return vals
 
-def hgetall(instance, hkey):
-    'https://redis.io/commands/hgetall'
+def hgetall(instance, hkey, stream=False):
+    '''
+    https://redis.io/commands/hgetall
+    returns a generator of (field, value) tuples reading the hash by batches
+    if `stream`, see `hscan_iter`
+    '''
+    if stream:
+        return _stream(instance, hkey, None, STREAM_BATCH)
     db = _db(instance, hkey)
     items = {}
     prefix = _augkey(hkey, '').encode('utf-8')
@@ -76,10 +199,80 @@ def hgetall(instance, hkey):
 
 def hmset(instance, hkey, mapping):
     'https://redis.io/commands/hmset'
-    for k, v in mapping.items():
-        hset(instance, hkey, k, v)
+    hset(instance, hkey, mapping=mapping)
+    return True
+
+
+def _hmget(db, targets):
+    # gets the records of the sorted keys `targets` in a single cursor pass,
+    # stepping to the next records when they are close and seeking otherwise
+    found = {}
+    with db.cursor() as cursor:
+        current = None
+        for target in targets:
+            steps = 0
+            while current is not None and current < target \
+                    and steps < DENSE_STEPS:
+                try:
+                    cursor.next()
+                except StopIteration:
+                    return found
+                current = cursor.key()
+                steps += 1
+            if current is None or current < target:
+                try:
+                    cursor.seek(target, lsm.SEEK_GE)
+                except KeyError:
+                    return found
+                current = cursor.key()
+            if current == target:
+                found[target] = cursor.value()
+    return found
 
 
 def hmget(instance, hkey, *keys):
-    'https://redis.io/commands/hmget'
-    return [hget(instance, hkey, k) for k in keys]
+    '''
+    https://redis.io/commands/hmget
+    the fields are read in one pass over the hash. `keys` may also be given as
+    a single list
+    '''
+    if len(keys) == 1 and isinstance(keys[0], (list, tuple)):
+        keys = keys[0]
+    db = _db(instance, hkey)
+    records = [_augkey(hkey, k).encode('utf-8') for k in keys]
+    found = _hmget(db, sorted(set(records)))
+    return [instance.makevalue(found[k]) if k in found else None
+            for k in records]
+
+
+def hscan(instance, hkey, cursor=0, match=None, count=10):
+    '''
+    https://redis.io/commands/hscan
+    the cursor encodes the last field visited, so a scan can be resumed at any
+    time with a seek. `count` bounds the number of fields visited by a call,
+    the iteration is complete when the returned cursor is 0
+    '''
+    prefix = _augkey(hkey, '').encode('utf-8')
+    cursor, records = _scanprefix(
+        _db(instance, hkey), prefix, cursor, match, count)
+    return cursor, {instance.makevalue(k): instance.makevalue(v)
+                    for k, v in records}
+
+
+def _stream(instance, hkey, match, count):
+    # every batch is a separate command, the hash is never held in memory
+    cursor = 0
+    while True:
+        cursor, items = instance.hscan(hkey, cursor, match, count)
+        yield from items.items()
+        if cursor == 0:
+            return
+
+
+def hscan_iter(instance, hkey, match=None, count=STREAM_BATCH):
+    '''
+    generator of the (field, value) tuples of a hash matching `match`, read
+    by batches of `count` fields with `hscan`. fields changed meanwhile may
+    be missed or seen twice, like with hscan
+    '''
+    return _stream(instance, hkey, match, count)
@@ -4,10 +4,15 @@
 clodss: keys-related functions
 '''
 
+import bisect
+import heapq
 import re
 import time
 
-from .common import SEP, _clearexpired
+import lsm
+
+from .common import SEP, _clearexpired, _deletekey, _setexpire
+from .common import _transaction
 
 
 def _keyexists(db, key):
@@ -32,17 +37,19 @@ def sēt(instance, key, value):
     'https://redis.io/commands/set'
     db = instance.router.connection(key).db()
     db[key] = value
+    cached = instance.knownkeys.get(key)
+    if cached is None:
+        instance.cachekey(key, '', False)
+    else:
+        instance.cachekey(key, '', cached[1], cached[2])
 
 
 def delete(instance, key):
     'https://redis.io/commands/del'
     db = instance.router.connection(key).db()
-    for k, _ in db[key:]:
-        if k == key.encode('utf-8') or k.startswith(
-                f'{key}{SEP}'.encode('utf-8')):
-            del db[k]
-        else:
-            break
+    _deletekey(db, key)
+    instance.keystoexpire.pop(key, None)
+    instance.uncachekey(key)
 
 
 def expire(instance, key, duration: float) -> int:
@@ -52,8 +59,9 @@ def expire(instance, key, duration: float) -> int:
         print('key doesnt exist', key)
         return 0
     expiretime = duration + time.time()
-    db[f'{SEP}expire{SEP}{key}'] = expiretime
+    _setexpire(db, key, expiretime)
     instance.keystoexpire[key] = expiretime
+    instance.uncachekey(key)
     return 1
 
 
@@ -65,44 +73,50 @@ def persist(instance, key) -> int:
     if instance.checkexpired(key) != 'scheduled':
         return 0
     _clearexpired(instance, db, key)
+    instance.uncachekey(key)
     return 1
 
 
-def incr(instance, key, amount=1):
-    'https://redis.io/commands/incr'
+def _incrby(instance, key, amount, numtype):
     db = instance.router.connection(key).db()
-    try:
-        val = db[key]
-    except KeyError:
-        val = 0
-    try:
-        val = int(val)
-    except ValueError as e:
-        raise TypeError('invalid numeric %s' %val) from e
-    newval = val + amount
-    db[key] = newval
+    # the read and the write are atomic, also across processes
+    with _transaction(db):
+        try:
+            val = db[key]
+        except KeyError:
+            val = 0
+        try:
+            val = numtype(val)
+        except ValueError as e:
+            raise TypeError('invalid numeric %s' %val) from e
+        newval = val + amount
+        if numtype is float:
+            # shortest representation, without a trailing `.0` like redis
+            val = repr(newval)
+            db[key] = val[:-2] if val.endswith('.0') else val
+        else:
+            db[key] = newval
     return newval
 
 
+def incr(instance, key, amount=1):
+    'https://redis.io/commands/incr'
+    return _incrby(instance, key, int(amount), int)
+
+
 def incrby(instance, key, amount):
     'https://redis.io/commands/incrby'
     return incr(instance, key, amount)
 
 
+def incrbyfloat(instance, key, amount):
+    'https://redis.io/commands/incrbyfloat'
+    return _incrby(instance, key, float(amount), float)
+
+
 def decr(instance, key, amount=1):
     'https://redis.io/commands/decr'
-    db = instance.router.connection(key).db()
-    try:
-        val = db[key]
-    except KeyError:
-        val = 0
-    try:
-        val = int(val)
-    except ValueError as e:
-        raise TypeError('invalid numeric %s' %val) from e
-    newval = int(val) - amount
-    db[key] = newval
-    return newval
+    return _incrby(instance, key, -int(amount), int)
 
 
 def decrby(instance, key, amount):
@@ -110,49 +124,218 @@ def decrby(instance, key, amount):
     return decr(instance, key, amount)
 
 
-def flushdb(instance):
-    'https://redis.io/commands/flushdb'
-    instance.reset()
+def flushdb(instance, asynchronous=False):
+    '''
+    https://redis.io/commands/flushdb
+    the data is gone once this returns, `asynchronous` only leaves deleting
+    the files to a background thread
+    '''
+    instance.reset(asynchronous)
 
 
-def keys(instance, pattern='*', checkexpired=True):
+def _plan(pattern):
     '''
-    https://redis.io/commands/keys
-    generator function, non standard parameter `checkexpired` allows disabling
-    expiry check, which improves performance but will return keys which should
-    be expired
+    plans a scan for a glob-style pattern, returns the literal prefix which all
+    matching keys share, which allows seeking, and a regex matching the keys
+    '''
+    prefix = re.match(r'[^*?[\\]*', pattern).group(0)
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            regex.append('.*')
+        elif c == '?':
+            regex.append('.')
+        elif c == '\\' and i < len(pattern):
+            regex.append(re.escape(pattern[i]))
+            i += 1
+        elif c == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            chars = pattern[i:end]
+            if chars[0] == '!':
+                chars = '^' + chars[1:]
+            regex.append(f'[{chars}]')
+            i = end + 1
+        else:
+            regex.append(re.escape(c))
+    return prefix.encode('utf-8'), re.compile(''.join(regex), re.DOTALL)
+
+
+def _scanprefix(db, prefix, cursor, match, count):
+    '''
+    scans the records starting with `prefix`, e.g. the fields of a hash, for
+    hscan-like commands. the cursor encodes the last record visited, records
+    are matched by the rest of their key. returns the next cursor and the
+    (rest of the key, value) tuples visited
+    '''
+    start = b''
+    if cursor != 0:
+        try:
+            raw = cursor.to_bytes((cursor.bit_length() + 7) // 8, 'big')
+        except (AttributeError, OverflowError) as e:
+            raise ValueError(f'invalid cursor {cursor!r}') from e
+        if raw[:1] != b'\x01':
+            raise ValueError(f'invalid cursor {cursor!r}')
+        start = raw[1:]
+    subprefix, regex = _plan(match or '*')
+    records = []
+    budget = max(count, 1)
+    for k, v in db[prefix + max(subprefix, start):]:
+        if not k.startswith(prefix + subprefix):
+            break
+        rest = k[len(prefix):]
+        if regex.fullmatch(rest.decode('utf-8')):
+            records.append((rest, v))
+        budget -= 1
+        if budget == 0:
+            # the leading byte preserves leading null bytes of the key
+            return int.from_bytes(b'\x01' + rest + b'\0', 'big'), records
+    return 0, records
+
+
+def _iterkeys(db, prefix=b'', start=b''):
+    '''
+    generator of the keys in `db` starting with `prefix`, beginning at record
+    `start`. yields tuples (key, position of the next record to visit).
+    records of compound keys (lists, hashes) are skipped with a single seek
+    past them rather than visited, so are internal records (e.g. expiry)
     '''
-    pattern = pattern.replace('*', '.*')
-    regex = re.compile(pattern)
     sep = SEP.encode('utf-8')
-    yielded_compounds = set()
-    for db in instance.router.allconnections():
-        for k, _ in db.db():
-            if checkexpired and instance.checkexpired(
-                k.decode('utf-8'), enforce=True) is True:
+    with db.cursor() as cursor:
+        target = max(prefix, start)
+        while True:
+            if target is not None:
+                try:
+                    cursor.seek(target, lsm.SEEK_GE)
+                except KeyError:
+                    return
+            k = cursor.key()
+            if not k.startswith(prefix):
+                return
+            if k.startswith(sep):
+                target = sep + b'\xff'
                 continue
-            compound = sep in k
-            k = k.split(sep)[0]
-            if not k:
+            if sep in k:
+                k = k.split(sep)[0]
+                target = k + sep + b'\xff'
+                yield k, target
                 continue
-            if compound:
-                if k in yielded_compounds:
+            # plain keys are followed by the next record, no need to seek
+            yield k, k + b'\0'
+            try:
+                cursor.next()
+            except StopIteration:
+                return
+            target = None
+
+
+def _shardkeys(conn, prefix, regex, checkexpired, layout=None):
+    '''
+    lists the keys of a single db which match a planned pattern, returns a
+    tuple of the sorted live keys and the expired keys found. keys which
+    `layout` routes to other dbs, i.e. partially resharded, are skipped
+    '''
+    db = conn.db()
+    now = time.time()
+    live, expired = [], []
+    for k, _ in _iterkeys(db, prefix):
+        key = k.decode('utf-8')
+        if not regex.fullmatch(key):
+            continue
+        if layout is not None and layout.shard(key) != conn.name:
+            continue
+        if checkexpired:
+            try:
+                if now > float(db[f'{SEP}expire{SEP}{key}']):
+                    expired.append(key)
                     continue
-                yielded_compounds.add(k)
-            if regex.match(k.decode('utf-8')):
-                yield instance.makevalue(k)
+            except KeyError:
+                pass
+        live.append(k)
+    live.sort()
+    return live, expired
 
 
-def scan(instance, cursor=None, match='*'):
+def keys(instance, pattern='*', checkexpired=True, ordered=False):
     '''
-    https://redis.io/commands/scan
-    currently is the same as `keys`
+    https://redis.io/commands/keys
+    generator function, non standard parameter `checkexpired` allows disabling
+    expiry check, which improves performance but will return keys which should
+    be expired. dbs are scanned by the workers configured on the router, keys
+    are yielded per db as scans complete, or sorted if `ordered`
     '''
+    prefix, regex = _plan(pattern)
+    layout = instance.router.layout
+    if layout.target is None:
+        layout = None
+    results = []
+    for live, expired in instance.router.mapshards(
+            _shardkeys, prefix, regex, checkexpired, layout):
+        for key in expired:
+            instance.checkexpired(key, enforce=True)
+        if ordered:
+            results.append(live)
+        else:
+            yield from map(instance.makevalue, live)
+    yield from map(instance.makevalue, heapq.merge(*results))
+
 
-    if cursor not in (None, True):
-        raise ValueError('invalid cursor %r' %cursor)
+def _encodecursor(dbname, lastkey):
+    # the leading byte holds the length of the db name, which preserves
+    # leading zeros of the db index
+    dbindex = int(dbname, 16).to_bytes(4, 'big')
+    lead = bytes([0x10 + len(dbname)])
+    return int.from_bytes(lead + dbindex + lastkey, 'big')
 
-    if cursor is True:
-        return []
 
-    return True, keys(instance, match)
+def _decodecursor(cursor):
+    try:
+        raw = cursor.to_bytes((cursor.bit_length() + 7) // 8, 'big')
+    except (AttributeError, OverflowError) as e:
+        raise ValueError(f'invalid cursor {cursor!r}') from e
+    if len(raw) < 5 or not 0x10 < raw[0] <= 0x18:
+        raise ValueError(f'invalid cursor {cursor!r}')
+    factor = raw[0] - 0x10
+    dbindex = int.from_bytes(raw[1:5], 'big')
+    return f'{dbindex:0{factor}x}', raw[5:]
+
+
+def scan(instance, cursor=0, match='*', count=10):
+    '''
+    https://redis.io/commands/scan
+    the cursor encodes the db and the position of the next record to visit,
+    so a scan can be resumed at any time. `count` bounds the number of keys
+    visited by a call, the iteration is complete when the returned cursor is 0
+    '''
+    router = instance.router
+    dbname, start = '', b''
+    if cursor != 0:
+        dbname, start = _decodecursor(cursor)
+    prefix, regex = _plan(match)
+    dbnames = router.dbnames()
+    layout = router.layout
+    factor = min(layout.factor, layout.target or layout.factor)
+    if dbname and dbname not in dbnames and len(dbname) > factor:
+        # the db was merged while resharding, rescan the merged db
+        dbname = dbname[:factor]
+    offset = bisect.bisect_left(dbnames, dbname)
+
+    result = []
+    budget = max(count, 1)
+    for conn in router.allconnections(offset):
+        if conn.name != dbname:
+            start = b''
+        for k, position in _iterkeys(conn.db(), prefix, start):
+            budget -= 1
+            key = k.decode('utf-8')
+            if layout.target is not None and layout.shard(key) != conn.name:
+                # partially resharded
+                pass
+            elif regex.fullmatch(key) and instance.checkexpired(
+                    key, enforce=True) is not True:
+                result.append(instance.makevalue(k))
+            if budget == 0:
+                return _encodecursor(conn.name, position), result
+    return 0, result
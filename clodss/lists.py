@@ -4,7 +4,7 @@
 clodss: list data-structure
 '''
 
-from .common import SEP
+from .common import SEP, _transaction
 
 MAX_DIGITS = 12
 
@@ -16,93 +16,244 @@ def _augkey(lkey):
     return f'{lkey}{SEP}l{SEP}'
 
 
-def _maxkey(lkey, db, asint=True):
+def _metakey(lkey):
+    # sorts right before the list items, so it does not interfere with them
+    return f'{lkey}{SEP}l'
+
+
+def _itemkey(lkey, index):
+    indexstr = f'%0{MAX_DIGITS}d' % index
+    if index < 0 or len(indexstr) > MAX_DIGITS:
+        # TO DO: cleanup to use deleted indices
+        raise Exception('list is too big')
+    return _augkey(lkey).encode('utf-8') + indexstr.encode('utf-8')
+
+
+def _meta(lkey, db):
+    '''
+    gets the metadata record of a list as a tuple (length, head, tail) where
+    head and tail are the indices of the first and last items, or None if the
+    list does not exist
+    '''
+    try:
+        length, head, tail = db[_metakey(lkey)].split()
+        return int(length), int(head), int(tail)
+    except KeyError:
+        pass
+    # lists created before the metadata record was introduced
     prefix = _augkey(lkey).encode('utf-8')
-    maxkey = None
-    for k, _ in db[prefix::True]:
-        maxkey = k
-        break
-    if maxkey is None or not maxkey.startswith(prefix):
+    n, head, tail = 0, None, None
+    for k, _ in db[prefix:]:
+        if not k.startswith(prefix):
+            break
+        tail = int(k[len(prefix):])
+        if head is None:
+            head = tail
+        n += 1
+    if n == 0:
         return None
-    return maxkey if not asint else int(maxkey[len(prefix):])
+    return n, head, tail
 
 
-def _minkey(lkey, db, asint=True):
+def _setmeta(lkey, db, length, head, tail):
+    if length <= 0:
+        try:
+            del db[_metakey(lkey)]
+        except KeyError:
+            pass
+        return
+    db[_metakey(lkey)] = f'{length} {head} {tail}'
+
+
+def _neighbour(lkey, db, index, reverse):
+    '''
+    gets the index of the closest item after `index`, or before it if `reverse`
+    '''
     prefix = _augkey(lkey).encode('utf-8')
-    minkey = None
-    for k, _ in db[prefix:]:
-        minkey = k
-        break
-    if minkey is None or not minkey.startswith(prefix):
+    if reverse:
+        if index <= 0:
+            return None
+        iterable = db[prefix:_itemkey(lkey, index - 1):True]
+    else:
+        if index + 1 >= 10 ** MAX_DIGITS:
+            return None
+        iterable = db[_itemkey(lkey, index + 1):prefix + b'\xff']
+    for k, _ in iterable:
+        return int(k[len(prefix):])
+    return None
+
+
+def _maxkey(lkey, db, asint=True):
+    meta = _meta(lkey, db)
+    if meta is None:
+        return None
+    return meta[2] if asint else _itemkey(lkey, meta[2])
+
+
+def _minkey(lkey, db, asint=True):
+    meta = _meta(lkey, db)
+    if meta is None:
         return None
-    return minkey if not asint else int(minkey[len(prefix):])
+    return meta[1] if asint else _itemkey(lkey, meta[1])
 
 
 def llen(instance, key) -> int:
     'https://redis.io/commands/llen'
     db = instance.router.connection(key).db()
-    prefix = _augkey(key).encode('utf-8')
-    n = 0
-    for k, _ in db[prefix:]:
-        if not k.startswith(prefix):
-            break
-        n += 1
-    return n
+    meta = _meta(key, db)
+    return 0 if meta is None else meta[0]
 
 
-def rpush(instance, key, val):
+def rpush(instance, key, *values) -> int:
     'https://redis.io/commands/rpush'
+    if not values:
+        raise TypeError('too few parameters, at least one value is required')
     db = instance.router.connection(key).db()
-    prefix = _augkey(key).encode('utf-8')
-    maxkey = _maxkey(key, db)
-    index = MIDDLE_INDEX if maxkey is None else maxkey
-    indexstr = f'%0{MAX_DIGITS}d' % (index + 1)
-    if len(indexstr) > MAX_DIGITS:
-        # TO DO: cleanup to use deleted indices
-        raise Exception('list is too big')
-    db[prefix + indexstr.encode('utf-8')] = val
-
-
-def lpush(instance, key, val):
+    with _transaction(db):
+        meta = _meta(key, db)
+        length, head, tail = meta or (0, MIDDLE_INDEX + 1, MIDDLE_INDEX)
+        db.update({_itemkey(key, tail + i): v
+                   for i, v in enumerate(values, 1)})
+        tail += len(values)
+        _setmeta(key, db, length + len(values), head, tail)
+    instance.notifier.notify(key, db)
+    return length + len(values)
+
+
+def lpush(instance, key, *values) -> int:
     'https://redis.io/commands/lpush'
+    if not values:
+        raise TypeError('too few parameters, at least one value is required')
+    db = instance.router.connection(key).db()
+    with _transaction(db):
+        meta = _meta(key, db)
+        length, head, tail = meta or (0, MIDDLE_INDEX, MIDDLE_INDEX - 1)
+        db.update({_itemkey(key, head - i): v
+                   for i, v in enumerate(values, 1)})
+        head -= len(values)
+        _setmeta(key, db, length + len(values), head, tail)
+    instance.notifier.notify(key, db)
+    return length + len(values)
+
+
+def _pop(instance, key, count, reverse):
+    if count is not None and count < 0:
+        raise ValueError('`count` must be positive')
     db = instance.router.connection(key).db()
     prefix = _augkey(key).encode('utf-8')
-    minkey = _minkey(key, db)
-    index = MIDDLE_INDEX if minkey is None else minkey
-    index = index - 1
-    if index < 0:
-        # TO DO: cleanup to use deleted indices
-        raise Exception('list is too big')
-    indexstr = f'%0{MAX_DIGITS}d' % (index)
-    db[prefix + indexstr.encode('utf-8')] = val
+    n = 1 if count is None else count
+    with _transaction(db):
+        meta = _meta(key, db)
+        if meta is None:
+            return None
+        length, head, tail = meta
+        if reverse:
+            iterable = db[:prefix + b'\xff':True]
+        else:
+            iterable = db[prefix:prefix + b'\xff']
+        # the first item which is kept becomes the new head or tail
+        items, boundary = [], None
+        for k, v in iterable:
+            if not k.startswith(prefix):
+                break
+            if len(items) == n:
+                boundary = int(k[len(prefix):])
+                break
+            items.append((k, v))
+        if items:
+            lower = _metakey(key)
+            if reverse and boundary is not None:
+                lower = _itemkey(key, boundary)
+            db.delete_range(lower, max(k for k, _ in items) + b'\0')
+            if reverse:
+                tail = boundary
+            else:
+                head = boundary
+            _setmeta(key, db, length - len(items), head, tail)
+    values = [instance.makevalue(v) for _, v in items]
+    if count is None:
+        return values[0]
+    return values
+
+
+def rpop(instance, key, count: int = None):
+    '''
+    https://redis.io/commands/rpop
+    pops and returns a list of up to `count` items if `count` is given
+    '''
+    return _pop(instance, key, count, True)
+
+
+def lpop(instance, key, count: int = None):
+    '''
+    https://redis.io/commands/lpop
+    pops and returns a list of up to `count` items if `count` is given
+    '''
+    return _pop(instance, key, count, False)
+
+
+def lmove(instance, key, destination, src='LEFT', dest='RIGHT'):
+    'https://redis.io/commands/lmove'
+    instance.checkkey('lmove', destination)
+    db = instance.router.connection(key).db()
+    with _transaction(db):
+        value = _pop(instance, key, None, src.upper() == 'RIGHT')
+        if value is None:
+            return None
+        if dest.upper() == 'LEFT':
+            instance.lpush(destination, value)
+        else:
+            instance.rpush(destination, value)
+    return value
 
 
-def rpop(instance, key):
-    'https://redis.io/commands/rpop'
-    db = instance.router.connection(key).db()
-    maxkey = _maxkey(key, db, False)
-    if maxkey is None:
+def _bpop(instance, keys, timeout, reverse):
+    if isinstance(keys, str):
+        keys = [keys]
+    pop = instance.rpop if reverse else instance.lpop
+
+    def attempt():
+        for key in keys:
+            value = pop(key)
+            if value is not None:
+                return instance.makevalue(key.encode('utf-8')), value
         return None
-    v = db[maxkey]
-    del db[maxkey]
-    return instance.makevalue(v)
+    return instance.notifier.wait(keys, timeout, attempt)
 
 
-def lpop(instance, key):
-    'https://redis.io/commands/lpop'
-    db = instance.router.connection(key).db()
-    minkey = _minkey(key, db, False)
-    if minkey is None:
-        return None
-    v = db[minkey]
-    del db[minkey]
-    return instance.makevalue(v)
+def blpop(instance, keys, timeout: float = 0):
+    '''
+    https://redis.io/commands/blpop
+    `timeout` is in seconds, 0 blocks indefinitely
+    '''
+    return _bpop(instance, keys, timeout, False)
+
 
+def brpop(instance, keys, timeout: float = 0):
+    '''
+    https://redis.io/commands/brpop
+    `timeout` is in seconds, 0 blocks indefinitely
+    '''
+    return _bpop(instance, keys, timeout, True)
 
-def _normalizeindex(index, lkey, instance):
+
+def blmove(  # pylint: disable=too-many-positional-arguments
+        instance, key, destination, timeout: float = 0, src='LEFT',
+        dest='RIGHT'):
+    '''
+    https://redis.io/commands/blmove
+    `timeout` is in seconds, 0 blocks indefinitely
+    '''
+    return instance.notifier.wait(
+        [key], timeout,
+        lambda: instance.lmove(key, destination, src, dest))
+
+
+def _normalizeindex(index, lkey, instance, l=None):
     if index >= 0:
         return index
-    l = llen(instance, lkey)
+    if l is None:
+        l = llen(instance, lkey)
     if l == 0:
         return 0
     return (index + (-index // l + 1) * l) % l
@@ -110,18 +261,77 @@ def _normalizeindex(index, lkey, instance):
 
 def _lindex(lkey, index: int, instance):
     db = instance.router.connection(lkey).db()
+    meta = _meta(lkey, db)
+    if meta is None:
+        return None
+    length, head, tail = meta
+    index = _normalizeindex(index, lkey, instance, length)
+    if index >= length:
+        return None
+    if tail - head + 1 == length:
+        # no holes, items are addressable directly
+        return _itemkey(lkey, head + index)
+
+    instance.schedule(_compact, instance, lkey)
     prefix = _augkey(lkey).encode('utf-8')
-    index = _normalizeindex(index, lkey, instance)
-    i = 0
-    key = None
-    for k, _ in db[prefix:]:
+    if index < length // 2:
+        iterable, steps = db[prefix:prefix + b'\xff'], index
+    else:
+        iterable, steps = db[:prefix + b'\xff':True], length - 1 - index
+    for i, (k, _) in enumerate(iterable):
         if not k.startswith(prefix):
             break
-        if i == index:
-            key = k
-            break
-        i += 1
-    return key
+        if i == steps:
+            return k
+    return None
+
+
+def _compact(instance, lkey, chunksize=1024):
+    '''
+    moves the items of a list which has holes (e.g. after `lrem`) next to
+    each other, so that they become directly addressable again.
+    every chunk is moved in its own transaction under its own lock and keeps
+    the list valid, the metadata is read again before every chunk
+    '''
+    prefix = _augkey(lkey).encode('utf-8')
+    router = instance.router
+    target = None
+    done = False
+    while not done:
+        with router.keyed(lkey) as conn:
+            db = conn.db()
+            with _transaction(db):
+                meta = _meta(lkey, db)
+                if meta is None or meta[2] - meta[1] + 1 == meta[0]:
+                    return
+                length, head, tail = meta
+                if target is None or head > target:
+                    # first chunk, or the compacted items were popped
+                    target = head
+                lastkey = _itemkey(lkey, target)
+                items = []
+                for k, v in db[lastkey:prefix + b'\xff']:
+                    if k != lastkey:
+                        items.append((k, v))
+                    if len(items) == chunksize:
+                        break
+                for k, v in items:
+                    target += 1
+                    lastkey = _itemkey(lkey, target)
+                    if k != lastkey:
+                        db[lastkey] = v
+                        del db[k]
+                # the tail item is moved by the last chunk, which updates the
+                # metadata in the same transaction
+                done = len(items) < chunksize or \
+                    items[-1][0] == _itemkey(lkey, tail)
+                if done and target - head + 1 == length:
+                    _setmeta(lkey, db, length, head, target)
+                elif done:
+                    # items compacted by earlier chunks were removed
+                    target = None
+                    done = False
+            router.touch(lkey)
 
 
 def lindex(instance, key, index: int):
@@ -157,37 +367,50 @@ def lrange(instance, key, start: int, end: int):
 def ltrim(instance, key, start: int, end: int) -> None:
     'https://redis.io/commands/ltrim'
     db = instance.router.connection(key).db()
-    prefix = _augkey(key).encode('utf-8')
-    start = _normalizeindex(start, key, instance)
-    end = _normalizeindex(end, key, instance)
-    if start > end:
-        instance.delete(key)
-        return
-    i = 0
-    for k, _ in db[prefix:]:
-        if not k.startswith(prefix):
-            break
-        if not start <= i <= end:
-            del db[k]
-        i += 1
+    with _transaction(db):
+        length = llen(instance, key)
+        start = _normalizeindex(start, key, instance)
+        end = min(_normalizeindex(end, key, instance), length - 1)
+        if start > end:
+            instance.delete(key)
+            return
+        k0 = _lindex(key, start, instance)
+        k1 = _lindex(key, end, instance)
+        prefix = _augkey(key).encode('utf-8')
+        db.delete_range(_metakey(key), k0)
+        db.delete_range(k1, prefix + b'\xff')
+        _setmeta(key, db, end - start + 1, int(k0[len(prefix):]),
+                 int(k1[len(prefix):]))
 
 
 def lrem(instance, key, count: int, value: bytes) -> None:
     'https://redis.io/commands/lrem'
     db = instance.router.connection(key).db()
     prefix = _augkey(key).encode('utf-8')
-    todel = []
-    iterable = db[prefix::True] if count < 0 else db[prefix:]
-    limit = int(10**MAX_DIGITS) if count == 0 else abs(count)
-    for k, v in iterable:
-        if v == value.encode('utf-8'):
-            todel.append(k)
-        if len(todel) == limit:
-            break
-        if not k.startswith(prefix):
-            break
-    for k in todel:
-        del db[k]
+    with _transaction(db):
+        meta = _meta(key, db)
+        if meta is None:
+            return 0
+        todel = []
+        iterable = db[:prefix + b'\xff':True] if count < 0 else db[prefix:]
+        limit = int(10**MAX_DIGITS) if count == 0 else abs(count)
+        for k, v in iterable:
+            if not k.startswith(prefix):
+                break
+            if v == value.encode('utf-8'):
+                todel.append(k)
+            if len(todel) == limit:
+                break
+        for k in todel:
+            del db[k]
+        length, head, tail = meta
+        length -= len(todel)
+        if length > 0:
+            if _itemkey(key, head) in todel:
+                head = _neighbour(key, db, head, False)
+            if _itemkey(key, tail) in todel:
+                tail = _neighbour(key, db, tail, True)
+        _setmeta(key, db, length, head, tail)
     return len(todel)
 
 
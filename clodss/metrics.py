@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+'''
+metrics.py: provides the Metrics class which instruments commands with
+latency histograms and counters, and exporters of its measures
+'''
+
+import logging
+import math
+import threading
+
+LOG = logging.getLogger('clodss')
+
+# quantiles reported for every command
+QUANTILES = (('p50', .5), ('p99', .99), ('p999', .999))
+
+# the bytes written and read are measured on one call of every command out
+# of SIZE_SAMPLING, starting with the first, and extrapolated to the others
+SIZE_SAMPLING = 16
+
+
+class Histogram:
+    '''
+    log-linear histogram of positive values, in the manner of HDR histograms:
+    every power of two is split into SUBBUCKETS buckets, so quantiles are
+    accurate to 1/SUBBUCKETS of their value whatever the range of the values
+    '''
+    SUBBUCKETS = 64
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, value):
+        'counts `value`'
+        m, e = math.frexp(value if value > 1e-9 else 1e-9)
+        # m is in [.5, 1)
+        index = (e - 1) * self.SUBBUCKETS + int(m * 2 * self.SUBBUCKETS)
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def _upper(self, index):
+        e, sub = divmod(index, self.SUBBUCKETS)
+        return math.ldexp(.5 + (sub + 1) / (2 * self.SUBBUCKETS), e)
+
+    def quantile(self, q):
+        'gets the value below which the fraction `q` of the values fall'
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._upper(index), self.max)
+        return self.max
+
+    def mean(self):
+        'gets the mean of the values'
+        return self.total / self.count if self.count else 0.
+
+
+def _size(value):
+    # bytes of a value sent to or returned by a command
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, (int, float)):
+        return len(str(value))
+    if isinstance(value, (list, tuple)):
+        return sum(_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_size(k) + _size(v) for k, v in value.items())
+    return 0
+
+
+class Metrics:
+    '''
+    thread-safe measures of the commands of a StrictRedis instance: latency
+    histograms, errors, retries and bytes written and read per command, and
+    the number of commands per db. commands called by other commands are not
+    measured separately. bytes are sampled, see SIZE_SAMPLING, unless hooks
+    are added with `addhook`: they are called after every command with its
+    name, db, duration, whether it failed, and the bytes written and read
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._counters = {}
+        self._shards = {}
+        self._hooks = []
+
+    def addhook(self, hook):
+        'calls `hook(command, db, seconds, error, written, read)` afterwards'
+        self._hooks.append(hook)
+
+    def removehook(self, hook):
+        'stops calling `hook`'
+        self._hooks.remove(hook)
+
+    def _count(self, command, counter, amount=1):
+        counters = self._counters.setdefault(
+            command, {'errors': 0, 'retries': 0, 'written': 0, 'read': 0})
+        counters[counter] += amount
+
+    def record(  # pylint: disable=too-many-arguments
+            self, command, db, seconds, error, *, args=(), result=None):
+        '''
+        records a call to `command` on the db named `db` (None for commands
+        on all dbs) which took `seconds`. `args` are the values written by the
+        command and `result` the values it read, they are only measured when
+        sampled or when there are hooks
+        '''
+        with self._lock:
+            histogram = self._latencies.get(command)
+            if histogram is None:
+                histogram = self._latencies[command] = Histogram()
+                self._count(command, 'errors', 0)
+            histogram.record(seconds)
+            if error:
+                self._count(command, 'errors')
+            if db is not None:
+                counts = self._shards.get(db)
+                if counts is None:
+                    counts = self._shards[db] = {}
+                counts[command] = counts.get(command, 0) + 1
+            sampled = (histogram.count - 1) % SIZE_SAMPLING == 0
+        if not sampled and not self._hooks:
+            return
+        written, read = _size(args), _size(result)
+        if sampled:
+            with self._lock:
+                self._count(command, 'written', written)
+                self._count(command, 'read', read)
+        for hook in self._hooks:
+            try:
+                hook(command, db, seconds, error, written, read)
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception('metrics hook %r failed', hook)
+
+    def retry(self, command):
+        'records a retry of `command`'
+        with self._lock:
+            self._count(command, 'retries')
+
+    def snapshot(self):
+        '''
+        gets the measures as a dict: "commands" maps command names to their
+        count, mean, max and quantiles in seconds, and their counters, and
+        "dbs" maps db names to the number of calls of every command
+        '''
+        with self._lock:
+            commands = {}
+            for command, histogram in self._latencies.items():
+                measures = {'count': histogram.count,
+                            'mean': histogram.mean(),
+                            'max': histogram.max}
+                for label, q in QUANTILES:
+                    measures[label] = histogram.quantile(q)
+                measures.update(self._counters[command])
+                # extrapolates the sampled bytes to all calls
+                samples = (histogram.count - 1) // SIZE_SAMPLING + 1
+                for counter in ('written', 'read'):
+                    measures[counter] = \
+                        measures[counter] * histogram.count // samples
+                commands[command] = measures
+            return {'commands': commands,
+                    'dbs': {db: dict(counts)
+                            for db, counts in self._shards.items()}}
+
+    def stats(self):
+        'gets the mean duration and the number of calls per command'
+        with self._lock:
+            return {command: (histogram.mean(), histogram.count)
+                    for command, histogram in self._latencies.items()}
+
+    def export(self, exporter=None):
+        '''
+        exports the measures with `exporter(snapshot)`, see `snapshot`.
+        defaults to the prometheus text format
+        '''
+        return (exporter or prometheus)(self.snapshot())
+
+
+def prometheus(snapshot):
+    'formats a snapshot of metrics in the prometheus text exposition format'
+    lines = [
+        '# HELP clodss_command_duration_seconds duration of commands',
+        '# TYPE clodss_command_duration_seconds summary',
+    ]
+    commands = sorted(snapshot['commands'].items())
+    for command, measures in commands:
+        for label, q in QUANTILES:
+            lines.append(f'clodss_command_duration_seconds'
+                         f'{{command="{command}",quantile="{q}"}} '
+                         f'{measures[label]!r}')
+        lines.append(f'clodss_command_duration_seconds_sum'
+                     f'{{command="{command}"}} '
+                     f'{measures["mean"] * measures["count"]!r}')
+        lines.append(f'clodss_command_duration_seconds_count'
+                     f'{{command="{command}"}} {measures["count"]}')
+    for counter, metric, doc in (
+            ('errors', 'errors', 'failed commands'),
+            ('retries', 'retries', 'retries of busy commands'),
+            ('written', 'bytes_written', 'bytes written by commands'),
+            ('read', 'bytes_read', 'bytes read by commands')):
+        name = f'clodss_command_{metric}_total'
+        lines.append(f'# HELP {name} {doc}')
+        lines.append(f'# TYPE {name} counter')
+        lines.extend(f'{name}{{command="{command}"}} {measures[counter]}'
+                     for command, measures in commands)
+    lines.append('# HELP clodss_db_commands_total commands per db')
+    lines.append('# TYPE clodss_db_commands_total counter')
+    for db, counts in sorted(snapshot['dbs'].items()):
+        lines.extend(f'clodss_db_commands_total'
+                     f'{{db="{db}",command="{command}"}} {count}'
+                     for command, count in sorted(counts.items()))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+'''
+notify.py: provides the Notifier class to wake up clients waiting for keys
+'''
+
+import hashlib
+import os
+import threading
+import time
+
+
+class Notifier:
+    '''
+    wakes up clients blocked on keys. waiters register per key and are woken
+    through a condition variable by writers of the same process. writers also
+    touch a per-key notification file, which waiters poll to be woken by
+    writers in other processes sharing the same dbpath
+    '''
+    POLL_INTERVAL = .05
+
+    def __init__(self, path):
+        '''
+        path: directory for the notification files
+        '''
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._cond = threading.Condition()
+        self._waiters = {}
+        self._versions = {}
+        self._local = threading.local()
+
+    def _fname(self, key):
+        h = hashlib.sha1(key.encode('utf-8')).hexdigest()[:3]
+        return os.path.join(self.path, h)
+
+    def _stamps(self, keys):
+        stamps = []
+        for key in keys:
+            try:
+                stamps.append(os.stat(self._fname(key)).st_mtime_ns)
+            except FileNotFoundError:
+                stamps.append(None)
+        return stamps
+
+    def _pending(self):
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            pending = self._local.pending = set()
+        return pending
+
+    def notify(self, key, db=None):
+        '''
+        wakes up clients waiting for `key`. if `db` is within a transaction,
+        the notification is deferred until `flush` is called
+        '''
+        if db is not None and db.transaction_depth > 0:
+            self._pending().add(key)
+            return
+        with self._cond:
+            if key in self._waiters:
+                self._versions[key] = self._versions.get(key, 0) + 1
+                self._cond.notify_all()
+        try:
+            # only waiters create the files, so this is cheap when none exist
+            os.utime(self._fname(key))
+        except FileNotFoundError:
+            pass
+
+    def flush(self):
+        'sends the notifications deferred by the current thread'
+        pending = self._pending()
+        while pending:
+            self.notify(pending.pop())
+
+    def wait(self, keys, timeout, attempt):
+        '''
+        calls `attempt` every time one of `keys` is notified, until it returns
+        something other than None or `timeout` seconds pass (0 means forever)
+        '''
+        deadline = time.time() + timeout if timeout else None
+        for fname in map(self._fname, keys):
+            if not os.path.exists(fname):
+                with open(fname, 'ab'):
+                    pass
+        with self._cond:
+            for key in keys:
+                self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            while True:
+                with self._cond:
+                    versions = [self._versions.get(k) for k in keys]
+                stamps = self._stamps(keys)
+                result = attempt()
+                if result is not None:
+                    return result
+                with self._cond:
+                    while versions == [self._versions.get(k) for k in keys]:
+                        wait = self.POLL_INTERVAL
+                        if deadline is not None:
+                            wait = min(wait, deadline - time.time())
+                            if wait <= 0:
+                                return None
+                        self._cond.wait(wait)
+                        if stamps != self._stamps(keys):
+                            break
+        finally:
+            with self._cond:
+                for key in keys:
+                    self._waiters[key] -= 1
+                    if not self._waiters[key]:
+                        del self._waiters[key]
+                        self._versions.pop(key, None)
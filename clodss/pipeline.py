@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+'''
+pipeline.py: provides the Pipeline class which batches commands per db
+'''
+
+import time
+
+from .common import GLOBAL_METHODS, BLOCKING_METHODS, READ_METHODS
+from .common import methodtype, otherkeys, _transaction
+
+
+class Pipeline:
+    '''
+    queues commands and executes them grouped by the db holding their key.
+    every group runs on a single connection, within a single transaction
+    unless disabled, so that a failing command rolls back its whole group.
+    key type and expiry checks run once per key and batch. groups are retried
+    like commands while their db is locked, and their commands are recorded
+    in the metrics with an equal share of the duration of the group.
+    '''
+
+    def __init__(self, instance, transaction=True):
+        self._instance = instance
+        self._transaction = transaction
+        self._commands = []
+
+    def __getattr__(self, name):
+        method = getattr(type(self._instance), name, None)
+        method = getattr(method, '__wrapped__', None)
+        if method is None:
+            raise AttributeError(f'unknown command `{name}`')
+        if name in GLOBAL_METHODS + BLOCKING_METHODS:
+            raise ValueError(f'`{name}` cannot be pipelined')
+
+        def queue(*args, **kwargs):
+            if not args:
+                raise TypeError('too few parameters, `key` is required')
+            self._commands.append((name, method, args, kwargs))
+            return self
+        queue.__name__ = name
+        return queue
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.reset()
+
+    def reset(self):
+        'discards all queued commands'
+        self._commands = []
+
+    def _executegroup(self, commands, results, done):
+        # commands in `done` already ran in a previous attempt
+        instance = self._instance
+        seen = {}
+        for i, name, method, args, kwargs in commands:
+            if i in done:
+                continue
+            key = args[0]
+            mtype = methodtype(name)
+            if seen.get(key) != mtype:
+                instance.checkkey(name, key, expiry=key not in seen)
+                seen[key] = mtype
+            results[i] = method(instance, *args, **kwargs)
+            done.add(i)
+
+    def _rungroup(self, group, others, results, done):
+        router = self._instance.router
+        with router.keyed(group[0][3][0], True, others) as conn:
+            try:
+                if not self._transaction:
+                    self._executegroup(group, results, done)
+                    return
+                # a failing attempt is rolled back as a whole
+                with _transaction(conn.db()):
+                    self._executegroup(group, results, set())
+            finally:
+                for command in group:
+                    router.touch(command[3][0])
+
+    def _runshard(self, shard, group, results, nested):
+        # like commands, only the outermost call retries and is recorded
+        instance = self._instance
+        # keys of other dbs accessed by commands of the group
+        others = {}
+        for _, name, _, args, _ in group:
+            for k, write in (otherkeys(name, args) or {}).items():
+                others[k] = others.get(k, False) or write
+        if nested:
+            self._rungroup(group, others, results, set())
+            return
+        t = time.perf_counter()
+        error = True
+        try:
+            instance.retrying('pipeline', self._rungroup,
+                              group, others, results, set())
+            error = False
+        finally:
+            metrics = instance.metrics
+            seconds = (time.perf_counter() - t) / len(group)
+            for i, name, _, args, kwargs in group if metrics else ():
+                metrics.record(
+                    name, shard, seconds, error, result=results[i],
+                    args=() if name in READ_METHODS else (args[1:], kwargs))
+
+    def execute(self):
+        '''
+        executes all queued commands and returns their results in the order
+        they were queued
+        '''
+        instance = self._instance
+        router = instance.router
+        commands, self._commands = self._commands, []
+        groups = {}
+        for i, (name, method, args, kwargs) in enumerate(commands):
+            groups.setdefault(router.shard(args[0]), []).append(
+                (i, name, method, args, kwargs))
+        nested = router.holdslocks()
+        results = [None] * len(commands)
+        try:
+            for shard, group in groups.items():
+                self._runshard(shard, group, results, nested)
+        finally:
+            if not nested:
+                instance.notifier.flush()
+        return results
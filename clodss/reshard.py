@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+'''
+reshard.py: moves the data of a database to another spread factor while it
+keeps serving requests. can be run as a script:
+
+    python -m clodss.reshard DBPATH FACTOR [--db DB] [--batch-size N]
+                             [--profile PROFILE]
+'''
+
+import argparse
+import hashlib
+import logging
+import os
+import time
+
+from .common import SEP, BusyError, _recordkey, _deletekey, _setexpire
+from .common import _expirekey, _transaction
+from .router import Layout, Router
+from .storage import PROFILES, storageoptions
+
+LOG = logging.getLogger('clodss')
+
+# attempts to take the write lock of a db to switch it to the new layout
+SWITCH_ATTEMPTS = 10
+
+
+def _digest(key, factor):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:factor]
+
+
+def _write(router, records):
+    # records are (db name, key, value) tuples
+    groups = {}
+    for name, k, v in records:
+        groups.setdefault(name, {})[k] = v
+    for name, group in sorted(groups.items()):
+        with router.checkout(name) as conn, router.locked(name):
+            db = conn.db()
+            with _transaction(db):
+                db.update(group)
+
+
+def _copy(router, name, batchsize):
+    # streams the records of db `name` to the target layout, in batches
+    target = router.layout.target
+    start = b''
+    while True:
+        with router.checkout(name) as conn:
+            batch = []
+            for k, v in conn.db()[start:]:
+                batch.append((k, v))
+                if len(batch) == batchsize:
+                    break
+        _write(router, [(_digest(_recordkey(k), target), k, v)
+                        for k, v in batch])
+        if len(batch) < batchsize:
+            return
+        start = batch[-1][0] + b'\0'
+
+
+def _replay(router, name, keys):
+    # copies the current records of `keys` from db `name` again
+    sep = SEP.encode('utf-8')
+    target = router.layout.target
+    src = router.dbconnection(name).db()
+    groups = {}
+    for key in keys:
+        groups.setdefault(_digest(key, target), []).append(key)
+    for dest, group in sorted(groups.items()):
+        with router.checkout(dest) as conn, router.locked(dest):
+            db = conn.db()
+            with _transaction(db):
+                for key in group:
+                    _deletekey(db, key)
+                    k = key.encode('utf-8')
+                    try:
+                        db[k] = src[k]
+                    except KeyError:
+                        pass
+                    db.update(dict(src[k + sep:k + sep + b'\xff']))
+                    try:
+                        _setexpire(db, key, src[_expirekey(key)])
+                    except KeyError:
+                        pass
+
+
+def _purge(router, name):
+    # deletes the records copied by an interrupted copy of db `name`
+    factor, target = router.layout.factor, router.layout.target
+    for dest in router.dbnames(allnames=True):
+        if len(dest) != target or not (
+                dest.startswith(name) or name.startswith(dest)):
+            continue
+        with router.checkout(dest) as conn, router.locked(dest):
+            db = conn.db()
+            with _transaction(db):
+                stale = [k for k, _ in db
+                         if _digest(_recordkey(k), factor) == name]
+                for k in stale:
+                    del db[k]
+
+
+def _move(router, name, batchsize):
+    if router.layout.current == name:
+        LOG.info('resuming the interrupted copy of db %s', name)
+        _purge(router, name)
+    router.startcopy(name)
+    _copy(router, name, batchsize)
+    for attempt in range(SWITCH_ATTEMPTS):
+        try:
+            with router.checkout(name), router.locked(name):
+                router.endcopy(lambda keys: _replay(router, name, keys))
+            break
+        except BusyError:
+            if attempt == SWITCH_ATTEMPTS - 1:
+                raise
+            time.sleep(Router.LOCK_TIMEOUT)
+    router.discard(name)
+
+
+def reshard(router, factor, batchsize=1000):
+    '''
+    moves the dbs of `router` to the layout of spread factor `factor`, one db
+    at a time. the records of a db are streamed in batches of `batchsize`,
+    and the keys written meanwhile are copied again before the keys of the
+    db are switched to the new layout, under the write lock of the db.
+    requests are served throughout, from the old db until the switch.
+    an interrupted resharding is resumed by calling `reshard` again, only the
+    db being moved is copied again. other processes sharing the dbpath
+    follow the layout within GENERATION_CHECK_INTERVAL, but their writes are
+    not tracked, they must be stopped while resharding
+    '''
+    layout = router.layout
+    if layout.target is None:
+        if factor == layout.factor:
+            return
+        router.setlayout(Layout(layout.factor, factor))
+        layout = router.layout
+    elif factor != layout.target:
+        raise ValueError(
+            f'resharding to spread factor {layout.target} is in progress')
+    names = router.dbnames(allnames=True)
+    if layout.current in names:
+        # the interrupted copy comes first
+        names.remove(layout.current)
+        names.insert(0, layout.current)
+    for name in names:
+        if len(name) != layout.factor:
+            continue
+        if name in layout.done:
+            # removal interrupted
+            router.discard(name)
+            continue
+        LOG.info('resharding db %s', name)
+        _move(router, name, batchsize)
+    router.setlayout(Layout(factor))
+
+
+def main(argv=None):
+    'command line entry point'
+    parser = argparse.ArgumentParser(
+        description='changes the spread factor of a clodss database')
+    parser.add_argument('dbpath', help='base path of the database')
+    parser.add_argument('factor', type=int, help='new spread factor')
+    parser.add_argument('--db', type=int, default=0, help='database index')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='number of records copied per transaction')
+    parser.add_argument('--profile', choices=PROFILES, default='default',
+                        help='storage profile of the database')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    dbpath = os.path.join(args.dbpath, f'{args.db:02d}')
+    if not os.path.isdir(dbpath):
+        parser.error(f'no database at {dbpath}')
+    router = Router(dbpath, options=storageoptions(args.profile))
+    try:
+        reshard(router, args.factor, args.batch_size)
+    finally:
+        router.close()
+
+
+if __name__ == '__main__':
+    main()
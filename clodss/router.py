@@ -5,85 +5,703 @@ router.py: provides the Router class to map keys to a corresponding database.
 routing is configured by a spread factor
 '''
 
+import contextlib
+import glob
 import hashlib
+import json
+import logging
+import multiprocessing
 import os
-import random
+import shutil
+import threading
+import time
 import uuid
+from concurrent.futures import (
+    ThreadPoolExecutor, ProcessPoolExecutor, as_completed)
 import lsm
+from .common import BusyError
 
-class DBConnection:
-    'a database connection used within a pool'
-    def __init__(self, fname):
+LOG = logging.getLogger('clodss')
+
+
+class RWLock:
+    '''
+    reentrant reader/writer lock: readers share it, writers hold it
+    exclusively and are preferred over new readers. a writer may take the read
+    lock, but a reader cannot upgrade to the write lock
+    '''
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = {}
+        self._writer = None
+        self._writes = 0
+        self._waiting = 0
+
+    def acquire(self, write, timeout=None):
+        'acquires the lock, returns False if `timeout` seconds pass first'
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                if write:
+                    self._writes += 1
+                else:
+                    self._readers[me] = self._readers.get(me, 0) + 1
+                return True
+            if write:
+                if me in self._readers:
+                    raise RuntimeError('cannot upgrade a read lock')
+                self._waiting += 1
+                try:
+                    if not self._cond.wait_for(
+                            lambda: self._writer is None and not self._readers,
+                            timeout):
+                        return False
+                finally:
+                    self._waiting -= 1
+                self._writer = me
+                self._writes = 1
+                return True
+            if me not in self._readers and not self._cond.wait_for(
+                    lambda: self._writer is None and not self._waiting,
+                    timeout):
+                return False
+            self._readers[me] = self._readers.get(me, 0) + 1
+            return True
+
+    def release(self, write):
+        'releases the lock'
+        me = threading.get_ident()
+        with self._cond:
+            if write:
+                self._writes -= 1
+                if not self._writes:
+                    self._writer = None
+            else:
+                self._readers[me] -= 1
+                if not self._readers[me]:
+                    del self._readers[me]
+            self._cond.notify_all()
+
+
+class DBConnection:  # pylint: disable=too-many-instance-attributes
+    'a database connection used within a pool, opened on first use'
+    def __init__(self, fname, options=None):
         self._id = uuid.uuid1().hex
+        self.options = options or {}
         self.free = True
-        self._db = lsm.LSM(fname)
+        self._db = None
         self.fname = fname
+        self.name = os.path.basename(fname).rsplit('.', 1)[0]
+        self.opened = time.perf_counter()
+        self.busy = 0
+        self._since = None
+
+    def checkout(self):
+        'marks the connection as used'
+        self.free = False
+        self._since = time.perf_counter()
+
+    def checkin(self):
+        'marks the connection as free'
+        self.busy += time.perf_counter() - self._since
+        self.free = True
+
+    def utilisation(self):
+        'gets the fraction of the time the connection was in use'
+        now = time.perf_counter()
+        busy = self.busy
+        if not self.free:
+            busy += now - self._since
+        return busy / max(now - self.opened, 1e-9)
+
+    def __reduce__(self):
+        # connections sent to worker processes open their own handle
+        return DBConnection, (self.fname, self.options)
 
     def db(self):
         'db object'
+        if self._db is None:
+            self._db = lsm.LSM(self.fname, **self.options)
         return self._db
 
+    def isopen(self):
+        'checks whether the db file is open'
+        return self._db is not None
+
+    def close(self):
+        '''
+        closes the db file, it is opened again on next use. the connection
+        must not be in use, lsm crashes on accesses to closed handles
+        '''
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
     def id(self):
         'connection id'
         return self._id
 
 
-class Router:
+class Layout:
+    '''
+    maps keys to dbs named after the first `factor` hex digits of the sha1 of
+    the key. while resharding to `target` digits, the keys of the dbs listed
+    in `done` are served by the dbs of the target layout, and the db being
+    moved is `current`
+    '''
+    def __init__(self, factor, target=None, done=(), current=None):
+        self.factor = factor
+        self.target = target
+        self.done = set(done)
+        self.current = current
+
+    def shard(self, key: str):
+        'gets the name of the db which holds `key`'
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        name = digest[:self.factor]
+        if name in self.done:
+            return digest[:self.target]
+        return name
+
+    def serves(self, name: str):
+        'checks whether the db named `name` is part of the layout'
+        if len(name) == self.factor:
+            return name not in self.done
+        return len(name) == self.target
+
+    def todict(self):
+        'gets a json-serializable representation'
+        if self.target is None:
+            return {'factor': self.factor}
+        return {'factor': self.factor, 'target': self.target,
+                'done': sorted(self.done), 'current': self.current}
+
+
+def _delete(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+
+
+def _runclosing(func, conn, *args):
+    # runs in worker processes, which must not accumulate open handles
+    try:
+        return func(conn, *args)
+    finally:
+        conn.close()
+
+
+class Router:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
     'main routing class, maps keys to a db based on a spread factor'
     EXT = 'clodssdb'
+    # seconds to wait for a db lock before giving up. commands accessing
+    # several dbs lock them in the order of their names, see `keyed`
+    LOCK_TIMEOUT = 1
+    # file recording the layout of the dbs, see `Layout`
+    LAYOUT = 'layout'
+    # file naming the directory of the current generation of the db files,
+    # which are in dbpath itself without it
+    GENERATION = 'generation'
+    # seconds between two checks of the generation and layout files, i.e.
+    # how long other processes may keep using the dbs of a generation after
+    # a flush, or the previous layout while resharding
+    GENERATION_CHECK_INTERVAL = .1
 
-    def __init__(self, dbpath, factor=2, poolsize=3):
+    def __init__(  # pylint: disable=too-many-arguments
+            self, dbpath, factor=2, *, poolsize=3, workers=1,
+            processes=False, maxopen=256, options=None):
         '''
         dbpath: where to store the data files
         factor: partitioning factor, the higher it is, the more spread your
         data will be. this improves concurrency but also increases the number
-        of open files. defaults to 2
-        poolsize: pool size per data file, defaults to 3
+        of open files. defaults to 2. ignored for existing dbs, which keep
+        their factor until they are resharded
+        poolsize: maximum number of connections per data file, opened on
+        demand. defaults to 3
+        workers: number of workers operations on all dbs are spread over,
+        defaults to 1 i.e. dbs are visited one after another
+        processes: whether workers are processes rather than threads. lsm
+        holds the GIL while reading, so processes are needed to use several
+        cores. defaults to False
+        maxopen: maximum number of connections kept open over all dbs, the
+        least recently used idle ones are closed beyond it. every connection
+        uses two file descriptors. defaults to 256
+        options: options the lsm files are opened with, see
+        `storage.storageoptions`
         '''
-        self.factor = factor
         self.dbpath = dbpath
+        # directory of the db files, replaced when the dbs are flushed
+        self.datapath, self._genstamp = self._readgeneration()
+        self._genchecked = time.monotonic()
+        self.layout, self._layoutstamp = self._loadlayout(factor)
+        # keys written to the db being resharded
+        self._dirty = None
         self.poolsize = poolsize
         self.pool = {}
+        self._poolcond = threading.Condition()
+        self.poolwaits = {}
+        self.maxopen = maxopen
+        self.options = options or {}
+        # pooled connections, least recently used first
+        self._lru = {}
+        self.workers = workers
+        self.processes = processes
+        self._executor = None
+        self._local = threading.local()
+        self._locks = {}
+        self._lockslock = threading.Lock()
+        self.lockwaits = {}
+
+    @property
+    def factor(self):
+        'number of hex digits of the db names'
+        return self.layout.factor
+
+    def _stamp(self, fname):
+        # identifies the version of a file replaced as a whole
+        try:
+            st = os.stat(os.path.join(self.dbpath, fname))
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def _loadlayout(self, factor):
+        # gets the layout and the stamp of the layout file
+        try:
+            with open(os.path.join(self.dbpath, Router.LAYOUT),
+                      encoding='utf-8') as f:
+                st = os.fstat(f.fileno())
+                layout = Layout(**json.load(f))
+                stamp = st.st_ino, st.st_mtime_ns
+        except FileNotFoundError:
+            # dbs created before the layout was recorded
+            lengths = {len(name) for name in self._names()}
+            layout = Layout(lengths.pop() if len(lengths) == 1 else factor)
+            stamp = self._savelayout(layout)
+        if layout.factor != factor and layout.target is None:
+            LOG.warning('dbs in %s have spread factor %d, use reshard to '
+                        'change it', self.dbpath, layout.factor)
+        return layout, stamp
+
+    def _savelayout(self, layout):
+        fname = os.path.join(self.dbpath, Router.LAYOUT)
+        with open(fname + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(layout.todict(), f)
+        os.replace(fname + '.tmp', fname)
+        return self._stamp(Router.LAYOUT)
+
+    def setlayout(self, layout):
+        'switches to `layout` and records it'
+        with self._poolcond:
+            self._layoutstamp = self._savelayout(layout)
+            self.layout = layout
+
+    def savelayout(self):
+        'records the changes made to the current layout'
+        with self._poolcond:
+            self._layoutstamp = self._savelayout(self.layout)
+
+    def _readgeneration(self):
+        # gets the data directory and the stamp of the generation file
+        try:
+            with open(os.path.join(self.dbpath, Router.GENERATION),
+                      encoding='utf-8') as f:
+                st = os.fstat(f.fileno())
+                return (os.path.join(self.dbpath, f.read().strip()),
+                        (st.st_ino, st.st_mtime_ns))
+        except FileNotFoundError:
+            return self.dbpath, None
+
+    def _checkgeneration(self):
+        # follows flushes and resharding made by other processes sharing the
+        # dbpath, the generation and layout files are checked at most once
+        # per interval
+        now = time.monotonic()
+        if now - self._genchecked < self.GENERATION_CHECK_INTERVAL:
+            return
+        self._genchecked = now
+        if (self._stamp(Router.GENERATION) == self._genstamp
+                and self._stamp(Router.LAYOUT) == self._layoutstamp):
+            return
+        with self._poolcond:
+            if self._stamp(Router.GENERATION) != self._genstamp:
+                self.datapath, self._genstamp = self._readgeneration()
+                LOG.info('dbs in %s were flushed, switching to %s',
+                         self.dbpath, self.datapath)
+                self._dirty = None
+            elif self._stamp(Router.LAYOUT) != self._layoutstamp:
+                LOG.info('layout of %s was changed, reloading it',
+                         self.dbpath)
+            else:
+                return
+            # connections to the dbs moved away are dropped as well
+            self.layout, self._layoutstamp = self._loadlayout(
+                self.layout.factor)
+            self.close()
 
     def _alldbs(self):
         return sorted([
-            os.path.join(self.dbpath, f)
-            for f in os.listdir(self.dbpath)
+            os.path.join(self.datapath, f)
+            for f in os.listdir(self.datapath)
             if f.endswith(Router.EXT)
         ])
 
-    def reset(self):
-        'clears the database and closes all connections'
-        for db in self._alldbs():
-            os.unlink(db)
-        self.pool = {}
+    def _names(self):
+        return [os.path.basename(db).rsplit('.', 1)[0]
+                for db in self._alldbs()]
+
+    def _dbfile(self, name):
+        return os.path.join(self.datapath, f'{name}.{Router.EXT}')
+
+    def dbnames(self, allnames=False):
+        '''
+        gets the names of all available dbs of the layout, or of all dbs if
+        `allnames`, alphabetically sorted
+        '''
+        self._checkgeneration()
+        if allnames:
+            return self._names()
+        return [name for name in self._names() if self.layout.serves(name)]
 
-    def connection(self, key: bytes):
-        'gets a new connection'
-        db = hashlib.sha1(key.encode('utf-8')).hexdigest()[:self.factor]
-        dbs = self.pool.get(db)
-        if not dbs:
-            self.pool[db] = [
-                DBConnection(os.path.join(self.dbpath, f'{db}.{Router.EXT}'))
-                for _ in range(self.poolsize)
-            ]
-            dbs = self.pool[db]
-        return random.choice(dbs)
+    def reset(self, asynchronous=False):
+        '''
+        clears the database and closes all connections. the db files are
+        replaced at once by an empty generation directory, the previous ones
+        are deleted afterwards, in the background if `asynchronous`.
+        commands in flight complete on the previous files, and other
+        processes sharing the dbpath switch on their first checkout after
+        GENERATION_CHECK_INTERVAL
+        '''
+        generation = f'gen-{uuid.uuid1().hex}'
+        os.mkdir(os.path.join(self.dbpath, generation))
+        with self._poolcond:
+            if self.layout.target is not None:
+                self.setlayout(Layout(self.layout.target))
+                self._dirty = None
+            fname = os.path.join(self.dbpath, Router.GENERATION)
+            with open(fname + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(generation)
+            os.replace(fname + '.tmp', fname)
+            self.datapath, self._genstamp = self._readgeneration()
+            self.close()
+        # previous generations, including the ones left by interrupted
+        # deletions and the files of dbs created without generations
+        stale = [os.path.join(self.dbpath, f)
+                 for f in os.listdir(self.dbpath)
+                 if f.startswith('gen-') and f != generation]
+        stale += glob.glob(os.path.join(
+            glob.escape(self.dbpath), f'*.{Router.EXT}*'))
+        if asynchronous:
+            threading.Thread(target=_delete, args=(stale,),
+                             name='clodss-flush', daemon=True).start()
+        else:
+            _delete(stale)
+
+    def close(self):
+        '''
+        closes all connections, the ones in use are closed when they are
+        returned to the pool
+        '''
+        with self._poolcond:
+            conns = [conn for conns in self.pool.values() for conn in conns]
+            self.pool = {}
+            self._lru = {}
+        for conn in conns:
+            if conn.free:
+                conn.close()
+
+    def discard(self, name):
+        '''
+        closes the connections to the db named `name` and deletes its files,
+        the ones in use are closed when they are returned to the pool
+        '''
+        with self._poolcond:
+            conns = self.pool.pop(name, [])
+            for conn in conns:
+                del self._lru[conn]
+        for conn in conns:
+            if conn.free:
+                conn.close()
+        for fname in glob.glob(glob.escape(self._dbfile(name)) + '*'):
+            os.unlink(fname)
+
+    def _pins(self):
+        pins = getattr(self._local, 'pins', None)
+        if pins is None:
+            pins = self._local.pins = {}
+        return pins
+
+    def shard(self, key: str):
+        'gets the name of the db which holds `key`'
+        return self.layout.shard(key)
+
+    @contextlib.contextmanager
+    def keyed(self, key: str, write: bool = True, others: dict = None):
+        '''
+        checks out the connection serving `key` and holds the lock of its db,
+        see `checkout` and `locked`. raises BusyError if the key moved to
+        another db while waiting for the lock
+        others: other keys accessed along with `key`, mapped to whether they
+        are written. their dbs are checked out and locked as well, all in the
+        order of their names, so that threads accessing the same dbs do not
+        deadlock
+        '''
+        name = self.shard(key)
+        if not others:
+            with self.checkout(name) as conn, self.locked(name, write):
+                if self.shard(key) != name:
+                    raise BusyError(f'{key!r} moved from db {name}')
+                yield conn
+            return
+        keys = dict(others)
+        keys[key] = write or keys.get(key, False)
+        dbs = {}
+        for k, w in keys.items():
+            db = self.shard(k)
+            dbs[db] = dbs.get(db, False) or w
+        with contextlib.ExitStack() as stack:
+            for db in sorted(dbs):
+                stack.enter_context(self.checkout(db))
+                stack.enter_context(self.locked(db, dbs[db]))
+            for k in keys:
+                if self.shard(k) not in dbs:
+                    raise BusyError(f'{k!r} moved while locking its db')
+            yield self.connection(key)
+
+    def startcopy(self, name):
+        '''
+        starts recording the keys written to the db named `name`, which is
+        being copied to the target layout
+        '''
+        self._dirty = set()
+        self.layout.current = name
+        self.savelayout()
+
+    def touch(self, key: str):
+        '''
+        records a write to `key`, called once the write is committed.
+        writes to the db being copied are replayed before the switch
+        '''
+        dirty = self._dirty
+        if dirty is not None and self.shard(key) == self.layout.current:
+            dirty.add(key)
+
+    def endcopy(self, replay):
+        '''
+        copies the keys written during the copy again with `replay(keys)`,
+        then switches the keys of the db being copied to the target layout.
+        the caller holds the write lock of the db
+        '''
+        replay(self._dirty)
+        self._dirty = None
+        self.layout.done.add(self.layout.current)
+        self.layout.current = None
+        self.savelayout()
+
+    def pinned(self, key: str):
+        '''
+        checks out the connection serving `key` for the current thread, see
+        `checkout`
+        '''
+        return self.checkout(self.shard(key))
+
+    @contextlib.contextmanager
+    def checkout(self, db: str):
+        '''
+        checks out a connection to the db named `db` from the pool and pins it
+        to the current thread: all calls to `dbconnection` and `connection`
+        for the same db return it until the context exits. nested checkouts
+        of the same db share the connection. a new connection is opened when
+        all are in use and the pool is not full, otherwise waits for one to
+        be returned and raises BusyError after LOCK_TIMEOUT seconds
+        '''
+        pins = self._pins()
+        if db in pins:
+            yield pins[db]
+            return
+        conn = self._acquire(db)
+        pins[db] = conn
+        try:
+            yield conn
+        finally:
+            del pins[db]
+            with self._poolcond:
+                conn.checkin()
+                if conn not in self._lru:
+                    evicted = conn
+                elif len(self._lru) > self.maxopen:
+                    evicted = self._evict()
+                else:
+                    evicted = None
+                self._poolcond.notify_all()
+            if evicted is not None:
+                evicted.close()
+
+    def _acquire(self, db):
+        self._checkgeneration()
+        t = time.perf_counter()
+        deadline = t + self.LOCK_TIMEOUT
+        evicted = None
+        with self._poolcond:
+            while True:
+                conns = self.pool.setdefault(db, [])
+                conn = next((c for c in conns if c.free), None)
+                if conn is None and len(conns) < self.poolsize:
+                    conn = DBConnection(self._dbfile(db), self.options)
+                    conns.append(conn)
+                    if len(self._lru) >= self.maxopen:
+                        evicted = self._evict()
+                if conn is not None:
+                    conn.checkout()
+                    self._lru.pop(conn, None)
+                    self._lru[conn] = None
+                    break
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    self._countwait(db, t)
+                    raise BusyError(
+                        f'timeout while waiting for a connection to db {db}')
+                self._poolcond.wait(timeout)
+            self._countwait(db, t)
+        if evicted is not None:
+            evicted.close()
+        return conn
+
+    def _evict(self):
+        # drops the least recently used idle connection from the pool. when
+        # all are in use, the pool grows beyond `maxopen` until they return
+        conn = next((c for c in self._lru if c.free), None)
+        if conn is None:
+            return None
+        del self._lru[conn]
+        conns = self.pool[conn.name]
+        conns.remove(conn)
+        if not conns:
+            del self.pool[conn.name]
+        return conn
+
+    def _countwait(self, db, t):
+        n, total = self.poolwaits.get(db, (0, 0))
+        self.poolwaits[db] = (n + 1, total + time.perf_counter() - t)
+
+    @contextlib.contextmanager
+    def locked(self, db: str, write: bool = True):
+        '''
+        holds the lock of the db named `db` in the current thread, shared
+        with other readers unless `write`. raises BusyError if the lock cannot
+        be acquired within LOCK_TIMEOUT seconds
+        '''
+        lock = self._locks.get(db)
+        if lock is None:
+            with self._lockslock:
+                lock = self._locks.setdefault(db, RWLock())
+        t = time.perf_counter()
+        acquired = lock.acquire(write, self.LOCK_TIMEOUT)
+        with self._lockslock:
+            n, total = self.lockwaits.get(db, (0, 0))
+            self.lockwaits[db] = (n + 1, total + time.perf_counter() - t)
+        if not acquired:
+            raise BusyError(f'timeout while waiting for the lock of db {db}')
+        self._local.held = getattr(self._local, 'held', 0) + 1
+        try:
+            yield
+        finally:
+            self._local.held -= 1
+            lock.release(write)
+
+    def holdslocks(self):
+        'checks whether the current thread holds any db lock'
+        return getattr(self._local, 'held', 0) > 0
+
+    def connection(self, key: str):
+        'gets the connection checked out for the db holding `key`'
+        return self.dbconnection(self.shard(key))
+
+    def dbconnection(self, db: str):
+        '''
+        gets the connection to the db named `db` checked out by the current
+        thread, raises RuntimeError if there is none
+        '''
+        conn = self._pins().get(db)
+        if conn is None:
+            raise RuntimeError(
+                f'no connection to db {db} checked out by this thread')
+        return conn
 
     def allconnections(self, offset: int = 0):
         '''
-        generator of connections to all available dbs
+        generator of connections to all available dbs, each one checked out
+        until the next one is requested
         offset: start offset in the alphabetically sorted list of dbs
         '''
-        dbs = self._alldbs()[offset:]
-        pooldbs = {dbs[0].fname: dbs[0] for dbs in self.pool.values()}
-        for db in dbs:
-            try:
-                yield pooldbs[db]
-            except KeyError:
-                yield DBConnection(db)
+        for name in self.dbnames()[offset:]:
+            with self.checkout(name) as conn:
+                yield conn
+
+    def _onshard(self, name, func, *args):
+        with self.checkout(name) as conn:
+            return func(conn, *args)
+
+    def mapshards(self, func, *args):
+        '''
+        generator of `func(connection, *args)` for connections to all
+        available dbs, yielded as they complete. calls are spread over the
+        configured workers, `func` and its arguments must be picklable when
+        workers are processes
+        '''
+        names = self.dbnames()
+        if self.workers <= 1 or len(names) <= 1:
+            for name in names:
+                yield self._onshard(name, func, *args)
+            return
+        if self._executor is None:
+            if self.processes:
+                self._executor = ProcessPoolExecutor(
+                    self.workers, multiprocessing.get_context('spawn'))
+            else:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='clodss-shard')
+        if self.processes:
+            # worker processes open their own handles
+            futures = [self._executor.submit(
+                _runclosing, func,
+                DBConnection(self._dbfile(name), self.options), *args)
+                for name in names]
+        else:
+            futures = [self._executor.submit(self._onshard, name, func, *args)
+                       for name in names]
+        for future in as_completed(futures):
+            yield future.result()
+
+    def lockstatus(self):
+        '''
+        gets the number of acquisitions of the lock of every db and the total
+        seconds spent waiting for them
+        '''
+        with self._lockslock:
+            return dict(self.lockwaits)
 
     def poolstatus(self):
-        'gets pooling status'
-        return {k: [conn.free for conn in conns]
-                for k, conns in self.pool.items()}
+        '''
+        gets the status of the pool of every db: the number of open and of
+        checked out connections, the mean utilisation of the open connections,
+        and the number of checkouts and the total seconds spent waiting for
+        them
+        '''
+        status = {}
+        with self._poolcond:
+            for db, conns in self.pool.items():
+                waits, waittime = self.poolwaits.get(db, (0, 0))
+                status[db] = {
+                    'size': len(conns),
+                    'inuse': sum(not conn.free for conn in conns),
+                    'utilisation': sum(
+                        conn.utilisation() for conn in conns) / len(conns)
+                    if conns else 0,
+                    'checkouts': waits,
+                    'waittime': waittime,
+                }
+        return status
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+
+'''
+clodss: set data-structure
+
+members are records ordered by member, so the set algebra commands merge the
+sets as sorted streams with cursors. members are sampled by their rank, which
+is sought through the counts of the ranges of members in the rank index
+'''
+
+import bisect
+import contextlib
+import heapq
+import itertools
+import random
+
+import lsm
+
+from .common import SEP, _deletekey, _getcount, _setcount
+from .hashmaps import _hmget
+from .keys import _scanprefix
+
+# records written per update by the store commands
+STORE_BATCH = 10000
+
+# members read per batch by the streaming variant of smembers
+STREAM_BATCH = 1000
+
+# members per range of the rank index, ranges are split beyond twice as many
+RANK_RANGE = 1000
+
+
+def _prefix(skey):
+    return f'{skey}{SEP}s{SEP}'.encode('utf-8')
+
+
+def _rankprefix(skey):
+    # sorts after the count record and before the members
+    return f'{skey}{SEP}sr{SEP}'.encode('utf-8')
+
+
+def _member(member):
+    if isinstance(member, bytes):
+        return member
+    return str(member).encode('utf-8')
+
+
+def _db(instance, skey):
+    return instance.router.connection(skey).db()
+
+
+def _members(db, skey, start=b''):
+    # generator of the members of a set from `start` on in sorted order, as
+    # bytes
+    prefix = _prefix(skey)
+    for k, _ in db[prefix + start:]:
+        if not k.startswith(prefix):
+            return
+        yield k[len(prefix):]
+
+
+def _ranges(db, skey):
+    # the ranges of the rank index as (first member, count), in order
+    prefix = _rankprefix(skey)
+    for k, v in db[prefix:]:
+        if not k.startswith(prefix):
+            return
+        yield k[len(prefix):], int(v)
+
+
+def _writeranges(db, skey, members, start=b''):
+    '''
+    writes the ranges of the rank index over the sorted `members`, the first
+    one starting at `start`. gets the number of members
+    '''
+    prefix = _rankprefix(skey)
+    records = {}
+    count = 0
+    for i, member in enumerate(members):
+        if i % RANK_RANGE == 0:
+            first = start if i == 0 else member
+            records[prefix + first] = str(RANK_RANGE)
+        count += 1
+    if count:
+        records[prefix + first] = str(count - (count - 1) // RANK_RANGE
+                                      * RANK_RANGE)
+        db.update(records)
+    return count
+
+
+def _rangeof(cursor, prefix, member):
+    # gets the key of the range of the rank index holding `member`, None if
+    # the set has no rank index
+    try:
+        cursor.seek(prefix + member, lsm.SEEK_LE)
+    except KeyError:
+        return None
+    k = cursor.key()
+    return k if k.startswith(prefix) else None
+
+
+def _nextrange(cursor, prefix, member):
+    # gets the first member of the range following the one of `member`
+    try:
+        cursor.seek(prefix + member + b'\0', lsm.SEEK_GE)
+    except KeyError:
+        return None
+    k = cursor.key()
+    return k[len(prefix):] if k.startswith(prefix) else None
+
+
+def _index(db, skey, members, delta):
+    '''
+    updates the count record and the rank index of a set once the sorted
+    `members` have been added (`delta` 1) or removed (`delta` -1)
+    '''
+    count = _getcount(db, skey, 's') + delta * len(members)
+    _setcount(db, skey, 's', count)
+    prefix = _rankprefix(skey)
+    if count <= 0:
+        for first, _ in list(_ranges(db, skey)):
+            del db[prefix + first]
+        return
+    counts = {}
+    with db.cursor() as cursor:
+        k = end = None
+        for i, member in enumerate(members):
+            # members are sorted, a range is sought once they pass it
+            if k is None or end is not None and member >= end:
+                k = _rangeof(cursor, prefix, member)
+                if k is None:
+                    break
+                counts[k] = int(cursor.value())
+                if i + 1 < len(members):
+                    end = _nextrange(cursor, prefix, member)
+            counts[k] += delta
+    if k is None:
+        # new sets, and sets written before the rank index was introduced
+        _writeranges(db, skey, _members(db, skey))
+        return
+    for k, n in counts.items():
+        if n > 2 * RANK_RANGE:
+            first = k[len(prefix):]
+            _writeranges(db, skey, itertools.islice(
+                _members(db, skey, first), n), first)
+        elif n > 0 or k == prefix:
+            db[k] = str(n)
+        else:
+            del db[k]
+
+
+def _seeker(stack, db, skey):
+    '''
+    gets a function which moves a cursor over the set to its first member
+    not below the one given, and returns it or None if there is none
+    '''
+    prefix = _prefix(skey)
+    cursor = stack.enter_context(db.cursor())
+
+    def seek(member):
+        try:
+            cursor.seek(prefix + member, lsm.SEEK_GE)
+        except KeyError:
+            return None
+        k = cursor.key()
+        return k[len(prefix):] if k.startswith(prefix) else None
+    return seek
+
+
+def _sources(instance, stack, name, skeys):
+    '''
+    checks the sets `skeys`, checks out and read-locks their dbs until
+    `stack` exits, and gets their db objects
+    '''
+    dbs = []
+    for skey in skeys:
+        instance.checkkey(name, skey)
+        dbs.append(stack.enter_context(
+            instance.router.keyed(skey, write=False)).db())
+    return dbs
+
+
+def _inter(stack, dbs, skeys):
+    '''
+    generator of the members of the intersection of sets: every cursor seeks
+    to the largest member seen so far, so the smallest set drives the merge
+    and the others are only visited by seeks
+    '''
+    sizes = [_getcount(db, skey, 's') for db, skey in zip(dbs, skeys)]
+    if not all(sizes):
+        return
+    order = sorted(range(len(skeys)), key=sizes.__getitem__)
+    seekers = [_seeker(stack, dbs[i], skeys[i]) for i in order]
+    target = b''
+    while True:
+        for seek in seekers:
+            member = seek(target)
+            if member is None:
+                return
+            if member != target:
+                target = member
+                break
+        else:
+            yield target
+            # the smallest member above the current one
+            target += b'\0'
+
+
+def _union(_stack, dbs, skeys):
+    previous = None
+    for member in heapq.merge(*map(_members, dbs, skeys)):
+        if member != previous:
+            yield member
+            previous = member
+
+
+def _diff(stack, dbs, skeys):
+    seekers = [_seeker(stack, db, skey)
+               for db, skey in zip(dbs[1:], skeys[1:])]
+    for member in _members(dbs[0], skeys[0]):
+        if all(seek(member) != member for seek in seekers):
+            yield member
+
+
+OPERATIONS = {'inter': _inter, 'union': _union, 'diff': _diff}
+
+
+def _algebra(instance, name, operation, skeys):
+    with contextlib.ExitStack() as stack:
+        dbs = _sources(instance, stack, name, skeys)
+        return {instance.makevalue(m)
+                for m in OPERATIONS[operation](stack, dbs, skeys)}
+
+
+def _store(instance, name, operation, dest, skeys):
+    db = _db(instance, dest)
+    with contextlib.ExitStack() as stack:
+        dbs = _sources(instance, stack, name, skeys)
+        members = OPERATIONS[operation](stack, dbs, skeys)
+        if dest in skeys:
+            members = list(members)
+        _deletekey(db, dest)
+        prefix = _prefix(dest)
+
+        def written():
+            # writes the members as the rank index is built over them
+            batch = {}
+            for member in members:
+                batch[prefix + member] = b''
+                if len(batch) == STORE_BATCH:
+                    db.update(batch)
+                    batch = {}
+                yield member
+            db.update(batch)
+        count = _writeranges(db, dest, written())
+    instance.uncachekey(dest)
+    instance.keystoexpire.pop(dest, None)
+    _setcount(db, dest, 's', count)
+    return count
+
+
+def sadd(instance, skey, *members):
+    'https://redis.io/commands/sadd'
+    db = _db(instance, skey)
+    prefix = _prefix(skey)
+    records = {prefix + _member(m) for m in members}
+    added = sorted(records.difference(_hmget(db, sorted(records))))
+    if added:
+        db.update(dict.fromkeys(added, b''))
+        _index(db, skey, [k[len(prefix):] for k in added], 1)
+    return len(added)
+
+
+def srem(instance, skey, *members):
+    'https://redis.io/commands/srem'
+    db = _db(instance, skey)
+    prefix = _prefix(skey)
+    records = {prefix + _member(m) for m in members}
+    found = _hmget(db, sorted(records))
+    for k in found:
+        del db[k]
+    if found:
+        _index(db, skey, [k[len(prefix):] for k in found], -1)
+    return len(found)
+
+
+def scard(instance, skey):
+    'https://redis.io/commands/scard'
+    return _getcount(_db(instance, skey), skey, 's')
+
+
+def sismember(instance, skey, member):
+    'https://redis.io/commands/sismember'
+    return _prefix(skey) + _member(member) in _db(instance, skey)
+
+
+def smismember(instance, skey, *members):
+    'https://redis.io/commands/smismember'
+    if len(members) == 1 and isinstance(members[0], (list, tuple)):
+        members = members[0]
+    records = [_prefix(skey) + _member(m) for m in members]
+    found = _hmget(_db(instance, skey), sorted(set(records)))
+    return [k in found for k in records]
+
+
+def smembers(instance, skey, stream=False):
+    '''
+    https://redis.io/commands/smembers
+    returns a generator reading the set by batches if `stream`, see
+    `sscan_iter`
+    '''
+    if stream:
+        return _stream(instance, skey, None, STREAM_BATCH)
+    return {instance.makevalue(m) for m in _members(_db(instance, skey), skey)}
+
+
+def smove(instance, skey, destination, member):
+    'https://redis.io/commands/smove'
+    instance.checkkey('smove', destination)
+    if srem(instance, skey, member):
+        instance.sadd(destination, member)
+        return 1
+    return 0
+
+
+def sinter(instance, skey, *skeys):
+    '''
+    https://redis.io/commands/sinter
+    the sets are merged with cursors seeking to the members of the smallest
+    '''
+    return _algebra(instance, 'sinter', 'inter', [skey, *skeys])
+
+
+def sunion(instance, skey, *skeys):
+    '''
+    https://redis.io/commands/sunion
+    the sets are merged as sorted streams
+    '''
+    return _algebra(instance, 'sunion', 'union', [skey, *skeys])
+
+
+def sdiff(instance, skey, *skeys):
+    '''
+    https://redis.io/commands/sdiff
+    the members of the first set are looked up in the others with cursors
+    '''
+    return _algebra(instance, 'sdiff', 'diff', [skey, *skeys])
+
+
+def sinterstore(instance, destination, skey, *skeys):
+    '''
+    https://redis.io/commands/sinterstore
+    the result is written by batches as it is merged, see `sinter`
+    '''
+    return _store(instance, 'sinterstore', 'inter', destination,
+                  [skey, *skeys])
+
+
+def sunionstore(instance, destination, skey, *skeys):
+    'https://redis.io/commands/sunionstore'
+    return _store(instance, 'sunionstore', 'union', destination,
+                  [skey, *skeys])
+
+
+def sdiffstore(instance, destination, skey, *skeys):
+    'https://redis.io/commands/sdiffstore'
+    return _store(instance, 'sdiffstore', 'diff', destination,
+                  [skey, *skeys])
+
+
+def _sample(db, skey, number):
+    '''
+    samples `number` distinct members, or with repetitions if negative. the
+    ranks of the members are drawn uniformly from the count of the set, and
+    every member is read by seeking to the range of the rank index holding
+    its rank, then stepping to it within the range
+    '''
+    length = _getcount(db, skey, 's')
+    if not length or not number:
+        return []
+    if number < 0:
+        ranks = random.choices(range(length), k=-number)
+    else:
+        ranks = random.sample(range(length), min(number, length))
+    # sets written before the rank index was introduced are a single range
+    starts, counts = zip(*(list(_ranges(db, skey)) or [(b'', length)]))
+    ends = list(itertools.accumulate(counts))
+    prefix = _prefix(skey)
+    found = {}
+    position = None
+    with db.cursor() as cursor:
+        for rank in sorted(set(ranks)):
+            i = bisect.bisect_right(ends, rank)
+            first = ends[i] - counts[i]
+            if position is None or position < first:
+                cursor.seek(prefix + starts[i], lsm.SEEK_GE)
+                position = first
+            while position < rank:
+                cursor.next()
+                position += 1
+            found[rank] = cursor.key()[len(prefix):]
+    return [found[rank] for rank in ranks]
+
+
+def srandmember(instance, skey, number=None):
+    '''
+    https://redis.io/commands/srandmember
+    members are sampled uniformly by rank, see `_sample`
+    '''
+    members = _sample(_db(instance, skey), skey, 1 if number is None
+                      else number)
+    members = [instance.makevalue(m) for m in members]
+    if number is None:
+        return members[0] if members else None
+    return members
+
+
+def spop(instance, skey, count=None):
+    '''
+    https://redis.io/commands/spop
+    members are sampled like with srandmember
+    '''
+    if count is not None and count < 0:
+        raise ValueError('`count` must be positive')
+    db = _db(instance, skey)
+    members = _sample(db, skey, 1 if count is None else count)
+    for member in members:
+        del db[_prefix(skey) + member]
+    if members:
+        _index(db, skey, sorted(members), -1)
+    members = [instance.makevalue(m) for m in members]
+    if count is None:
+        return members[0] if members else None
+    return members
+
+
+def sscan(instance, skey, cursor=0, match=None, count=10):
+    '''
+    https://redis.io/commands/sscan
+    the cursor encodes the last member visited, see `hscan`
+    '''
+    cursor, records = _scanprefix(
+        _db(instance, skey), _prefix(skey), cursor, match, count)
+    return cursor, [instance.makevalue(k) for k, _ in records]
+
+
+def _stream(instance, skey, match, count):
+    # every batch is a separate command, the set is never held in memory
+    cursor = 0
+    while True:
+        cursor, members = instance.sscan(skey, cursor, match, count)
+        yield from members
+        if cursor == 0:
+            return
+
+
+def sscan_iter(instance, skey, match=None, count=STREAM_BATCH):
+    '''
+    generator of the members of a set matching `match`, read by batches of
+    `count` members with `sscan`
+    '''
+    return _stream(instance, skey, match, count)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+'''
+snapshot.py: provides point-in-time snapshots of a database, taken while it
+keeps serving requests
+'''
+
+import contextlib
+import json
+import logging
+import os
+import shutil
+import time
+
+import lsm
+
+from .common import BusyError, _transaction
+from .router import Router
+
+LOG = logging.getLogger('clodss')
+
+MANIFEST = 'manifest.json'
+# records copied per transaction
+BATCH_SIZE = 10000
+# attempts to lock all dbs at once
+CUT_ATTEMPTS = 10
+
+
+def _stats(fname):
+    # changes of the db or of its transaction log
+    stats = []
+    for suffix in ('', '-log'):
+        try:
+            st = os.stat(fname + suffix)
+            stats.append([st.st_size, st.st_mtime_ns])
+        except FileNotFoundError:
+            stats.append(None)
+    return stats
+
+
+def _checkpoint(router, name):
+    with router.checkout(name) as conn, router.locked(name):
+        db = conn.db()
+        db.flush()
+        db.checkpoint(0)
+
+
+def _lockall(router, names):
+    '''
+    write-locks the dbs `names` in the order of their names, like commands on
+    several dbs do, so that no command is in flight on them. no connection is
+    needed for it. gets the exit stacks holding the lock of every db
+    '''
+    for attempt in range(CUT_ATTEMPTS):
+        try:
+            # releases the locks taken so far if one cannot be taken
+            with contextlib.ExitStack() as held:
+                locks = {}
+                for name in sorted(names):
+                    lock = contextlib.ExitStack()
+                    held.callback(lock.close)
+                    lock.enter_context(router.locked(name))
+                    locks[name] = lock
+                held.pop_all()
+                return locks
+        except BusyError:
+            if attempt == CUT_ATTEMPTS - 1:
+                raise
+    return None
+
+
+def _cursor(stack, conn):
+    # opens a cursor reading the db as it is now, None if the db is empty
+    cursor = stack.enter_context(conn.db().cursor())
+    try:
+        cursor.first()
+    except (KeyError, StopIteration):
+        return None
+    return cursor
+
+
+def _copy(cursor, fname):
+    db = lsm.LSM(fname, transaction_log=False, write_safety=lsm.SAFETY_OFF)
+    count = 0
+    try:
+        done = cursor is None
+        while not done:
+            batch = {}
+            while len(batch) < BATCH_SIZE:
+                batch[cursor.key()] = cursor.value()
+                try:
+                    cursor.next()
+                except StopIteration:
+                    done = True
+                    break
+            with _transaction(db):
+                db.update(batch)
+            count += len(batch)
+    finally:
+        db.close()
+    return count
+
+
+def _opencursors(router, names, locks):
+    '''
+    opens a cursor on every db of `names` while all dbs are write-locked in
+    `locks`, then releases all locks: the cursors read the dbs as they were
+    at that point. every db keeps a connection checked out until its exit
+    stack is closed, even beyond the pool limit. gets the exit stack and
+    the cursor of every db
+    '''
+    try:
+        # closes the cursors opened so far if one cannot be opened
+        with contextlib.ExitStack() as held:
+            opened = {}
+            for name in names:
+                stack = contextlib.ExitStack()
+                held.callback(stack.close)
+                conn = stack.enter_context(router.checkout(name))
+                opened[name] = stack, _cursor(stack, conn)
+            held.pop_all()
+    finally:
+        for lock in locks.values():
+            lock.close()
+    return opened
+
+
+def _copyall(router, path, names, locks):
+    '''
+    copies the dbs `names`, write-locked in `locks`, to `path`: cursors are
+    opened on all of them, which releases the locks, then the records are
+    copied db by db, closing every cursor and returning its connection once
+    its db is copied. gets the number of records of every db
+    '''
+    opened = _opencursors(router, names, locks)
+    records = {}
+    try:
+        for name, (stack, cursor) in opened.items():
+            with stack:
+                records[name] = _copy(
+                    cursor, os.path.join(path, f'{name}.{Router.EXT}'))
+    finally:
+        for stack, _ in opened.values():
+            stack.close()
+    return records
+
+
+def snapshot(instance, path, base=None):
+    '''
+    writes a snapshot of all dbs as they were at a single point in time to
+    the directory `path`, which can be used as a db directory. every db is
+    checkpointed first, then all dbs are locked at once, a cursor is opened
+    on every changed db and all locks are released before any record is
+    copied: writers only wait for the cursors to open. the connections of
+    the changed dbs stay open, beyond the pool limit, until their db is
+    copied. with `base`, the path of a previous snapshot, the files of dbs
+    which did not change since are copied from it instead, which requires
+    the transaction log to detect changes. writes from other processes
+    during the locking are not excluded.
+    returns the manifest of the snapshot
+    '''
+    router = instance.router
+    if router.layout.target is not None:
+        raise ValueError('cannot take a snapshot while resharding')
+    os.makedirs(path)
+    previous = {}
+    if base is not None:
+        with open(os.path.join(base, MANIFEST), encoding='utf-8') as f:
+            previous = json.load(f)['dbs']
+
+    # without transaction log, writes may not reach the files until later
+    logged = router.options.get('transaction_log', True)
+
+    def unchanged(name, stats):
+        return logged and previous.get(name, {}).get('stats') == stats
+
+    names = router.dbnames()
+    for name in names:
+        # checkpoints modify the files, unchanged dbs are left alone
+        fname = os.path.join(router.datapath, f'{name}.{Router.EXT}')
+        if not unchanged(name, _stats(fname)):
+            _checkpoint(router, name)
+    t = time.time()
+    locks = _lockall(router, names)
+    LOG.debug('snapshot cut took %.3fs', time.time() - t)
+    manifest = {'created': t, 'layout': router.layout.todict(),
+                'base': base, 'dbs': {}}
+    try:
+        changed = []
+        for name in names:
+            stats = _stats(os.path.join(router.datapath,
+                                        f'{name}.{Router.EXT}'))
+            manifest['dbs'][name] = {'stats': stats}
+            if unchanged(name, stats):
+                locks.pop(name).close()
+            else:
+                changed.append(name)
+        records = _copyall(router, path, changed, locks)
+    finally:
+        for lock in locks.values():
+            lock.close()
+    for name in names:
+        if name not in records:
+            # snapshots may be opened read-write, so files are not shared
+            shutil.copy2(os.path.join(base, f'{name}.{Router.EXT}'),
+                         os.path.join(path, f'{name}.{Router.EXT}'))
+            records[name] = previous[name]['records']
+        manifest['dbs'][name]['records'] = records[name]
+    with open(os.path.join(path, Router.LAYOUT), 'w', encoding='utf-8') as f:
+        json.dump(router.layout.todict(), f)
+    with open(os.path.join(path, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    return manifest
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+'''
+storage.py: provides storage profiles, i.e. presets of the options the lsm
+files are opened with
+'''
+
+import lsm
+
+# options of lsm files, see the documentation of `lsm.LSM`. sizes are in KB,
+# except `page_size` and `block_size` which only apply to new files
+OPTIONS = (
+    'autocheckpoint', 'autoflush', 'automerge', 'autowork', 'block_size',
+    'mmap', 'multiple_processes', 'page_size', 'readonly', 'transaction_log',
+    'write_safety',
+)
+
+SAFETY = {
+    'off': lsm.SAFETY_OFF,
+    'normal': lsm.SAFETY_NORMAL,
+    'full': lsm.SAFETY_FULL,
+}
+
+PROFILES = {
+    # library defaults
+    'default': {},
+    # syncs on every commit, survives power failures
+    'durable': {
+        'write_safety': lsm.SAFETY_FULL,
+        'transaction_log': True,
+    },
+    # larger in-memory trees and less frequent checkpoints, for write-heavy
+    # workloads
+    'throughput': {
+        'write_safety': lsm.SAFETY_NORMAL,
+        'autoflush': 8192,
+        'autocheckpoint': 8192,
+        'automerge': 8,
+        'block_size': 2048,
+    },
+    # fewer segments in the files, for read-heavy workloads
+    'read-heavy': {
+        'automerge': 2,
+        'mmap': True,
+    },
+    # no syncs and no transaction log, for imports which are restarted from
+    # scratch after a crash
+    'bulk-load': {
+        'write_safety': lsm.SAFETY_OFF,
+        'transaction_log': False,
+        'autoflush': 16384,
+        'autocheckpoint': 16384,
+        'automerge': 8,
+        'block_size': 4096,
+    },
+}
+
+
+def storageoptions(profile=None, options=None):
+    '''
+    gets the lsm options of the storage profile named `profile` (defaults to
+    "default") updated with `options`. `safety` is accepted for
+    `write_safety`, as one of "off", "normal" and "full". raises ValueError
+    for unknown profiles and options
+    '''
+    try:
+        result = dict(PROFILES[profile or 'default'])
+    except KeyError as e:
+        raise ValueError(f'unknown storage profile {profile!r}, available '
+                         f'profiles: {", ".join(PROFILES)}') from e
+    for name, value in (options or {}).items():
+        if name == 'safety':
+            name = 'write_safety'
+        if name == 'write_safety' and isinstance(value, str):
+            try:
+                value = SAFETY[value]
+            except KeyError as e:
+                raise ValueError(f'unknown safety level {value!r}') from e
+        if name in ('compression', 'compress'):
+            # the lsm bindings do not expose the compression hooks of lsm
+            raise ValueError('compression is not supported by lsm-db')
+        if name not in OPTIONS:
+            raise ValueError(f'unknown storage option {name!r}')
+        result[name] = value
+    return result
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+'''
+clodss: sorted set data-structure
+
+every member has two records: one mapping the member to its score, and one
+in the score index, whose key is the encoded score followed by the member so
+that the records are ordered by score then member. range queries by score or
+rank are seeks in the index
+'''
+
+import itertools
+import math
+import struct
+
+from .common import SEP, _getcount, _setcount
+
+
+def _memberkey(zkey, member):
+    return f'{zkey}{SEP}z{SEP}m{SEP}{member}'
+
+
+def _indexprefix(zkey):
+    return f'{zkey}{SEP}z{SEP}s{SEP}'.encode('utf-8')
+
+
+def _encodescore(score):
+    # hex of the bits of the double, with the sign bit flipped for positive
+    # scores and all bits flipped for negative ones, sorts like the scores
+    bits = struct.unpack('>Q', struct.pack('>d', score + 0.))[0]
+    if bits >> 63:
+        bits ^= 0xffffffffffffffff
+    else:
+        bits |= 1 << 63
+    return b'%016x' % bits
+
+
+def _decodescore(encoded):
+    bits = int(encoded, 16)
+    if bits >> 63:
+        bits &= ~(1 << 63)
+    else:
+        bits ^= 0xffffffffffffffff
+    return struct.unpack('>d', struct.pack('>Q', bits))[0]
+
+
+def _indexkey(zkey, score, member):
+    return _indexprefix(zkey) + _encodescore(score) + member.encode('utf-8')
+
+
+def _member(member):
+    if isinstance(member, bytes):
+        return member.decode('utf-8')
+    return str(member)
+
+
+def _score(score):
+    score = float(score)
+    if math.isnan(score):
+        raise ValueError('score is not a number')
+    return score
+
+
+def _bound(value):
+    # parses a score bound, "(" marks exclusive ones. returns
+    # (score, exclusive)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if isinstance(value, str) and value.startswith('('):
+        return _score(value[1:]), True
+    return _score(value), False
+
+
+def _db(instance, zkey):
+    return instance.router.connection(zkey).db()
+
+
+def _getscore(db, zkey, member):
+    try:
+        return float(db[_memberkey(zkey, member)])
+    except KeyError:
+        return None
+
+
+def _setscore(db, zkey, member, old, score):
+    if old is not None:
+        del db[_indexkey(zkey, old, member)]
+    db[_memberkey(zkey, member)] = repr(score)
+    db[_indexkey(zkey, score, member)] = b''
+
+
+def _remove(db, zkey, member, score):
+    del db[_memberkey(zkey, member)]
+    del db[_indexkey(zkey, score, member)]
+
+
+def _byscore(db, zkey, lo=(-math.inf, False), hi=(math.inf, False),
+             reverse=False):
+    '''
+    generator of the (score, member) tuples of a sorted set with scores
+    between the bounds `lo` and `hi`, see `_bound`, in ascending order or in
+    descending order if `reverse`. members are bytes
+    '''
+    prefix = _indexprefix(zkey)
+    (low, lowex), (high, highex) = lo, hi
+    if reverse:
+        records = db[prefix + _encodescore(high) + b'\xff':prefix:True]
+    else:
+        records = db[prefix + _encodescore(low):]
+    for k, _ in records:
+        if not k.startswith(prefix):
+            return
+        score = _decodescore(k[len(prefix):len(prefix) + 16])
+        below = score < low or lowex and score == low
+        above = score > high or highex and score == high
+        if below and reverse or above and not reverse:
+            return
+        if not below and not above:
+            yield score, k[len(prefix) + 16:]
+
+
+def _result(instance, items, withscores):
+    if withscores:
+        return [(instance.makevalue(m), score) for score, m in items]
+    return [instance.makevalue(m) for _, m in items]
+
+
+def zadd(  # pylint: disable=too-many-arguments
+        instance, zkey, mapping, *, nx=False, xx=False, ch=False,
+        incr=False):
+    '''
+    https://redis.io/commands/zadd
+    `mapping` maps members to scores. returns the number of members added,
+    or changed if `ch`, or the new score of the member if `incr`
+    '''
+    if nx and xx:
+        raise ValueError('`nx` and `xx` are mutually exclusive')
+    if incr and len(mapping) != 1:
+        raise ValueError('`incr` requires a single member')
+    db = _db(instance, zkey)
+    added = changed = 0
+    for member, score in mapping.items():
+        member, score = _member(member), _score(score)
+        old = _getscore(db, zkey, member)
+        if old is None and xx or old is not None and nx:
+            if incr:
+                return None
+            continue
+        if incr:
+            score = _score((old or 0.) + score)
+        if old != score:
+            _setscore(db, zkey, member, old, score)
+            changed += 1
+            added += old is None
+        if incr:
+            break
+    if added:
+        _setcount(db, zkey, 'z', _getcount(db, zkey, 'z') + added)
+    if incr:
+        return score
+    return changed if ch else added
+
+
+def zincrby(instance, zkey, amount, member):
+    'https://redis.io/commands/zincrby'
+    return zadd(instance, zkey, {member: amount}, incr=True)
+
+
+def zscore(instance, zkey, member):
+    'https://redis.io/commands/zscore'
+    return _getscore(_db(instance, zkey), zkey, _member(member))
+
+
+def zcard(instance, zkey):
+    'https://redis.io/commands/zcard'
+    return _getcount(_db(instance, zkey), zkey, 'z')
+
+
+def zcount(instance, zkey, minscore, maxscore):
+    'https://redis.io/commands/zcount'
+    db = _db(instance, zkey)
+    return sum(1 for _ in _byscore(
+        db, zkey, _bound(minscore), _bound(maxscore)))
+
+
+def zrem(instance, zkey, *members):
+    'https://redis.io/commands/zrem'
+    db = _db(instance, zkey)
+    removed = 0
+    for member in {_member(m) for m in members}:
+        score = _getscore(db, zkey, member)
+        if score is not None:
+            _remove(db, zkey, member, score)
+            removed += 1
+    if removed:
+        _setcount(db, zkey, 'z', _getcount(db, zkey, 'z') - removed)
+    return removed
+
+
+def zrange(  # pylint: disable=too-many-arguments
+        instance, zkey, start, end, *, desc=False, withscores=False):
+    '''
+    https://redis.io/commands/zrange
+    members are visited from the first of the range, ranks are counted by
+    stepping through the index
+    '''
+    db = _db(instance, zkey)
+    length = _getcount(db, zkey, 'z')
+    if start < 0:
+        start = max(length + start, 0)
+    if end < 0:
+        end = length + end
+    if start > end or start >= length:
+        return []
+    items = itertools.islice(
+        _byscore(db, zkey, reverse=desc), start, end + 1)
+    return _result(instance, items, withscores)
+
+
+def zrevrange(instance, zkey, start, end, withscores=False):
+    'https://redis.io/commands/zrevrange'
+    return zrange(instance, zkey, start, end, desc=True,
+                  withscores=withscores)
+
+
+def zrangebyscore(  # pylint: disable=too-many-arguments
+        instance, zkey, minscore, maxscore, *, start=None, num=None,
+        withscores=False):
+    '''
+    https://redis.io/commands/zrangebyscore
+    `start` and `num` select a slice of the members in range, like LIMIT
+    '''
+    db = _db(instance, zkey)
+    items = _byscore(db, zkey, _bound(minscore), _bound(maxscore))
+    if start is not None:
+        items = itertools.islice(
+            items, start, None if num is None or num < 0 else start + num)
+    return _result(instance, items, withscores)
+
+
+def zrevrangebyscore(  # pylint: disable=too-many-arguments
+        instance, zkey, maxscore, minscore, *, start=None, num=None,
+        withscores=False):
+    'https://redis.io/commands/zrevrangebyscore'
+    db = _db(instance, zkey)
+    items = _byscore(db, zkey, _bound(minscore), _bound(maxscore), True)
+    if start is not None:
+        items = itertools.islice(
+            items, start, None if num is None or num < 0 else start + num)
+    return _result(instance, items, withscores)
+
+
+def zrank(instance, zkey, member):
+    '''
+    https://redis.io/commands/zrank
+    counts the members before `member` in the index
+    '''
+    db = _db(instance, zkey)
+    member = _member(member)
+    score = _getscore(db, zkey, member)
+    if score is None:
+        return None
+    prefix = _indexprefix(zkey)
+    # slices include both ends
+    return sum(1 for _ in db[prefix:_indexkey(zkey, score, member)]) - 1
+
+
+def zrevrank(instance, zkey, member):
+    'https://redis.io/commands/zrevrank'
+    rank = zrank(instance, zkey, member)
+    if rank is None:
+        return None
+    return _getcount(_db(instance, zkey), zkey, 'z') - 1 - rank
+
+
+def _pop(instance, zkey, count, reverse):
+    db = _db(instance, zkey)
+    items = list(itertools.islice(
+        _byscore(db, zkey, reverse=reverse), 1 if count is None else count))
+    for score, member in items:
+        _remove(db, zkey, member.decode('utf-8'), score)
+    if items:
+        _setcount(db, zkey, 'z', _getcount(db, zkey, 'z') - len(items))
+    return _result(instance, items, True)
+
+
+def zpopmin(instance, zkey, count=None):
+    'https://redis.io/commands/zpopmin'
+    return _pop(instance, zkey, count, False)
+
+
+def zpopmax(instance, zkey, count=None):
+    'https://redis.io/commands/zpopmax'
+    return _pop(instance, zkey, count, True)
+
+
+def zremrangebyscore(instance, zkey, minscore, maxscore):
+    'https://redis.io/commands/zremrangebyscore'
+    db = _db(instance, zkey)
+    items = list(_byscore(db, zkey, _bound(minscore), _bound(maxscore)))
+    for score, member in items:
+        _remove(db, zkey, member.decode('utf-8'), score)
+    if items:
+        _setcount(db, zkey, 'z', _getcount(db, zkey, 'z') - len(items))
+    return len(items)
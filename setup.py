@@ -22,4 +22,10 @@ setuptools.setup(
     install_requires=[
         'lsm-db',
     ],
+    entry_points={
+        'console_scripts': [
+            'clodss-load=clodss.bulkload:main',
+            'clodss-reshard=clodss.reshard:main',
+        ],
+    },
 )
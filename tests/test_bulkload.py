@@ -0,0 +1,80 @@
+'''
+test cases for bulk loading
+'''
+
+import time
+
+import pytest
+from clodss import clodss
+from clodss import bulkload
+
+
+def test_bulkload(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path), decode_responses=True)
+    db.rpush('list', 'a')
+    db.set('string', 'old')
+    db.expire('string', 100)
+    items = [(f'key-{i}', i) for i in range(1000)]
+    items += [('map', {'f1': 1}), ('map', {'f2': 2}),
+              ('list', ['b', 'c']), ('string', 'new'),
+              ('expiring', 'value', .5)]
+    assert db.bulkload(items, chunksize=100) == 1005
+    assert db.get('key-123') == '123'
+    assert db.hgetall('map') == {'f1': '1', 'f2': '2'}
+    assert db.hlen('map') == 2
+    assert db.lrange('list', 0, -1) == ['a', 'b', 'c']
+    assert db.llen('list') == 3
+    assert db.get('string') == 'new'
+    assert db.get('expiring') == 'value'
+    time.sleep(.6)
+    assert db.get('expiring') is None
+    assert len(list(db.keys())) == 1003
+
+
+def test_bulkload_type_conflict(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path), decode_responses=True)
+    db.rpush('list', 'a')
+    with pytest.raises(ValueError):
+        db.bulkload([('list', 'string')])
+    assert db.lrange('list', 0, -1) == ['a']
+
+
+def test_bulkload_ttl_only(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path), decode_responses=True)
+    db.set('existing', 'v')
+    items = [('ghost', None, .3), ('existing', None, .3),
+             ('new', 'v'), ('new', None, .3)]
+    assert db.bulkload(items) == 4
+    db.set('ghost', 'v')
+    time.sleep(.4)
+    fresh = clodss.StrictRedis(str(tmp_path), decode_responses=True)
+    assert fresh.get('ghost') == 'v'
+    assert fresh.get('existing') is None
+    assert fresh.get('new') is None
+
+
+def test_bulkload_files(tmp_path):
+    (tmp_path / 'data.jsonl').write_text(
+        '{"key": "j1", "value": "v1"}\n'
+        '{"key": "j2", "value": {"f": "v"}, "ttl": 100}\n')
+    (tmp_path / 'data.csv').write_text('c1,"v,1"\nc2,v2,100\n')
+    (tmp_path / 'data.resp').write_bytes(
+        b'*3\r\n$3\r\nSET\r\n$2\r\nr1\r\n$2\r\nv1\r\n'
+        b'*4\r\n$5\r\nRPUSH\r\n$2\r\nr2\r\n$1\r\na\r\n$1\r\nb\r\n'
+        b'*3\r\n$6\r\nEXPIRE\r\n$2\r\nr1\r\n$3\r\n100\r\n'
+        b'*6\r\n$3\r\nSET\r\n$2\r\nr3\r\n$1\r\nv\r\n$2\r\nNX\r\n'
+        b'$2\r\nEX\r\n$2\r\n10\r\n')
+    for name in ('data.jsonl', 'data.csv', 'data.resp'):
+        bulkload.main([str(tmp_path / 'db'), str(tmp_path / name)])
+    db = clodss.StrictRedis(str(tmp_path / 'db'), decode_responses=True)
+    assert db.get('j1') == 'v1'
+    assert db.hget('j2', 'f') == 'v'
+    assert db.get('c1') == 'v,1'
+    assert db.persist('c2') == 1
+    assert db.lrange('r2', 0, -1) == ['a', 'b']
+    assert db.persist('r1') == 1
+    assert db.get('r3') == 'v'
+    assert db.persist('r3') == 1
+    with pytest.raises(SystemExit):
+        bulkload.main([str(tmp_path / 'db'), str(tmp_path / 'data.csv'),
+                       '--profile', 'bulkload'])
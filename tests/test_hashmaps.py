@@ -3,7 +3,9 @@ test cases for keys functionality
 '''
 
 from clodss import clodss
+from clodss.common import SEP
 import os
+import pytest
 
 db = clodss.StrictRedis(
     os.path.realpath(os.path.dirname(__file__) + '/../data'),
@@ -88,3 +90,115 @@ def test_hmget():
     db.delete(hkey)
     db.hmset(hkey, {'1': 'v1', '2': 'v2', '3': 'v3'})
     assert db.hmget(hkey, *range(5)) == [None, 'v1', 'v2', 'v3', None]
+
+
+def test_hset_mapping():
+    db.delete(hkey)
+    assert db.hset(hkey, mapping={'a': 1, 'b': 2}) == 2
+    assert db.hset(hkey, 'c', 3, mapping={'a': 4}) == 1
+    assert db.hgetall(hkey) == {'a': '4', 'b': '2', 'c': '3'}
+    assert db.hmset(hkey, {'d': 5}) is True
+
+
+def test_hmget_many():
+    db.delete(hkey)
+    db.hset(hkey, mapping={f'f{i:03d}': i for i in range(0, 200, 2)})
+    fields = [f'f{i:03d}' for i in range(200, -1, -1)]
+    expected = [str(i) if i % 2 == 0 and i < 200 else None
+                for i in range(200, -1, -1)]
+    assert db.hmget(hkey, fields) == expected
+    sparse = fields[::37] + ['f010', 'zzz']
+    assert db.hmget(hkey, *sparse) == [
+        db.hget(hkey, field) for field in sparse]
+
+
+def test_hlen():
+    db.delete(hkey)
+    assert db.hlen(hkey) == 0
+    db.hset(hkey, mapping={'a': 1, 'b': 2})
+    db.hset(hkey, 'a', 3)
+    assert db.hlen(hkey) == 2
+    assert db.hdel(hkey, 'a', 'c') == 1
+    assert db.hlen(hkey) == 1
+    assert db.hdel(hkey, 'b') == 1
+    assert db.hlen(hkey) == 0
+    assert db.keydtype(hkey) is None
+
+
+def test_hlen_legacy():
+    db.delete(hkey)
+    with db.router.pinned(hkey) as conn:
+        conn.db().update({f'{hkey}{SEP}h{SEP}{f}': 'v' for f in 'abc'})
+    db.knownkeys = {}
+    assert db.hlen(hkey) == 3
+    db.hset(hkey, 'd', 'v')
+    assert db.hlen(hkey) == 4
+    assert sorted(db.hkeys(hkey)) == ['a', 'b', 'c', 'd']
+
+
+def test_hexists_hstrlen():
+    db.delete(hkey)
+    db.hset(hkey, 'a', 'value')
+    assert db.hexists(hkey, 'a')
+    assert not db.hexists(hkey, 'b')
+    assert db.hstrlen(hkey, 'a') == 5
+    assert db.hstrlen(hkey, 'b') == 0
+
+
+def test_hsetnx():
+    db.delete(hkey)
+    assert db.hsetnx(hkey, 'a', 1) == 1
+    assert db.hsetnx(hkey, 'a', 2) == 0
+    assert db.hget(hkey, 'a') == '1'
+    assert db.hlen(hkey) == 1
+
+
+def test_hincrby():
+    db.delete(hkey)
+    assert db.hincrby(hkey, 'n') == 1
+    assert db.hincrby(hkey, 'n', 5) == 6
+    assert db.hincrbyfloat(hkey, 'f', 1.5) == 1.5
+    assert db.hincrbyfloat(hkey, 'n', '.5') == 6.5
+    assert db.hget(hkey, 'n') == '6.5'
+    assert db.hlen(hkey) == 2
+    db.hset(hkey, 's', 'text')
+    with pytest.raises(TypeError):
+        db.hincrby(hkey, 's')
+
+
+def test_hscan():
+    db.delete(hkey)
+    fields = {f'f{i:03d}': str(i) for i in range(250)}
+    fields['\0null'] = 'n'
+    db.hset(hkey, mapping=fields)
+    seen = {}
+    cursor, calls = 0, 0
+    while True:
+        cursor, items = db.hscan(hkey, cursor, count=100)
+        assert len(items) <= 100
+        seen.update(items)
+        calls += 1
+        if cursor == 0:
+            break
+    assert seen == fields
+    assert calls == 3
+    # seeks to the literal prefix of the pattern
+    assert db.hscan(hkey, match='f1?9', count=10)[1] == {'f109': '109'}
+    matched = dict(db.hscan_iter(hkey, match='f1?9', count=7))
+    assert matched == {f'f1{i}9': f'1{i}9' for i in range(10)}
+    with pytest.raises(ValueError):
+        db.hscan(hkey, 12345)
+
+
+def test_hash_stream():
+    db.delete(hkey)
+    fields = {f'f{i:04d}': str(i) for i in range(2500)}
+    db.hset(hkey, mapping=fields)
+    stream = db.hgetall(hkey, stream=True)
+    assert next(stream) == ('f0000', '0')
+    # the hash is not locked between batches
+    db.hset(hkey, 'zzz', 'last')
+    del fields['f0000']
+    assert dict(stream) == {**fields, 'zzz': 'last'}
+    assert list(db.hkeys(hkey, stream=True)) == db.hkeys(hkey)
+    assert list(db.hvalues(hkey, stream=True)) == db.hvalues(hkey)
@@ -3,11 +3,14 @@ test cases for keys functionality
 '''
 
 import os
+import threading
 import time
 
+import lsm
 import pytest
 from clodss import clodss
 from clodss.common import SEP
+from clodss.expiry import ActiveExpiry
 
 db = clodss.StrictRedis(
     os.path.realpath(os.path.dirname(__file__) + '/../data'),
@@ -147,6 +150,76 @@ def test_decrby_nonint():
         db.decrby(key, 44)
 
 
+def test_incrbyfloat():
+    key = 'key_incrbyfloat'
+    db.set(key, '10.5')
+    assert db.incrbyfloat(key, 0.1) == 10.6
+    assert db.incrbyfloat(key, -5) == 5.6
+    assert db.get(key) == '5.6'
+    db.delete(key)
+    assert db.incrbyfloat(key, 3) == 3
+    assert db.get(key) == '3'
+
+
+def test_incr_concurrent():
+    key = 'key_incr_concurrent'
+    db.delete(key)
+
+    def count():
+        for _ in range(200):
+            db.incr(key)
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert db.get(key) == '800'
+
+
+def test_counterbuffer():
+    keys = [f'key_counterbuffer_{i}' for i in range(5)]
+    for key in keys:
+        db.set(key, 1)
+    with db.counterbuffer(interval=0) as counters:
+        for _ in range(100):
+            for key in keys:
+                counters.incr(key)
+        counters.decrby(keys[0], 50)
+        assert counters.pending(keys[0]) == 50
+        assert db.get(keys[0]) == '1'
+        assert counters.flush()[keys[0]] == 51
+        assert counters.pending(keys[0]) == 0
+        counters.incr(keys[1])
+    assert [db.get(key) for key in keys] == ['51', '102', '101', '101', '101']
+
+
+def test_counterbuffer_periodic():
+    key = 'key_counterbuffer_periodic'
+    db.delete(key)
+    counters = db.counterbuffer(interval=.05)
+    counters.incrbyfloat(key, .5)
+    time.sleep(.3)
+    assert db.get(key) == '0.5'
+    counters.close()
+
+
+def test_counterbuffer_failure():
+    good = 'key_counterbuffer_good'
+    bad = next(f'key_counterbuffer_bad_{i}' for i in range(1000)
+               if db.router.shard(f'key_counterbuffer_bad_{i}')
+               == db.router.shard(good))
+    db.delete(good)
+    db.set(bad, 'text')
+    counters = db.counterbuffer(interval=0)
+    counters.incr(good, 5)
+    counters.incr(bad)
+    with pytest.raises(TypeError):
+        counters.flush()
+    assert db.get(good) == '5'
+    assert counters.pending(good) == 0
+    assert db.get(bad) == 'text'
+
+
 def test_expire_nonexitent():
     assert db.expire('non-existing', 5) == 0
 
@@ -190,6 +263,10 @@ def test_flushdb():
         db.lpush(f'list-{i}', i)
     db.flushdb()
     assert len(list(db.keys())) == 0
+    db.set('key', 'value')
+    db.flushdb(asynchronous=True)
+    assert db.get('key') is None
+    assert len(list(db.keys())) == 0
 
 
 def test_keys():
@@ -212,10 +289,228 @@ def test_scan():
         db.hset(f'map-{i}', 'key', i)
         db.lpush(f'list-{i}', i)
         keys |= {f'bytes-{i}', f'map-{i}', f'list-{i}'}
-    cur, res = db.scan()
+    cur, res = db.scan(count=1000)
     assert set(res) == keys
-    assert cur == True
-    assert db.scan(cur) == []
-    _, res = db.scan(match='map-*')
+    assert cur == 0
+    _, res = db.scan(match='map-*', count=1000)
     assert set(res) == {k for k in keys if k.startswith('map-')}
-    #assert set(db.keys('map-*')) == {k for k in keys if k.startswith('map-')}
+
+
+def test_scan_cursor():
+    db.flushdb()
+    keys = set()
+    for i in range(20):
+        db.set(f'bytes-{i}', i)
+        db.hmset(f'map-{i}', {'a': 1, 'b': 2, 'c': 3})
+        db.rpush(f'list-{i}', 1, 2, 3)
+        keys |= {f'bytes-{i}', f'map-{i}', f'list-{i}'}
+    found = []
+    cur, ncalls = 0, 0
+    while True:
+        cur, res = db.scan(cur, count=5)
+        found += res
+        ncalls += 1
+        if cur == 0:
+            break
+        assert isinstance(cur, int)
+    assert sorted(found) == sorted(keys)
+    assert ncalls > 10
+    with pytest.raises(ValueError):
+        db.scan(12345)
+
+
+def test_keys_patterns():
+    db.flushdb()
+    for key in ('user:1:name', 'user:12:name', 'user:2:age', 'users', 'u?er'):
+        db.set(key, 1)
+    db.rpush('user:1:list', *range(100))
+    db.hset('user:3:map', 'user:1:name', 1)
+    assert set(db.keys('user:1*')) == {'user:1:name', 'user:12:name',
+                                      'user:1:list'}
+    assert set(db.keys('user:?:*')) == {'user:1:name', 'user:2:age',
+                                       'user:1:list', 'user:3:map'}
+    assert set(db.keys('user:[13]:*')) == {'user:1:name', 'user:1:list',
+                                          'user:3:map'}
+    assert set(db.keys('user:[!13]:*')) == {'user:2:age'}
+    assert set(db.keys('u\\?er')) == {'u?er'}
+    assert set(db.keys('user')) == set()
+
+
+@pytest.mark.parametrize('processes', (False, True))
+def test_keys_parallel(processes):
+    pdb = clodss.StrictRedis(
+        os.path.realpath(os.path.dirname(__file__) + '/../data'),
+        db=1, decode_responses=True, scan_workers=4,
+        scan_processes=processes)
+    pdb.flushdb()
+    keys = set()
+    for i in range(30):
+        pdb.set(f'bytes-{i}', i)
+        pdb.rpush(f'list-{i}', i)
+        keys |= {f'bytes-{i}', f'list-{i}'}
+    pdb.set('expiring', 1)
+    pdb.expire('expiring', .01)
+    time.sleep(.02)
+    assert set(pdb.keys()) == keys
+    assert list(pdb.keys(ordered=True)) == sorted(keys)
+    assert list(pdb.keys('list-1*', ordered=True)) == sorted(
+        k for k in keys if k.startswith('list-1'))
+    assert pdb.get('expiring') is None
+
+
+def test_active_expire():
+    edb = clodss.StrictRedis(
+        os.path.realpath(os.path.dirname(__file__) + '/../data'),
+        db=2, decode_responses=True, active_expire_interval=.05)
+    key = 'key_active_expire'
+    edb.rpush(key, *range(10))
+    edb.expire(key, .05)
+    time.sleep(.5)
+    edb.activeexpiry.stop()
+    with edb.router.pinned(key) as conn:
+        assert not any(k.startswith(key.encode('utf-8'))
+                       for k, _ in conn.db()[key:])
+        assert f'{SEP}expire{SEP}{key}' not in conn.db()
+
+
+def test_active_expire_legacy(tmp_path, monkeypatch):
+    monkeypatch.setattr('clodss.expiry.INDEX_BATCH_SIZE', 1)
+    edb = clodss.StrictRedis(str(tmp_path), spread_factor=1,
+                             decode_responses=True)
+    keys = [f'legacy-{i}' for i in range(10)]
+    for key in keys:
+        edb.set(key, 1)
+        with edb.router.pinned(key) as conn:
+            # expiry recorded before the expiry index was introduced
+            conn.db()[f'{SEP}expire{SEP}{key}'] = str(time.time() - 1)
+    expiry = ActiveExpiry(edb, interval=10)
+    for _ in keys:
+        expiry.cycle()
+    for key in keys:
+        with edb.router.pinned(key) as conn:
+            assert key not in conn.db()
+            assert f'{SEP}expire{SEP}{key}' not in conn.db()
+
+
+def test_expire_reset():
+    key = 'key_expire_reset'
+    db.set(key, 1)
+    db.expire(key, .05)
+    db.expire(key, 5)
+    time.sleep(.3)
+    assert db.get(key) == '1'
+    db.delete(key)
+    db.set(key, 2)
+    time.sleep(.1)
+    assert db.get(key) == '2'
+
+
+def test_keycache():
+    key = 'key_cache'
+    db.delete(key)
+    assert key not in db.knownkeys
+    db.set(key, 1)
+    assert db.knownkeys[key][:2] == ('', False)
+    assert db.get(key) == '1'
+    db.expire(key, .1)
+    assert db.get(key) == '1'
+    assert db.knownkeys[key][:2] == ('', True)
+    time.sleep(.15)
+    assert db.get(key) is None
+    assert key not in db.knownkeys
+    db.rpush(key, 1)
+    db.rpop(key)
+    db.set(key, 2)
+    assert db.get(key) == '2'
+
+
+def test_keycache_other_instance():
+    key = 'key_cache_other'
+    other = clodss.StrictRedis(
+        os.path.realpath(os.path.dirname(__file__) + '/../data'),
+        decode_responses=True)
+    db.set(key, 1)
+    assert db.get(key) == '1'
+    other.expire(key, .1)
+    time.sleep(.15)
+    assert db.get(key) is None
+    assert other.get(key) is None
+
+
+def test_keycache_bounded():
+    cdb = clodss.StrictRedis(
+        os.path.realpath(os.path.dirname(__file__) + '/../data'),
+        decode_responses=True, keycache_size=10)
+    for i in range(20):
+        cdb.set(f'key_cache-{i}', i)
+    assert list(cdb.knownkeys) == [f'key_cache-{i}' for i in range(10, 20)]
+
+
+def test_error_not_retried():
+    key = 'key_error_not_retried'
+    db.set(key, 'ab')
+    t = time.time()
+    with pytest.raises(TypeError):
+        db.incr(key)
+    assert time.time() - t < .1
+
+
+def test_busy_retried():
+    key = 'key_busy_retried'
+    db.set(key, 1)
+    with db.router.pinned(key) as conn:
+        other = lsm.LSM(conn.fname)
+    other.begin()
+    other['something'] = 'in the way'
+    writer = threading.Thread(target=db.set, args=(key, 2))
+    writer.start()
+    time.sleep(.05)
+    other.rollback(False)
+    writer.join()
+    assert db.get(key) == '2'
+    retries, giveups = db.retrystats()['commands']['set']
+    assert retries > 0 and giveups == 0
+
+
+def test_retrystats_threads(monkeypatch):
+    counted = clodss.StrictRedis(
+        os.path.realpath(os.path.dirname(__file__) + '/../data'))
+    perf_counter = time.perf_counter
+
+    def switching(*args):
+        # lets other threads run in the middle of the updates
+        time.sleep(0)
+        return perf_counter(*args)
+    monkeypatch.setattr('clodss.metrics.Metrics.retry',
+                        lambda self, command: switching())
+    monkeypatch.setattr('clodss.router.time.perf_counter', switching)
+
+    def count():
+        for _ in range(500):
+            counted.countretry('threaded', 1)
+            with counted.router.locked('threaded', False):
+                pass
+    threads = [threading.Thread(target=count) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = counted.retrystats()
+    assert stats['commands']['threaded'] == (4000, 0)
+    assert stats['locks']['threaded'][0] == 4000
+
+
+def test_concurrent_writers():
+    key = 'key_concurrent_writers'
+    db.delete(key)
+
+    def push():
+        for i in range(50):
+            db.rpush(key, i)
+    threads = [threading.Thread(target=push) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert db.llen(key) == 200
+    assert len(db.lrange(key, 0, -1)) == 200
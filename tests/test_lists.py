@@ -2,8 +2,13 @@
 test cases for lists functionality
 '''
 import os
+import subprocess
+import sys
+import threading
+import time
 import pytest
 from clodss import clodss
+from clodss.lists import _compact
 
 db = clodss.StrictRedis(
     os.path.realpath(os.path.dirname(__file__) + '/../data'),
@@ -255,3 +260,166 @@ def test_ltrim(rng, expected):
     resetlist(key)
     db.ltrim(key, *rng)
     assert getlist(key) == expected
+
+
+def test_llen_after_updates():
+    resetlist(key)
+    db.rpush(key, '+01')
+    assert db.lrem(key, 0, '+01') == 2
+    assert db.llen(key) == 19
+    db.ltrim(key, 2, -3)
+    assert db.llen(key) == 15
+    assert db.lindex(key, 0) == '-08'
+    assert db.lindex(key, -1) == '+08'
+    for _ in range(15):
+        db.lpop(key)
+    assert db.llen(key) == 0
+    assert db.lpop(key) is None
+    db.set(key, 'not a list anymore')
+    db.delete(key)
+
+
+def test_lrem_ends():
+    resetlist(key)
+    db.lrem(key, 1, '-10')
+    db.lrem(key, -1, '+10')
+    assert db.lindex(key, 0) == '-09'
+    assert db.lindex(key, -1) == '+09'
+    assert db.lpop(key) == '-09'
+    assert db.rpop(key) == '+09'
+    assert db.llen(key) == 16
+
+
+def test_lindex_holes():
+    resetlist(key)
+    db.lrem(key, 0, '-05')
+    db.lrem(key, 0, '+05')
+    expected = [f'-{i:02d}' for i in range(10, 0, -1) if i != 5] + \
+        [f'+{i:02d}' for i in range(1, 11) if i != 5]
+    assert getlist(key) == expected
+    assert db.lindex(key, -2) == '+09'
+    assert db.lrange(key, 3, 12) == expected[3:13]
+    time.sleep(.2)
+    assert getlist(key) == expected
+    db.rpush(key, '+11')
+    assert db.lrange(key, -3, -1) == ['+09', '+10', '+11']
+
+
+def test_push_multiple():
+    db.delete(key)
+    assert db.rpush(key, 'c', 'd', 'e') == 3
+    assert db.lpush(key, 'b', 'a') == 5
+    assert db.lrange(key, 0, -1) == ['a', 'b', 'c', 'd', 'e']
+    with pytest.raises(TypeError):
+        db.rpush(key)
+
+
+def test_pop_count():
+    resetlist(key)
+    assert db.lpop(key, 3) == ['-10', '-09', '-08']
+    assert db.rpop(key, 2) == ['+10', '+09']
+    assert db.lpop(key, 0) == []
+    assert db.llen(key) == 15
+    assert db.lindex(key, 0) == '-07'
+    assert db.lindex(key, -1) == '+08'
+    assert db.rpop(key, 100)[-1] == '-07'
+    assert db.llen(key) == 0
+    assert db.lpop(key, 2) is None
+
+
+def test_lmove():
+    db.delete(key)
+    db.delete('other-list')
+    db.rpush(key, 'a', 'b', 'c')
+    assert db.lmove(key, 'other-list') == 'a'
+    assert db.lmove(key, 'other-list', 'RIGHT', 'LEFT') == 'c'
+    assert db.lrange('other-list', 0, -1) == ['c', 'a']
+    assert db.lrange(key, 0, -1) == ['b']
+
+
+def test_blpop_timeout():
+    db.delete(key)
+    t = time.time()
+    assert db.blpop(key, .2) is None
+    assert time.time() - t >= .2
+
+
+def test_blpop_existing():
+    db.delete(key)
+    db.rpush(key, 'a', 'b')
+    assert db.blpop(['nonexisting-list', key], 1) == (key, 'a')
+    assert db.brpop(key, 1) == (key, 'b')
+
+
+def test_blpop_wakeup():
+    db.delete(key)
+    pusher = threading.Timer(.1, db.rpush, (key, 'woken'))
+    pusher.start()
+    t = time.time()
+    assert db.blpop(key, 0) == (key, 'woken')
+    assert time.time() - t < 1
+    pusher.join()
+
+
+def test_blpop_wakeup_other_process():
+    db.delete(key)
+    script = (
+        'import time; from clodss import clodss; '
+        f'db = clodss.StrictRedis({os.path.dirname(db.dbpath())!r}); '
+        f'time.sleep(.2); db.lpush({key!r}, "from-afar")'
+    )
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(
+        os.path.realpath(__file__))))
+    pusher = subprocess.Popen([sys.executable, '-c', script], env=env)
+    assert db.blpop(key, 5) == (key, 'from-afar')
+    pusher.wait()
+
+
+def test_blmove():
+    db.delete(key)
+    db.delete('other-list')
+    pusher = threading.Timer(.1, db.rpush, (key, 'moved'))
+    pusher.start()
+    assert db.blmove(key, 'other-list', 1) == 'moved'
+    assert db.lrange('other-list', 0, -1) == ['moved']
+    pusher.join()
+    assert db.blmove(key, 'other-list', .1) is None
+
+
+def test_compact_chunks():
+    resetlist(key)
+    db.lrem(key, 0, '-05')
+    db.lrem(key, 0, '+05')
+    expected = getlist(key)
+    _compact(db, key, chunksize=4)
+    assert getlist(key) == expected
+    assert db.lindex(key, -1) == '+10'
+    db.rpush(key, 'last')
+    assert db.lindex(key, -1) == 'last'
+
+
+def test_lmove_lock_order(tmp_path):
+    # opposite moves between two dbs lock them in the same order
+    ldb = clodss.StrictRedis(str(tmp_path), decode_responses=True)
+    first = 'left'
+    second = next(f'right-{i}' for i in range(100)
+                  if ldb.router.shard(f'right-{i}') != ldb.router.shard(first))
+    ldb.rpush(first, *range(200))
+    ldb.rpush(second, *range(200))
+
+    def move(src, dest):
+        for _ in range(200):
+            ldb.lmove(src, dest)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=move, args=keys)
+                   for keys in ((first, second), (second, first))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert ldb.llen(first) + ldb.llen(second) == 400
+    assert ldb.metrics.snapshot()['commands']['lmove']['retries'] == 0
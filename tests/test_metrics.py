@@ -0,0 +1,73 @@
+'''
+test cases for metrics
+'''
+
+import random
+
+from clodss import clodss
+from clodss.metrics import Histogram, Metrics, prometheus
+
+
+def test_histogram():
+    histogram = Histogram()
+    values = [random.expovariate(1000) for _ in range(10000)]
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    for q in (.5, .99, .999):
+        expected = values[int(q * len(values)) - 1]
+        assert abs(histogram.quantile(q) - expected) <= expected / 32
+    assert histogram.quantile(1) == values[-1]
+    assert abs(histogram.mean() - sum(values) / len(values)) < 1e-9
+
+
+def test_metrics(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path), decode_responses=True)
+    calls = []
+    db.metrics.addhook(lambda *args: calls.append(args))
+    db.set('key', 'value')
+    assert db.get('key') == 'value'
+    db.rpush('list', 'a', 'bc')
+    assert db.lrange('list', 0, -1) == ['a', 'bc']
+    try:
+        db.lpush('key', 'x')
+    except ValueError:
+        pass
+    snapshot = db.metrics.snapshot()
+    commands = snapshot['commands']
+    assert commands['set']['count'] == 1
+    assert commands['set']['written'] == 5
+    assert commands['get']['read'] == 5
+    assert commands['lrange']['read'] == 3
+    assert commands['lpush']['errors'] == 1
+    assert 0 < commands['get']['p50'] <= commands['get']['p999']
+    shard = db.router.shard('key')
+    assert snapshot['dbs'][shard]['set'] == 1
+    assert calls[0][:2] == ('set', shard)
+    assert len(calls) == 5
+    assert db.stats()['get'][1] == 1
+
+    text = db.metrics.export()
+    assert 'clodss_command_duration_seconds_count{command="get"} 1' in text
+    assert 'clodss_command_errors_total{command="lpush"} 1' in text
+    assert f'clodss_db_commands_total{{db="{shard}",command="set"}} 1' in text
+    assert db.metrics.export(lambda s: s) == db.metrics.snapshot()
+    assert prometheus(Metrics().snapshot()).startswith('# HELP')
+
+
+def test_metrics_sampling():
+    metrics = Metrics()
+    for _ in range(40):
+        metrics.record('get', 'ab', .001, False, result='value')
+    assert metrics.snapshot()['commands']['get']['read'] == 200
+    calls = []
+    metrics.addhook(lambda *args: calls.append(args[-1]))
+    metrics.record('get', 'ab', .001, False, result='other value')
+    assert calls == [11]
+
+
+def test_metrics_disabled(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path), benchmark=False)
+    db.set('key', 'value')
+    assert db.metrics is None
+    assert db.stats() is None
@@ -0,0 +1,91 @@
+'''
+test cases for pipeline functionality
+'''
+
+import os
+import threading
+import time
+
+import lsm
+import pytest
+from clodss import clodss
+
+db = clodss.StrictRedis(
+    os.path.realpath(os.path.dirname(__file__) + '/../data'),
+    decode_responses=True
+)
+
+
+def test_pipeline_results_order():
+    for i in range(20):
+        db.delete(f'pipe-{i}')
+    pipe = db.pipeline()
+    for i in range(20):
+        pipe.set(f'pipe-{i}', i)
+    for i in range(20):
+        pipe.get(f'pipe-{i}')
+    assert len(pipe) == 40
+    results = pipe.execute()
+    assert results[20:] == [str(i) for i in range(20)]
+    assert len(pipe) == 0
+    assert db.get('pipe-7') == '7'
+
+
+def test_pipeline_mixed_types():
+    db.delete('pipe-list')
+    db.delete('pipe-map')
+    with db.pipeline() as pipe:
+        pipe.rpush('pipe-list', 'a').rpush('pipe-list', 'b')
+        pipe.hset('pipe-map', 'k', 'v')
+        pipe.lrange('pipe-list', 0, -1)
+        results = pipe.execute()
+    assert results[-1] == ['a', 'b']
+    assert db.hget('pipe-map', 'k') == 'v'
+
+
+def test_pipeline_no_transaction():
+    db.delete('pipe-notx')
+    pipe = db.pipeline(transaction=False)
+    pipe.incr('pipe-notx').incr('pipe-notx')
+    assert pipe.execute() == [1, 2]
+
+
+def test_pipeline_rollback():
+    db.delete('pipe-rollback')
+    pipe = db.pipeline()
+    pipe.set('pipe-rollback', 'a')
+    pipe.hset('pipe-rollback', 'k', 'v')
+    with pytest.raises(ValueError):
+        pipe.execute()
+    assert db.get('pipe-rollback') is None
+
+
+def test_pipeline_busy_retried():
+    key = 'pipe-busy'
+    db.set(key, 1)
+    commands = db.metrics.snapshot()['commands']
+    before = commands.get('incr', {}).get('count', 0)
+    with db.router.pinned(key) as conn:
+        other = lsm.LSM(conn.fname)
+    other.begin()
+    other['something'] = 'in the way'
+    pipe = db.pipeline(transaction=False)
+    pipe.incr(key).incr(key)
+    writer = threading.Thread(target=pipe.execute)
+    writer.start()
+    time.sleep(.05)
+    other.rollback(False)
+    writer.join()
+    assert db.get(key) == '3'
+    assert db.retrystats()['commands']['pipeline'][0] > 0
+    assert db.metrics.snapshot()['commands']['incr']['count'] == before + 2
+
+
+def test_pipeline_invalid():
+    pipe = db.pipeline()
+    with pytest.raises(AttributeError):
+        pipe.nonexisting('key')
+    with pytest.raises(ValueError):
+        pipe.keys()
+    with pytest.raises(TypeError):
+        pipe.get()
@@ -0,0 +1,127 @@
+'''
+test cases for resharding
+'''
+
+import threading
+import time
+
+import pytest
+from clodss import clodss
+from clodss import reshard
+from clodss.router import Layout, Router
+
+
+def _fill(db):
+    for i in range(200):
+        db.set(f'str-{i}', i)
+    for i in range(10):
+        db.rpush(f'list-{i}', *range(10))
+        db.hset(f'map-{i}', 'field', i)
+    db.set('expiring', 'value')
+    db.expire('expiring', 100)
+
+
+def _check(db):
+    assert db.get('str-123') == '123'
+    assert db.lrange('list-3', 0, -1) == [str(i) for i in range(10)]
+    assert db.hget('map-7', 'field') == '7'
+    assert db.persist('expiring') == 1
+    assert len(list(db.keys())) == 221
+
+
+def test_reshard_split_merge(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path), spread_factor=1,
+                            decode_responses=True)
+    _fill(db)
+    db.reshard(2, batchsize=50)
+    assert db.router.factor == 2
+    assert all(len(name) == 2 for name in db.router.dbnames(allnames=True))
+    _check(db)
+    db.expire('expiring', 100)
+    db.reshard(1, batchsize=50)
+    assert db.router.dbnames(allnames=True) == list('0123456789abcdef')
+    _check(db)
+
+
+def test_reshard_layout_kept(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path), spread_factor=1,
+                            decode_responses=True)
+    _fill(db)
+    db.reshard(2)
+    db.router.close()
+    db = clodss.StrictRedis(str(tmp_path), decode_responses=True,
+                            spread_factor=3)
+    assert db.router.factor == 2
+    _check(db)
+
+
+def test_reshard_concurrent_writes(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path), spread_factor=1,
+                            decode_responses=True)
+    _fill(db)
+    stopped = threading.Event()
+    written = []
+
+    def write():
+        while not stopped.is_set():
+            i = len(written)
+            db.set(f'written-{i}', i)
+            db.incr('str-5')
+            written.append(i)
+    writer = threading.Thread(target=write)
+    writer.start()
+    db.reshard(2, batchsize=20)
+    stopped.set()
+    writer.join()
+    assert written
+    assert all(db.get(f'written-{i}') == str(i) for i in written)
+    assert db.get('str-5') == str(5 + len(written))
+
+
+def test_reshard_resume(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path), spread_factor=1,
+                            decode_responses=True)
+    _fill(db)
+    name = db.router.shard('str-1')
+    db.router.setlayout(Layout(1, 2))
+    db.router.startcopy(name)
+    reshard._copy(db.router, name, 1000)
+    # interrupted after the copy, the key is deleted from the old db only
+    db.router.close()
+    db = clodss.StrictRedis(str(tmp_path), decode_responses=True)
+    db.delete('str-1')
+    db.router.close()
+    db = clodss.StrictRedis(str(tmp_path), decode_responses=True)
+    assert db.router.layout.current == name
+    with pytest.raises(ValueError):
+        db.reshard(3)
+    db.reshard(2)
+    assert db.get('str-1') is None
+    assert db.get('str-2') == '2'
+
+
+def test_reshard_scan(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path), spread_factor=2,
+                            decode_responses=True)
+    _fill(db)
+    cursor, found = db.scan(count=100)
+    db.reshard(1)
+    while cursor:
+        cursor, keys = db.scan(cursor, count=100)
+        found.extend(keys)
+    assert len(set(found)) == 221
+
+
+def test_reshard_other_process(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path), spread_factor=1,
+                            decode_responses=True)
+    _fill(db)
+    assert db.get('str-123') == '123'
+    # the command line tool uses a router of its own
+    reshard.main([str(tmp_path), '2', '--batch-size', '50'])
+    time.sleep(Router.GENERATION_CHECK_INTERVAL)
+    _check(db)
+    assert db.router.factor == 2
+    db.set('new', 'value')
+    db.router.close()
+    assert clodss.StrictRedis(str(tmp_path)).get('new') == b'value'
@@ -0,0 +1,182 @@
+'''
+test cases for routing and connection pooling
+'''
+
+import os
+import threading
+import time
+
+import lsm
+import pytest
+from clodss.common import BusyError
+from clodss.router import Router
+from clodss.storage import storageoptions
+
+
+def test_checkout_exclusive(tmp_path):
+    router = Router(str(tmp_path), poolsize=2)
+    with router.checkout('ab') as first:
+        with router.checkout('ab') as nested:
+            assert nested is first
+            assert router.dbconnection('ab') is first
+        seen = []
+
+        def other():
+            with router.checkout('ab') as conn:
+                seen.append(conn)
+        worker = threading.Thread(target=other)
+        worker.start()
+        worker.join()
+        assert seen[0] is not first
+    status = router.poolstatus()['ab']
+    assert status['size'] == 2
+    assert status['checkouts'] == 2
+
+
+def test_checkout_on_demand(tmp_path):
+    router = Router(str(tmp_path), poolsize=3)
+    for _ in range(5):
+        with router.checkout('ab'):
+            pass
+    assert router.poolstatus()['ab']['size'] == 1
+    assert router.poolstatus()['ab']['inuse'] == 0
+
+
+def test_checkout_waits(tmp_path):
+    router = Router(str(tmp_path), poolsize=1)
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with router.checkout('ab'):
+            held.set()
+            release.wait()
+    holder = threading.Thread(target=hold)
+    holder.start()
+    held.wait()
+    assert router.poolstatus()['ab']['inuse'] == 1
+    threading.Timer(.1, release.set).start()
+    t = time.perf_counter()
+    with router.checkout('ab'):
+        assert time.perf_counter() - t >= .09
+    holder.join()
+    assert router.poolstatus()['ab']['waittime'] >= .09
+
+
+def test_checkout_timeout(tmp_path):
+    router = Router(str(tmp_path), poolsize=1)
+    router.LOCK_TIMEOUT = .1
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with router.checkout('ab'):
+            held.set()
+            release.wait()
+    holder = threading.Thread(target=hold)
+    holder.start()
+    held.wait()
+    with pytest.raises(BusyError):
+        with router.checkout('ab'):
+            pass
+    release.set()
+    holder.join()
+
+
+def test_connection_requires_checkout(tmp_path):
+    router = Router(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        router.connection('key')
+    with router.pinned('key') as conn:
+        assert router.connection('key') is conn
+        assert router.poolstatus()[conn.name]['utilisation'] > 0
+
+
+def test_lazy_open(tmp_path):
+    router = Router(str(tmp_path))
+    with router.checkout('ab') as conn:
+        assert not conn.isopen()
+        conn.db()['key'] = 'value'
+        assert conn.isopen()
+    router.close()
+    assert not conn.isopen()
+
+
+def test_maxopen(tmp_path):
+    router = Router(str(tmp_path), maxopen=2)
+    conns = []
+    for name in ('aa', 'bb', 'cc', 'dd'):
+        with router.checkout(name) as conn:
+            conn.db()['key'] = name
+            conns.append(conn)
+    assert sorted(router.pool) == ['cc', 'dd']
+    assert [conn.isopen() for conn in conns] == [False, False, True, True]
+    with router.checkout('aa') as conn:
+        assert conn.db()['key'] == b'aa'
+    assert sorted(router.pool) == ['aa', 'dd']
+
+
+def test_maxopen_in_use(tmp_path):
+    router = Router(str(tmp_path), maxopen=1)
+    with router.checkout('aa') as first, router.checkout('bb') as second:
+        first.db()['key'] = 'a'
+        second.db()['key'] = 'b'
+        assert first.isopen() and second.isopen()
+    with router.checkout('cc'):
+        pass
+    assert list(router.pool) == ['cc']
+    assert not first.isopen() and not second.isopen()
+
+
+def test_storage_options(tmp_path):
+    options = storageoptions('throughput', {'safety': 'full', 'mmap': False})
+    assert options['autoflush'] == 8192
+    assert options['write_safety'] == lsm.SAFETY_FULL
+    router = Router(str(tmp_path), options=options)
+    with router.checkout('ab') as conn:
+        db = conn.db()
+        assert db.autoflush == 8192
+        assert db.write_safety == lsm.SAFETY_FULL
+        assert not db.mmap
+
+
+def test_storage_options_invalid():
+    with pytest.raises(ValueError):
+        storageoptions('nonexisting')
+    with pytest.raises(ValueError):
+        storageoptions(options={'nonexisting': 1})
+    with pytest.raises(ValueError):
+        storageoptions(options={'safety': 'paranoid'})
+    with pytest.raises(ValueError):
+        storageoptions('bulk-load', {'compression': 'zstd'})
+
+
+def test_reset(tmp_path):
+    router = Router(str(tmp_path))
+    other = Router(str(tmp_path))
+    for r in (router, other):
+        with r.checkout('ab') as conn:
+            conn.db()[b'key'] = b'value'
+    # files of dbs created before generations
+    assert (tmp_path / 'ab.clodssdb').exists()
+    router.reset()
+    assert not list(tmp_path.glob('*.clodssdb*'))
+    assert not router.poolstatus()
+    assert router.datapath != str(tmp_path)
+    with router.checkout('ab') as conn:
+        assert b'key' not in conn.db()
+        conn.db()[b'key'] = b'new'
+    # other processes switch to the new generation
+    time.sleep(Router.GENERATION_CHECK_INTERVAL)
+    with other.checkout('ab') as conn:
+        assert conn.db()[b'key'] == b'new'
+    previous = router.datapath
+    router.reset(asynchronous=True)
+    with router.checkout('ab') as conn:
+        assert b'key' not in conn.db()
+    for _ in range(100):
+        if not os.path.exists(previous):
+            break
+        time.sleep(.01)
+    assert not os.path.exists(previous)
+    other.close()
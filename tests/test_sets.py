@@ -0,0 +1,182 @@
+'''
+test cases for sets functionality
+'''
+
+import collections
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from clodss import clodss
+from clodss.common import SEP
+
+db = clodss.StrictRedis(
+    os.path.realpath(os.path.dirname(__file__) + '/../data'),
+    decode_responses=True
+)
+
+skeys = ['set-a', 'set-b', 'set-c', 'set-dest']
+
+
+def setup_function():
+    for skey in skeys:
+        db.delete(skey)
+
+
+def test_sadd():
+    assert db.sadd('set-a', 'x', 'y', 'x') == 2
+    assert db.sadd('set-a', 'y', 'z') == 1
+    assert db.scard('set-a') == 3
+    assert db.smembers('set-a') == {'x', 'y', 'z'}
+    assert db.sismember('set-a', 'x')
+    assert not db.sismember('set-a', 'w')
+    assert db.smismember('set-a', ['w', 'x']) == [False, True]
+    assert db.srem('set-a', 'x', 'w') == 1
+    assert db.scard('set-a') == 2
+    assert db.srem('set-a', 'y', 'z') == 2
+    assert db.keydtype('set-a') is None
+    db.set('set-b', 'string')
+    with pytest.raises(ValueError):
+        db.sadd('set-b', 'x')
+    assert db.get('set-b') == 'string'
+
+
+def test_smove():
+    db.sadd('set-a', 'x', 'y')
+    assert db.smove('set-a', 'set-b', 'x') == 1
+    assert db.smove('set-a', 'set-b', 'w') == 0
+    assert db.smembers('set-a') == {'y'}
+    assert db.smembers('set-b') == {'x'}
+
+
+def test_lock_order(tmp_path):
+    # commands on sets of two dbs lock them in the same order
+    sdb = clodss.StrictRedis(str(tmp_path), decode_responses=True)
+    first = 'set-a'
+    second = next(f'set-{i}' for i in range(100)
+                  if sdb.router.shard(f'set-{i}') != sdb.router.shard(first))
+    sdb.sadd(first, *range(100))
+    sdb.sadd(second, *range(100, 200))
+
+    def move(src, dest):
+        for i in range(100):
+            sdb.smove(src, dest, i if src == first else i + 100)
+            sdb.sunionstore(dest, dest, src)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(2) as executor:
+            list(executor.map(move, (first, second), (second, first)))
+    finally:
+        sys.setswitchinterval(interval)
+    assert sdb.sunion(first, second) == {str(i) for i in range(200)}
+    for command in ('smove', 'sunionstore'):
+        assert sdb.metrics.snapshot()['commands'][command]['retries'] == 0
+
+
+def test_algebra():
+    a = {str(i) for i in range(0, 1000, 2)}
+    b = {str(i) for i in range(0, 1000, 3)}
+    c = {str(i) for i in range(0, 1000, 5)}
+    db.sadd('set-a', *a)
+    db.sadd('set-b', *b)
+    db.sadd('set-c', *c)
+    assert db.sinter('set-a', 'set-b', 'set-c') == a & b & c
+    assert db.sinter('set-a', 'set-b', 'nonexisting') == set()
+    assert db.sunion('set-a', 'set-b', 'set-c') == a | b | c
+    assert db.sdiff('set-a', 'set-b', 'set-c') == a - b - c
+    assert db.sdiff('set-a') == a
+    assert db.sinterstore('set-dest', 'set-a', 'set-b') == len(a & b)
+    assert db.smembers('set-dest') == a & b
+    assert db.scard('set-dest') == len(a & b)
+    assert db.sunionstore('set-dest', 'set-dest', 'set-c') == len(a & b | c)
+    assert db.smembers('set-dest') == a & b | c
+    assert db.sdiffstore('set-dest', 'set-a', 'set-a') == 0
+    assert db.keydtype('set-dest') is None
+
+
+def test_srandmember_spop():
+    members = {f'member-{i}' for i in range(100)}
+    db.sadd('set-a', *members)
+    assert db.srandmember('set-a') in members
+    sample = db.srandmember('set-a', 10)
+    assert len(set(sample)) == 10 and set(sample) <= members
+    assert len(db.srandmember('set-a', -200)) == 200
+    assert set(db.srandmember('set-a', 200)) == members
+    popped = db.spop('set-a', 30)
+    assert len(set(popped)) == 30
+    assert db.scard('set-a') == 70
+    assert not set(popped) & db.smembers('set-a')
+    assert db.spop('set-dest') is None
+    assert db.srandmember('set-dest') is None
+    with pytest.raises(ValueError):
+        db.spop('set-a', -1)
+    assert db.scard('set-a') == 70
+
+
+def test_sampling_uniformity():
+    # members with very uneven gaps between them in the key space
+    members = ['a', 'b', 'c', 'd', 'e', 'p', 'x', 'y', 'z', 'zzzz']
+    db.sadd('set-a', *members)
+    random.seed(1)
+    for draw in (lambda: db.srandmember('set-a', -10000),
+                 lambda: [db.srandmember('set-a') for _ in range(10000)],
+                 lambda: sum((db.srandmember('set-a', 3)
+                              for _ in range(3333)), [])):
+        counts = collections.Counter(draw())
+        expected = sum(counts.values()) / len(members)
+        chi2 = sum((counts[m] - expected) ** 2 / expected for m in members)
+        # 99.9% quantile of the chi-square distribution with 9 degrees of
+        # freedom
+        assert chi2 < 27.88
+
+
+def test_rank_index(monkeypatch):
+    monkeypatch.setattr('clodss.sets.RANK_RANGE', 3)
+    random.seed(2)
+    members = set()
+    for _ in range(60):
+        added = {f'm{random.randrange(100)}' for _ in range(5)}
+        db.sadd('set-a', *added)
+        members |= added
+        removed = {f'm{random.randrange(100)}' for _ in range(3)}
+        db.srem('set-a', *removed)
+        members -= removed
+        members.difference_update(db.spop('set-a', 2))
+    db.sunionstore('set-b', 'set-a', 'set-c')
+    for skey in ('set-a', 'set-b'):
+        prefix = f'{skey}{SEP}sr{SEP}'.encode('utf-8')
+        with db.router.pinned(skey) as conn:
+            ranges = [(k[len(prefix):].decode('utf-8'), int(v))
+                      for k, v in conn.db()[prefix:prefix + b'\xff']]
+        assert ranges[0][0] == ''
+        bounds = [first for first, _ in ranges[1:]] + [None]
+        for (first, count), end in zip(ranges, bounds):
+            assert 0 < count <= 6 or first == ''
+            assert count == sum(first <= m and (end is None or m < end)
+                                for m in members)
+    counts = collections.Counter(db.srandmember('set-a', -100 * len(members)))
+    assert set(counts) == members
+    chi2 = sum((counts[m] - 100) ** 2 / 100 for m in members)
+    # 99.9% quantile of the chi-square distribution, approximated for
+    # len(members) - 1 degrees of freedom
+    assert chi2 < len(members) + 4 * len(members) ** .5 + 10
+    db.srem('set-a', *members)
+    assert db.keydtype('set-a') is None
+
+
+def test_sscan():
+    members = {f'm{i:04d}' for i in range(2500)}
+    db.sadd('set-a', *members)
+    cursor, seen = 0, set()
+    while True:
+        cursor, batch = db.sscan('set-a', cursor, count=1000)
+        seen.update(batch)
+        if cursor == 0:
+            break
+    assert seen == members
+    assert set(db.sscan_iter('set-a', match='m00?1')) == {
+        f'm00{i}1' for i in range(10)}
+    assert set(db.smembers('set-a', stream=True)) == members
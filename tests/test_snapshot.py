@@ -0,0 +1,106 @@
+'''
+test cases for snapshots
+'''
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from clodss import clodss
+from clodss.snapshot import _copy
+
+
+def test_snapshot(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path / 'db'), decode_responses=True)
+    for i in range(100):
+        db.set(f'key-{i}', i)
+    db.rpush('list', *range(10))
+    db.hset('map', 'field', 'value')
+    manifest = db.snapshot(str(tmp_path / 'snap' / '00'))
+    assert sum(d['records'] for d in manifest['dbs'].values()) == 113
+    db.set('key-1', 'changed')
+    copy = clodss.StrictRedis(str(tmp_path / 'snap'), decode_responses=True)
+    assert copy.get('key-1') == '1'
+    assert copy.lrange('list', 0, -1) == [str(i) for i in range(10)]
+    assert copy.hget('map', 'field') == 'value'
+    assert len(list(copy.keys())) == 102
+
+
+def test_snapshot_incremental(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path / 'db'), decode_responses=True)
+    for i in range(100):
+        db.set(f'key-{i}', i)
+    first = str(tmp_path / 'first' / '00')
+    second = str(tmp_path / 'second' / '00')
+    db.snapshot(first)
+    db.set('key-1', 'changed')
+    manifest = db.snapshot(second, base=first)
+    assert not any(
+        os.path.samefile(os.path.join(first, f'{name}.clodssdb'),
+                         os.path.join(second, f'{name}.clodssdb'))
+        for name in manifest['dbs'])
+    copy = clodss.StrictRedis(str(tmp_path / 'second'),
+                              decode_responses=True)
+    assert copy.get('key-1') == 'changed'
+    assert copy.get('key-2') == '2'
+    # the snapshots do not share files
+    copy.set('key-2', 'restored')
+    original = clodss.StrictRedis(str(tmp_path / 'first'),
+                                  decode_responses=True)
+    assert original.get('key-2') == '2'
+
+
+def test_snapshot_consistent(tmp_path):
+    db = clodss.StrictRedis(str(tmp_path / 'db'), decode_responses=True)
+    keys = [f'list-{i}' for i in range(4)]
+    for key in keys:
+        db.rpush(key, *range(50))
+    stopped = threading.Event()
+
+    def move():
+        i = 0
+        while not stopped.is_set():
+            db.lmove(keys[i % 4], keys[(i + 1) % 4])
+            i += 1
+    mover = threading.Thread(target=move)
+    mover.start()
+    try:
+        for i in range(3):
+            db.snapshot(str(tmp_path / f'snap-{i}' / '00'))
+    finally:
+        stopped.set()
+        mover.join()
+    for i in range(3):
+        copy = clodss.StrictRedis(str(tmp_path / f'snap-{i}'))
+        assert sum(copy.llen(key) for key in keys) == 200
+
+
+def test_snapshot_unlocked(tmp_path, monkeypatch):
+    db = clodss.StrictRedis(str(tmp_path / 'db'), decode_responses=True,
+                            max_open_dbs=4)
+    for i in range(200):
+        db.set(f'key-{i}', i)
+    router = db.router
+
+    def write():
+        # raises BusyError if a db is still locked by the snapshot
+        for name in router.dbnames():
+            with router.locked(name):
+                pass
+        db.set('key-0', 'changed')
+        return True
+    written = []
+
+    def copying(cursor, fname):
+        with ThreadPoolExecutor(1) as pool:
+            written.append(pool.submit(write).result())
+        return _copy(cursor, fname)
+    monkeypatch.setattr('clodss.snapshot._copy', copying)
+    manifest = db.snapshot(str(tmp_path / 'snap' / '00'))
+    assert len(written) == len(manifest['dbs']) > 4
+    assert sum(conn.isopen() for conns in router.pool.values()
+               for conn in conns) <= 4
+    assert sum(d['records'] for d in manifest['dbs'].values()) == 200
+    copied = clodss.StrictRedis(str(tmp_path / 'snap'), decode_responses=True)
+    assert copied.get('key-0') == '0'
+    assert copied.get('key-123') == '123'
@@ -0,0 +1,99 @@
+'''
+test cases for sorted sets functionality
+'''
+
+import os
+import random
+
+import pytest
+from clodss import clodss
+from clodss.zsets import _decodescore, _encodescore
+
+db = clodss.StrictRedis(
+    os.path.realpath(os.path.dirname(__file__) + '/../data'),
+    decode_responses=True
+)
+
+zkey = 'some-zset'
+
+
+def setup_function():
+    db.delete(zkey)
+
+
+def test_score_encoding():
+    scores = [-float('inf'), -1e300, -2.5, -1e-300, 0., 1e-300, 1, 2.5, 1e300,
+              float('inf')] + [random.uniform(-1e6, 1e6) for _ in range(100)]
+    encoded = [_encodescore(s) for s in scores]
+    assert sorted(encoded) == [_encodescore(s) for s in sorted(scores)]
+    assert [_decodescore(e) for e in encoded] == scores
+    assert _encodescore(-0.) == _encodescore(0.)
+
+
+def test_zadd():
+    assert db.zadd(zkey, {'a': 1, 'b': 2}) == 2
+    assert db.zadd(zkey, {'a': 3, 'c': 0}) == 1
+    assert db.zadd(zkey, {'a': 4, 'b': 2}, ch=True) == 1
+    assert db.zadd(zkey, {'a': 5, 'd': 1}, nx=True) == 1
+    assert db.zadd(zkey, {'a': 5, 'e': 1}, xx=True) == 0
+    assert db.zscore(zkey, 'a') == 5
+    assert db.zscore(zkey, 'e') is None
+    assert db.zcard(zkey) == 4
+    assert db.zincrby(zkey, 2.5, 'a') == 7.5
+    assert db.zincrby(zkey, 1, 'new') == 1
+    assert db.zcard(zkey) == 5
+    assert db.zrange(zkey, 0, -1, withscores=True) == [
+        ('c', 0), ('d', 1), ('new', 1), ('b', 2), ('a', 7.5)]
+    with pytest.raises(ValueError):
+        db.zadd(zkey, {'a': 'nan'})
+    with pytest.raises(ValueError):
+        db.hset(zkey, 'a', 1)
+
+
+def test_zrange():
+    db.zadd(zkey, {f'm{i}': i % 5 for i in range(10)})
+    members = [f'm{i}' for i in sorted(range(10), key=lambda i: (i % 5, i))]
+    assert db.zrange(zkey, 0, -1) == members
+    assert db.zrange(zkey, 2, 4) == members[2:5]
+    assert db.zrange(zkey, -3, -1) == members[-3:]
+    assert db.zrange(zkey, 5, 2) == []
+    assert db.zrange(zkey, 8, 100) == members[8:]
+    assert db.zrevrange(zkey, 0, 2) == members[::-1][:3]
+    assert db.zrank(zkey, members[4]) == 4
+    assert db.zrevrank(zkey, members[4]) == 5
+    assert db.zrank(zkey, 'none') is None
+
+
+def test_zrangebyscore():
+    db.zadd(zkey, {f'm{i}': i for i in range(-5, 6)})
+    assert db.zrangebyscore(zkey, 1, 3) == ['m1', 'm2', 'm3']
+    assert db.zrangebyscore(zkey, '(1', '(3') == ['m2']
+    assert db.zrangebyscore(zkey, '-inf', -4, withscores=True) == [
+        ('m-5', -5), ('m-4', -4)]
+    assert db.zrangebyscore(zkey, 0, '+inf', start=1, num=2) == ['m1', 'm2']
+    assert db.zrevrangebyscore(zkey, 3, 1) == ['m3', 'm2', 'm1']
+    assert db.zrevrangebyscore(zkey, '(3', '-inf', start=0, num=2) == [
+        'm2', 'm1']
+    assert db.zcount(zkey, -1.5, 1.5) == 3
+    assert db.zcount(zkey, 10, 20) == 0
+
+
+def test_zrem_zpop():
+    db.zadd(zkey, {f'm{i}': i for i in range(10)})
+    assert db.zrem(zkey, 'm0', 'm1', 'none') == 2
+    assert db.zpopmin(zkey) == [('m2', 2)]
+    assert db.zpopmax(zkey, 2) == [('m9', 9), ('m8', 8)]
+    assert db.zremrangebyscore(zkey, 4, '(6') == 2
+    assert db.zrange(zkey, 0, -1) == ['m3', 'm6', 'm7']
+    assert db.zcard(zkey) == 3
+    assert db.zpopmin(zkey, 10) == [('m3', 3), ('m6', 6), ('m7', 7)]
+    assert db.zcard(zkey) == 0
+    assert db.keydtype(zkey) is None
+
+
+def test_zset_keys():
+    db.zadd(zkey, {'a': 1})
+    assert zkey in set(db.keys())
+    db.expire(zkey, 100)
+    db.delete(zkey)
+    assert db.zrange(zkey, 0, -1) == []